@@ -0,0 +1,164 @@
+"""
+Load test of concurrent database writes from many workers.
+
+Simulates workers each POSTing progress updates for their own encode task (the manager's most frequent write) while a
+dashboard polls the in-progress task list, and reports the latency of the writes.  With SQLite, this runs once for each
+journal mode, against an on-disk test database each time.  With Postgres configured (see
+`utils.config.load_database_config`), it runs once against a test database on the server.
+
+Usage (from the repository root):
+    python -m benchmarks.database_load [--workers 50] [--updates 40] [--journal-modes delete,wal]
+"""
+import argparse
+import json
+import os
+import pathlib
+import statistics
+import tempfile
+import threading
+import time
+
+
+def _percentile(values: list, percentile: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+
+def _run_load(workers: int, updates: int) -> dict:
+    from django.db import connection
+    from django.test import Client
+
+    import distributor.models
+    import encodes.models
+
+    profile = encodes.models.Profile.objects.create(
+        name="benchmark", codec="libx264", encode_type="crf", encode_value=18, encoder_preset="slow",
+        keep_original_main_audio=True
+    )
+    task_ids = []
+    for i in range(workers):
+        source_file = distributor.models.File.objects.create(
+            name="source_{}.mkv".format(i), directory="/input", size=1000000, duration=60, frame_rate=23.976,
+            frames=1439, width=1920, height=1080
+        )
+        task_ids.append(encodes.models.EncodeTask.objects.create(
+            source_file=source_file, profile=profile, encode_type="crf", encode_value=18,
+            status=encodes.models.EncodeTask.TaskStatus.DOWNLOADING, worker="worker_{}".format(i)
+        ).pk)
+
+    latencies = []
+    errors = []
+    polls = []
+    lock = threading.Lock()
+    start = threading.Barrier(workers + 1)
+    finished = threading.Event()
+
+    def run_worker(index: int):
+        client = Client()
+        url = "/api/tasks/{}".format(task_ids[index])
+        worker = "worker_{}".format(index)
+        start.wait()
+        try:
+            for update in range(updates):
+                body = json.dumps({"progress": round(100 * (update + 1) / updates, 2), "fps": 50.0, "eta": 60})
+                request_start = time.perf_counter()
+                try:
+                    response = client.post(url, body, content_type="application/json", HTTP_WORKER=worker)
+                    status_code = response.status_code
+                except Exception as e:
+                    status_code = str(e)
+                with lock:
+                    latencies.append(time.perf_counter() - request_start)
+                    if status_code != 200:
+                        errors.append(status_code)
+        finally:
+            connection.close()
+
+    def run_dashboard():
+        client = Client()
+        start.wait()
+        try:
+            while not finished.is_set():
+                request_start = time.perf_counter()
+                client.get("/api/tasks/in-progress/?fields=id,status,progress")
+                polls.append(time.perf_counter() - request_start)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=run_worker, args=(x,)) for x in range(workers)]
+    dashboard = threading.Thread(target=run_dashboard)
+    for thread in threads + [dashboard]:
+        thread.start()
+
+    load_start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    load_seconds = time.perf_counter() - load_start
+    finished.set()
+    dashboard.join()
+
+    encodes.models.EncodeTask.objects.all().delete()
+    distributor.models.File.objects.all().delete()
+    profile.delete()
+
+    return {
+        "writes": len(latencies),
+        "errors": len(errors),
+        "writes_per_second": round(len(latencies) / load_seconds, 1),
+        "write_latency_ms": {
+            "mean": round(statistics.mean(latencies) * 1000, 2),
+            "p50": round(_percentile(latencies, 50) * 1000, 2),
+            "p95": round(_percentile(latencies, 95) * 1000, 2),
+            "p99": round(_percentile(latencies, 99) * 1000, 2),
+            "max": round(max(latencies) * 1000, 2)
+        },
+        "dashboard_polls": len(polls),
+        "dashboard_latency_ms_p95": round(_percentile(polls, 95) * 1000, 2) if polls else None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, default=50, help="simulated workers writing at once")
+    parser.add_argument("--updates", type=int, default=40, help="progress updates sent by each worker")
+    parser.add_argument("--journal-modes", default="delete,wal", help="SQLite journal modes to compare")
+    arguments = parser.parse_args()
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "sved.settings")
+
+    import django
+    django.setup()
+    from django.conf import settings
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+
+    setup_test_environment()
+    settings.ALLOWED_HOSTS.append("testserver")
+
+    results = {"workers": arguments.workers, "updates": arguments.updates, "vendor": connection.vendor}
+    old_database_name = connection.settings_dict["NAME"]
+    if connection.vendor != "sqlite":
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            results["default"] = _run_load(arguments.workers, arguments.updates)
+        finally:
+            connection.creation.destroy_test_db(old_database_name, verbosity=0)
+    else:
+        for journal_mode in arguments.journal_modes.split(","):
+            with tempfile.TemporaryDirectory() as directory:
+                # An on-disk test database, an in-memory one can't be shared by the workers' connections
+                connection.settings_dict["TEST"]["NAME"] = str(pathlib.Path(directory, "benchmark.sqlite3"))
+                connection.settings_dict["PRAGMAS"] = {"journal_mode": journal_mode}
+                if journal_mode == "wal":
+                    connection.settings_dict["PRAGMAS"]["synchronous"] = "normal"
+                connection.creation.create_test_db(verbosity=0)
+                try:
+                    results[journal_mode] = _run_load(arguments.workers, arguments.updates)
+                finally:
+                    connection.creation.destroy_test_db(old_database_name, verbosity=0)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
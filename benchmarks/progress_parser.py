@@ -0,0 +1,78 @@
+"""
+Microbenchmark for parsing ffmpeg `-progress` output.
+
+Parses a synthetic stream of progress blocks (one per second of a long encode) and reports the cost per update, for
+a few stream lengths.  The cost per update should stay flat as the stream gets longer.
+
+Usage (from the repository root):
+    python -m benchmarks.progress_parser [--updates 36000] [--repeat 5]
+"""
+import argparse
+import io
+import json
+import time
+
+from utils import ffmpeg
+from utils import progress
+
+
+PROGRESS_BLOCK = (
+    "frame={frame}\n"
+    "fps={fps:.2f}\n"
+    "stream_0_0_q=23.0\n"
+    "bitrate=4078.7kbits/s\n"
+    "total_size={size}\n"
+    "out_time_us={time_us}\n"
+    "out_time_ms={time_us}\n"
+    "out_time=00:01:59.287000\n"
+    "dup_frames=0\n"
+    "drop_frames=0\n"
+    "speed=7.56x\n"
+    "progress=continue\n"
+)
+
+
+def _create_stream(updates: int) -> str:
+    return "".join(
+        PROGRESS_BLOCK.format(frame=x * 24, fps=185.81, size=x * 500000, time_us=x * 1000000)
+        for x in range(1, updates + 1)
+    )
+
+
+def _run(stream: str, updates: int, track: bool) -> float:
+    tracker = progress.ProgressTracker(updates * 24)
+
+    start_time = time.perf_counter()
+    for step in ffmpeg.read_progress(io.StringIO(stream), file_framerate=23.976):
+        if track:
+            tracker.update(step)
+    elapsed_time = time.perf_counter() - start_time
+
+    if tracker.updates not in [0, updates]:
+        raise RuntimeError("Expected [{}] updates, tracked [{}]".format(updates, tracker.updates))
+    return elapsed_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--updates", type=int, default=36000, help="updates in the longest stream (1/s, 10 hours)")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per stream length, the best is reported")
+    arguments = parser.parse_args()
+
+    results = []
+    for updates in [arguments.updates // 100, arguments.updates // 10, arguments.updates]:
+        stream = _create_stream(updates)
+        for track in [False, True]:
+            best_time = min(_run(stream, updates, track) for _ in range(arguments.repeat))
+            results.append({
+                "updates": updates,
+                "tracked": track,
+                "total_seconds": round(best_time, 4),
+                "microseconds_per_update": round(best_time / updates * 1000000, 2)
+            })
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
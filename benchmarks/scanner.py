@@ -0,0 +1,135 @@
+"""
+Benchmark for scanning a library of files into the database.
+
+Writes a directory of small synthetic Matroska files (headers with mkvtoolnix statistics, so nothing needs ffprobe or
+mkvpropedit), then times the thread pool `create_file` scan the manager used to run against `distributor.scanner`,
+each against an empty test database and again once every file is already in it.
+
+Usage (from the repository root):
+    python -m benchmarks.scanner [--files 1000] [--processes 8]
+"""
+import argparse
+import json
+import os
+import pathlib
+import struct
+import tempfile
+import time
+
+
+########################################################################################################################
+# Synthetic Files
+########################################################################################################################
+def _vint(value: int) -> bytes:
+    for length in range(1, 9):
+        if value < (1 << (7 * length)) - 1:
+            return ((1 << (7 * length)) | value).to_bytes(length, "big")
+    raise ValueError("Value [{}] is too large".format(value))
+
+
+def _element(element_id: int, payload: bytes) -> bytes:
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, "big") + _vint(len(payload)) + payload
+
+
+def _uint(element_id: int, value: int) -> bytes:
+    return _element(element_id, value.to_bytes(max(1, (value.bit_length() + 7) // 8), "big"))
+
+
+def _string(element_id: int, value: str) -> bytes:
+    return _element(element_id, value.encode())
+
+
+def _tag(name: str, value: str) -> bytes:
+    return _element(0x67C8, _string(0x45A3, name) + _string(0x447A, "und") + _string(0x4487, value))
+
+
+def _create_file(file_path: pathlib.Path, index: int) -> None:
+    frames = 24000 + index
+    info = _element(0x1549A966, _uint(0x2AD7B1, 1000000) + _element(0x4489, struct.pack(">d", frames * 1001 / 24)))
+    video = _element(0xE0, _uint(0xB0, 1920) + _uint(0xBA, 1080) + _uint(0x9A, 2))
+    tracks = _element(0x1654AE6B, _element(
+        0xAE, _uint(0xD7, 1) + _uint(0x73C5, index + 1) + _uint(0x83, 1) + _string(0x86, "V_MPEG4/ISO/AVC")
+        + _uint(0x23E383, 41708333) + video
+    ))
+    tags = _element(0x1254C367, _element(
+        0x7373, _element(0x63C0, _uint(0x63C5, index + 1)) + _tag("BPS", "5000000")
+        + _tag("NUMBER_OF_FRAMES", str(frames)) + _tag("_STATISTICS_WRITING_APP", "mkvmerge v80.0")
+    ))
+    cluster = _element(0x1F43B675, bytes(4096))
+
+    body = info + tracks + tags + cluster
+    with file_path.open("wb") as file:
+        file.write(_element(0x1A45DFA3, _string(0x4282, "matroska")))
+        file.write(b"\x18\x53\x80\x67" + b"\x01" + len(body).to_bytes(7, "big") + body)
+
+
+########################################################################################################################
+# Benchmark
+########################################################################################################################
+def _time(function, *args) -> float:
+    start_time = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", type=int, default=1000, help="files in the synthetic library")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="scanner processes")
+    arguments = parser.parse_args()
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "sved.settings")
+    os.environ["SCANNER_PROCESSES"] = str(arguments.processes)
+
+    import concurrent.futures
+
+    import django
+    django.setup()
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+
+    import distributor.models
+    import distributor.scanner
+    import distributor.utilities
+    from utils import ffprobe
+
+    def scan_threads(files):
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            return [x for x in executor.map(distributor.utilities.create_file, files) if x]
+
+    results = {"files": arguments.files, "processes": arguments.processes}
+    with tempfile.TemporaryDirectory() as directory:
+        # An on-disk test database, an in-memory one can't be shared by the thread pool's connections
+        setup_test_environment()
+        old_database_name = connection.settings_dict["NAME"]
+        connection.settings_dict["TEST"]["NAME"] = str(pathlib.Path(directory, "benchmark.sqlite3"))
+        connection.creation.create_test_db(verbosity=0)
+
+        try:
+            files = []
+            for i in range(arguments.files):
+                files.append(pathlib.Path(directory, "video_{:05d}.mkv".format(i)))
+                _create_file(files[-1], i)
+
+            for name, function in [("thread_pool", scan_threads), ("scanner", distributor.scanner.scan_files)]:
+                distributor.models.File.objects.all().delete()
+                ffprobe.invalidate_file_info()
+                new_seconds = _time(function, files)
+                ffprobe.invalidate_file_info()
+                existing_seconds = _time(function, files)
+
+                results[name] = {
+                    "rows": distributor.models.File.objects.count(),
+                    "new_seconds": round(new_seconds, 3),
+                    "new_files_per_second": round(arguments.files / new_seconds, 1),
+                    "existing_seconds": round(existing_seconds, 3),
+                    "existing_files_per_second": round(arguments.files / existing_seconds, 1)
+                }
+        finally:
+            connection.creation.destroy_test_db(old_database_name, verbosity=0)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
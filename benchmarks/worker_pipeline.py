@@ -0,0 +1,343 @@
+"""
+Benchmark of the worker pipeline on synthetic sources, without real media or a real manager.
+
+Generates an MKV for each resolution with ffmpeg's lavfi sources (testsrc2 or mandelbrot video, sine audio), then runs
+the worker's own download, encode, upload and metrics functions on it against a stub manager on localhost.  Each stage
+reports its speed (fps, or MB/s for transfers), how many subprocesses it started, how much CPU the worker process
+itself used, and what parsing ffmpeg's progress output cost: the progress lines ffmpeg wrote are recorded during the
+run and parsed again afterwards on their own, so the timing isn't mixed up with waiting on ffmpeg.  The stub manager
+runs in the benchmark's process, so the worker CPU time of the transfers includes the manager's side of them.
+
+Needs ffmpeg (with libx264 and, for metrics, libvmaf), ffprobe and mkvtoolnix, like the worker.  The metrics stage
+downloads the VMAF model to the working directory the first time, like the worker; skip it with `--skip-metrics`.
+The worker logs as configured, to stdout, so use `--output` for a file with only the results.
+
+Usage (from the repository root):
+    python -m benchmarks.worker_pipeline [--resolutions 720p,1080p,2160p] [--seconds 10] [--pattern testsrc2]
+                                         [--preset veryfast] [--crf 18] [--skip-metrics] [--output results.json]
+"""
+import argparse
+import collections
+import http.server
+import importlib.util
+import json
+import os
+import pathlib
+import shlex
+import subprocess
+import tempfile
+import threading
+import time
+import typing
+
+from utils import ffmpeg
+from utils import ffprobe
+from utils import mkvtoolnix
+from utils import progress
+from utils import subprocess_handler
+
+
+RESOLUTIONS = {
+    "720p": (1280, 720),
+    "1080p": (1920, 1080),
+    "2160p": (3840, 2160)
+}
+FRAME_RATE = 24
+
+
+########################################################################################################################
+# Synthetic Sources
+########################################################################################################################
+def _create_source(file_path: pathlib.Path, resolution: str, seconds: int, pattern: str) -> None:
+    width, height = RESOLUTIONS[resolution]
+    command = "ffmpeg -hide_banner -nostats -loglevel error -y"
+    command += " -f lavfi -i {}=size={}x{}:rate={}".format(pattern, width, height, FRAME_RATE)
+    command += " -f lavfi -i sine=frequency=440:sample_rate=48000"
+    # High quality video (the source should be much bigger than the encode, like a real one) and lossless stereo audio
+    command += " -t {} -map 0:v -map 1:a -c:v libx264 -preset ultrafast -crf 10 -pix_fmt yuv420p".format(seconds)
+    command += " -c:a flac -ac 2 \"{}\"".format(file_path)
+
+    process = subprocess.run(shlex.split(command), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        raise RuntimeError("Creating [{}] returned code [{}]: {}".format(
+            file_path.name, process.returncode, process.stderr.decode(errors="backslashreplace").strip()
+        ))
+
+    # Sources from the manager always have statistics tags
+    mkvtoolnix.add_media_statistics(file_path)
+
+
+########################################################################################################################
+# Stub Manager
+########################################################################################################################
+class _StubManager(http.server.ThreadingHTTPServer):
+    """
+    Just enough of the manager for the worker functions being measured: GET serves the source file, POST to
+    `/upload` takes an encoded file, and any other POST is a progress update.
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _StubManagerHandler)
+        self.source_file: typing.Optional[pathlib.Path] = None
+        self.uploaded_bytes = 0
+        self.progress_updates = 0
+        self._lock = threading.Lock()
+
+    def get_url(self, path: str) -> str:
+        return "http://127.0.0.1:{}/{}".format(self.server_address[1], path)
+
+    def count_progress_update(self) -> None:
+        with self._lock:
+            self.progress_updates += 1
+
+    def take_progress_updates(self) -> int:
+        with self._lock:
+            progress_updates = self.progress_updates
+            self.progress_updates = 0
+        return progress_updates
+
+
+class _StubManagerHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(self.server.source_file.stat().st_size))
+        self.end_headers()
+        with self.server.source_file.open("rb") as file:
+            while chunk := file.read(1024 * 1024):
+                self.wfile.write(chunk)
+
+    def do_POST(self):
+        remaining = int(self.headers.get("Content-Length", 0))
+        received = 0
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                break
+            received += len(chunk)
+            remaining -= len(chunk)
+
+        if self.path == "/upload":
+            self.server.uploaded_bytes = received
+        else:
+            self.server.count_progress_update()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _StubChannel:
+    """
+    Stands in for the worker's rabbitmq channel, which ffmpeg runs only use to send heartbeats.
+    """
+
+    def __init__(self):
+        self.connection = self
+
+    def process_data_events(self) -> None:
+        pass
+
+
+########################################################################################################################
+# Measuring
+########################################################################################################################
+class _Instrumentation:
+    """
+    Counts every subprocess started (by program name) and records every line of ffmpeg progress output read, for as
+    long as it's entered.
+    """
+
+    def __init__(self):
+        self.subprocesses: typing.Counter[str] = collections.Counter()
+        self.progress_lines: typing.List[str] = []
+        self._lock = threading.Lock()
+        self._original_popen = subprocess.Popen
+        self._original_read_progress = ffmpeg.read_progress
+
+    def __enter__(self) -> "_Instrumentation":
+        instrumentation = self
+
+        class CountingPopen(self._original_popen):
+            def __init__(self, args, *arguments, **keyword_arguments):
+                program = args[0] if isinstance(args, (list, tuple)) else shlex.split(args)[0]
+                with instrumentation._lock:
+                    instrumentation.subprocesses[pathlib.Path(program).name] += 1
+                super().__init__(args, *arguments, **keyword_arguments)
+
+        def recording_read_progress(stream, file_framerate=None):
+            return self._original_read_progress(self._record(stream), file_framerate=file_framerate)
+
+        subprocess.Popen = CountingPopen
+        ffmpeg.read_progress = recording_read_progress
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        subprocess.Popen = self._original_popen
+        ffmpeg.read_progress = self._original_read_progress
+
+    def _record(self, stream: typing.Iterable[str]) -> typing.Iterator[str]:
+        for line in stream:
+            with self._lock:
+                self.progress_lines.append(line)
+            yield line
+
+    def time_parser(self, frame_count: int) -> typing.Tuple[int, float]:
+        """
+        Parse the recorded progress output again, the same way the worker does, without waiting on ffmpeg.
+
+        :param frame_count: frames in the source, for the progress tracker
+        :return: progress updates parsed, and seconds it took
+        """
+        tracker = progress.ProgressTracker(frame_count)
+        start_time = time.perf_counter()
+        for step in self._original_read_progress(iter(self.progress_lines), file_framerate=FRAME_RATE):
+            tracker.update(step)
+        return tracker.updates, time.perf_counter() - start_time
+
+
+def _measure(function: typing.Callable, *args, frame_count: int, **kwargs) -> typing.Tuple[typing.Any, dict]:
+    # Every stage probes its files itself, like a worker starting on a new task
+    ffprobe.invalidate_file_info()
+
+    with _Instrumentation() as instrumentation:
+        cpu_start = time.process_time()
+        start_time = time.perf_counter()
+        result = function(*args, **kwargs)
+        seconds = time.perf_counter() - start_time
+        cpu_seconds = time.process_time() - cpu_start
+
+    results = {
+        "seconds": round(seconds, 3),
+        "worker_cpu_seconds": round(cpu_seconds, 3),
+        "subprocesses": dict(sorted(instrumentation.subprocesses.items()))
+    }
+    if instrumentation.progress_lines:
+        updates, parser_seconds = instrumentation.time_parser(frame_count)
+        results["fps"] = round(frame_count / seconds, 2)
+        results["progress_updates"] = updates
+        results["parser_seconds"] = round(parser_seconds, 6)
+        results["parser_microseconds_per_update"] = round(parser_seconds / updates * 1000000, 2) if updates else None
+        results["parser_share"] = round(parser_seconds / seconds, 6)
+    return result, results
+
+
+def _load_worker():
+    # Not importable by name because of the dash
+    worker_path = pathlib.Path(__file__).resolve().parent.parent.joinpath("sved-worker.py")
+    specification = importlib.util.spec_from_file_location("sved_worker", worker_path)
+    worker = importlib.util.module_from_spec(specification)
+    specification.loader.exec_module(worker)
+    return worker
+
+
+def _get_ffmpeg_version() -> str:
+    process = subprocess.run(["ffmpeg", "-version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    return process.stdout.splitlines()[0] if process.stdout else "unknown"
+
+
+def _run_resolution(worker, manager: _StubManager, directory: pathlib.Path, resolution: str,
+                    arguments: argparse.Namespace) -> dict:
+    source_file = directory.joinpath("source_{}.mkv".format(resolution))
+    _create_source(source_file, resolution, arguments.seconds, arguments.pattern)
+    manager.source_file = source_file
+    frame_count = ffprobe.get_file_info(source_file).frames
+    channel = _StubChannel()
+
+    results = {"resolution": resolution, "frames": frame_count, "source_bytes": source_file.stat().st_size}
+
+    downloaded_file, results["download"] = _measure(
+        worker.download_file, manager.get_url("source"), "{}.mkv".format(resolution), frame_count=frame_count
+    )
+    results["download"]["mb_per_second"] = round(
+        downloaded_file.stat().st_size / 1000000 / results["download"]["seconds"], 2
+    )
+    # The download is only measured, the encode uses the source, so both get the same statistics tags
+    downloaded_file.unlink()
+
+    profile = {
+        "codec": "libx264", "encoder_preset": arguments.preset, "encoder_tune": None,
+        "encode_type": "crf", "encode_value": arguments.crf
+    }
+    encoded_file, results["encode"] = _measure(
+        worker.encode_file, source_file, profile, manager.get_url("tasks/encode"), channel, frame_count=frame_count
+    )
+    results["encode"]["output_bytes"] = encoded_file.stat().st_size
+    results["encode"]["manager_progress_posts"] = manager.take_progress_updates()
+
+    _, results["upload"] = _measure(
+        worker.upload_file, manager.get_url("upload"), encoded_file, frame_count=frame_count
+    )
+    results["upload"]["mb_per_second"] = round(manager.uploaded_bytes / 1000000 / results["upload"]["seconds"], 2)
+
+    if not arguments.skip_metrics:
+        report_file, results["metrics"] = _measure(
+            worker.calculate_metrics, source_file, encoded_file, True, True, False, 1,
+            manager.get_url("tasks/metrics"), channel, frame_count=frame_count
+        )
+        results["metrics"]["manager_progress_posts"] = manager.take_progress_updates()
+        report_file.unlink()
+
+    encoded_file.unlink()
+    source_file.unlink()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--resolutions", default="720p,1080p,2160p", help="sources to generate, of {}".format(
+        ",".join(RESOLUTIONS)
+    ))
+    parser.add_argument("--seconds", type=int, default=10, help="length of each source")
+    parser.add_argument("--pattern", default="testsrc2", choices=["testsrc2", "mandelbrot"], help="video source")
+    parser.add_argument("--preset", default="veryfast", help="libx264 preset of the encode")
+    parser.add_argument("--crf", type=int, default=18, help="CRF of the encode")
+    parser.add_argument("--skip-metrics", action="store_true", help="don't run VMAF (needs the model download)")
+    parser.add_argument("--output", type=pathlib.Path, help="also write the results to this file")
+    arguments = parser.parse_args()
+
+    resolutions = arguments.resolutions.split(",")
+    for resolution in resolutions:
+        if resolution not in RESOLUTIONS:
+            parser.error("Unknown resolution [{}]".format(resolution))
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["WORKDIR"] = str(pathlib.Path(directory, "workdir"))
+        worker = _load_worker()
+
+        manager = _StubManager()
+        server_thread = threading.Thread(target=manager.serve_forever, daemon=True)
+        server_thread.start()
+        try:
+            results = {
+                "ffmpeg": _get_ffmpeg_version(),
+                "pattern": arguments.pattern,
+                "seconds": arguments.seconds,
+                "preset": arguments.preset,
+                "crf": arguments.crf,
+                "threads": worker._get_thread_count(),
+                "resolutions": [
+                    _run_resolution(worker, manager, pathlib.Path(directory), x, arguments) for x in resolutions
+                ],
+                # Totals for every command run through `utils.subprocess_handler`, including generating the sources
+                "subprocess_statistics": subprocess_handler.get_statistics()
+            }
+        finally:
+            manager.shutdown()
+            manager.server_close()
+
+    output = json.dumps(results, indent=2)
+    if arguments.output:
+        arguments.output.write_text(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
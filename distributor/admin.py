@@ -8,7 +8,14 @@ import distributor.models
 ########################################################################################################################
 class FileAdmin(admin.ModelAdmin):
     list_display = (
-        "id", "name", "directory", "size", "duration", "frame_rate", "frames"
+        "id", "name", "directory", "size", "duration", "frame_rate", "frames", "width", "height"
+    )
+    ordering = ("pk", )
+
+
+class WorkerAdmin(admin.ModelAdmin):
+    list_display = (
+        "id", "hostname", "tier", "cores", "avx512", "free_space", "registration_datetime", "last_seen_datetime"
     )
     ordering = ("pk", )
 
@@ -17,3 +24,4 @@ class FileAdmin(admin.ModelAdmin):
 # Default Admin models
 ########################################################################################################################
 admin.site.register(distributor.models.File, FileAdmin)
+admin.site.register(distributor.models.Worker, WorkerAdmin)
@@ -1,6 +1,11 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class DistributorConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'distributor'
+
+    def ready(self):
+        import sved.database
+        connection_created.connect(sved.database.configure_connection, dispatch_uid="sved-configure-connection")
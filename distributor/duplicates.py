@@ -0,0 +1,108 @@
+import queue
+import threading
+import typing
+
+from django.db import connection
+
+import distributor.models
+
+from utils import fingerprint
+from utils import log
+
+
+########################################################################################################################
+# Finding Duplicates
+########################################################################################################################
+def find_renamed_files(fingerprints: typing.Iterable[str]) -> typing.Dict[str, distributor.models.File]:
+    """
+    Find files that have been renamed or moved: a file with the same fingerprint is in the database, but isn't at its
+    path any more.
+
+    :param fingerprints: fingerprints of files without an entry at their path
+    :return: File objects with one of the fingerprints and no file at their path, by fingerprint
+    """
+    fingerprints = set(x for x in fingerprints if x)
+    if not fingerprints:
+        return {}
+
+    renamed_files = {}
+    for file_object in distributor.models.File.objects.filter(fingerprint__in=fingerprints).order_by("pk"):
+        if file_object.fingerprint not in renamed_files and not file_object.get_full_path().exists():
+            renamed_files[file_object.fingerprint] = file_object
+    return renamed_files
+
+
+def get_duplicates(file_object: distributor.models.File) -> typing.List[distributor.models.File]:
+    """
+    Get the other files in the database with the same contents as a file.  Files match on their fingerprint, unless
+    both have a full hash, then that has to match too.
+
+    :param file_object: file to find duplicates of
+    :return: File objects of the duplicates, oldest first
+    """
+    if not file_object.fingerprint:
+        return []
+
+    duplicates = distributor.models.File.objects.filter(fingerprint=file_object.fingerprint).exclude(pk=file_object.pk)
+    return [x for x in duplicates.order_by("pk") if not (x.hash and file_object.hash and x.hash != file_object.hash)]
+
+
+########################################################################################################################
+# Full Hashes
+########################################################################################################################
+_hash_queue: "queue.Queue[int]" = queue.Queue()
+_hash_thread: typing.Optional[threading.Thread] = None
+_hash_thread_lock = threading.Lock()
+
+
+def _hash_file(file_id: int) -> None:
+    file_object = distributor.models.File.objects.filter(pk=file_id).first()
+    if not file_object or file_object.hash:
+        return
+
+    file_path = file_object.get_full_path()
+    try:
+        # The file may have changed since it was scanned, the hash has to be of the same contents as the fingerprint
+        if fingerprint.get_fingerprint(file_path) != file_object.fingerprint:
+            log.debug("[{}] changed since it was scanned, not hashing it".format(file_path))
+            return
+        file_hash = fingerprint.hash_file(file_path)
+    except OSError as e:
+        log.warning("Could not hash [{}]: {}".format(file_path, e))
+        return
+
+    distributor.models.File.objects.filter(pk=file_id, fingerprint=file_object.fingerprint).update(hash=file_hash)
+    log.debug("Hashed [{}] as [{}]".format(file_path, file_hash))
+
+
+def _run_hash_queue() -> None:
+    while True:
+        file_id = _hash_queue.get()
+        try:
+            _hash_file(file_id)
+        except Exception as e:
+            log.error("Hashing file [{}] failed: {}".format(file_id, e))
+        finally:
+            _hash_queue.task_done()
+
+        if _hash_queue.empty():
+            connection.close()
+
+
+def queue_hashes(file_ids: typing.Iterable[int]) -> None:
+    """
+    Calculate the full hash of files in a background thread, one file at a time so a scan of a whole library doesn't
+    saturate its disks.  Files that already have a hash are skipped.
+
+    :param file_ids: IDs of files to hash
+    :return: None
+    """
+    global _hash_thread
+
+    with _hash_thread_lock:
+        if _hash_thread is None or not _hash_thread.is_alive():
+            _hash_thread = threading.Thread(target=_run_hash_queue, name="file-hasher", daemon=True)
+            _hash_thread.start()
+
+    for file_id in file_ids:
+        _hash_queue.put(file_id)
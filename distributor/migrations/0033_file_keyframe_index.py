@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 04:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('distributor', '0032_remove_file_ffprobe_information'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='keyframe_index',
+            field=models.BinaryField(null=True),
+        ),
+    ]
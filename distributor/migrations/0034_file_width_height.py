@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-19 04:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('distributor', '0033_file_keyframe_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='height',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='width',
+            field=models.IntegerField(null=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.7 on 2026-10-19 04:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('distributor', '0034_file_width_height'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Worker',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hostname', models.CharField(max_length=128, unique=True)),
+                ('tier', models.CharField(choices=[('small', 'Small'), ('large', 'Large')], default='small', max_length=16)),
+                ('cores', models.IntegerField(default=1)),
+                ('avx512', models.BooleanField(default=False)),
+                ('free_space', models.BigIntegerField(default=0)),
+                ('benchmarks', models.JSONField(blank=True, default=dict)),
+                ('registration_datetime', models.DateTimeField(auto_now_add=True)),
+                ('last_seen_datetime', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-19 05:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('distributor', '0035_worker'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='fingerprint',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='hash',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+    ]
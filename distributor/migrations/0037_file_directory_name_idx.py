@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-19 05:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('distributor', '0036_file_fingerprint_hash'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['directory', 'name'], name='file_directory_name_idx'),
+        ),
+    ]
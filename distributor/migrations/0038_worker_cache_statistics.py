@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 05:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('distributor', '0037_file_directory_name_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='worker',
+            name='cache_statistics',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
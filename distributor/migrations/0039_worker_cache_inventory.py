@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 05:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('distributor', '0038_worker_cache_statistics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='worker',
+            name='cache_inventory',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 05:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('distributor', '0040_file_modified_time'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='file',
+            name='size',
+            field=models.BigIntegerField(null=True),
+        ),
+    ]
@@ -1,11 +1,15 @@
 import datetime
 import math
 import pathlib
+import typing
 
 from django.conf import settings
 from django.db import models
 from django.urls import reverse
 
+from utils import ffprobe
+from utils import keyframes
+
 
 ########################################################################################################################
 # Private Helpers
@@ -26,10 +30,29 @@ def _format_bytes(file_size: int):
 class File(models.Model):
     name = models.CharField(max_length=256)
     directory = models.CharField(max_length=256)
-    size = models.IntegerField(null=True)
+    size = models.BigIntegerField(null=True)  # bytes, sources are often over 2 GiB
     duration = models.DecimalField(max_digits=9, decimal_places=3, null=True)
     frame_rate = models.DecimalField(max_digits=6, decimal_places=3, null=True)
     frames = models.IntegerField(null=True)
+    width = models.IntegerField(null=True)
+    height = models.IntegerField(null=True)
+
+    # Content identity, see `utils.fingerprint`.  The fingerprint is taken whenever the file is scanned, the full hash
+    # only if the scanner is configured to (in the background, after the scan).  Both are blank if unknown.
+    fingerprint = models.CharField(max_length=40, blank=True, default="", db_index=True)
+    hash = models.CharField(max_length=40, blank=True, default="")
+    # Modification time (ns) of the file when it was last probed, with the size it's how a rescan knows a file is
+    # unchanged without probing it again
+    modified_time = models.BigIntegerField(null=True)
+
+    # Delta-encoded keyframe timestamps, see `utils.keyframes.KeyframeIndex`.  Built the first time it's asked for.
+    keyframe_index = models.BinaryField(null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # Files are looked up by path, and listed by directory
+            models.Index(fields=["directory", "name"], name="file_directory_name_idx"),
+        ]
 
     def __str__(self):
         return "{} [{}]".format(self.name, self.pk)
@@ -40,6 +63,18 @@ class File(models.Model):
     def get_full_path(self) -> pathlib.Path:
         return pathlib.Path(self.directory, self.name)
 
+    def get_cache_key(self) -> typing.Optional[str]:
+        """
+        Get the key of the file in a worker's source cache.  Has to match `utils.source_cache.SourceCache.get_key`.
+
+        :return: cache key, None if the file can't be cached (its size is unknown)
+        """
+        if self.size in [None, -1]:
+            return None
+        if self.fingerprint:
+            return "{}-{}".format(self.fingerprint, self.size)
+        return "file{}-{}".format(self.pk, self.size)
+
     def get_file_url(self, is_secure: bool = False) -> str:
         """
         Get the URL for the actual file of a file ID
@@ -53,6 +88,28 @@ class File(models.Model):
         else:
             return "http://{}{}".format(request_host, reverse("distributor:api-file", args=(self.pk,)))
 
+    def get_keyframe_index(self, rebuild: bool = False) -> keyframes.KeyframeIndex:
+        """
+        Get the keyframe index of the file, probing the file and saving the result if it hasn't been built yet.
+
+        :param rebuild: if set, re-probe the file even if an index is already stored (e.g. the file was replaced)
+        :return: keyframe index of the file's video stream
+        """
+        cached_index: typing.Optional[keyframes.KeyframeIndex] = getattr(self, "_keyframe_index_cache", None)
+        if cached_index is not None and not rebuild:
+            return cached_index
+
+        if self.keyframe_index and not rebuild:
+            index = keyframes.KeyframeIndex.from_bytes(bytes(self.keyframe_index))
+        else:
+            file_info = ffprobe.get_file_info(self.get_full_path())
+            index = keyframes.KeyframeIndex(ffprobe.get_keyframe_timestamps(file_info))
+            self.keyframe_index = index.to_bytes()
+            self.save(update_fields=["keyframe_index"])
+
+        self._keyframe_index_cache = index
+        return index
+
     def get_size_formatted(self) -> str:
         return _format_bytes(self.size)
 
@@ -74,3 +131,41 @@ class File(models.Model):
         else:
             delta_split = [x.zfill(2) for x in delta.split(":")]
             return "{:2}:{:2}:{:2}".format(delta_split[0], delta_split[1], delta_split[2])
+
+
+class Worker(models.Model):
+    class Tier(models.TextChoices):
+        SMALL = "small"
+        LARGE = "large"
+
+    hostname = models.CharField(max_length=128, unique=True)
+    tier = models.CharField(max_length=16, choices=Tier.choices, default=Tier.SMALL)
+
+    # Capabilities, as advertised by the worker when it starts
+    cores = models.IntegerField(default=1)
+    avx512 = models.BooleanField(default=False)
+    free_space = models.BigIntegerField(default=0)
+    # {"libx264": {"medium": 123.4, ...}, "libx265": {...}} - fps of a short 1080p synthetic encode per preset
+    benchmarks = models.JSONField(default=dict, blank=True)
+    # Hit rate & contents of the worker's source cache, as last reported by the worker (see `utils.source_cache`)
+    cache_statistics = models.JSONField(default=dict, blank=True)
+    # Keys of the files in the worker's source cache, as of its latest heartbeat (see `File.get_cache_key`)
+    cache_inventory = models.JSONField(default=list, blank=True)
+
+    registration_datetime = models.DateTimeField(auto_now_add=True)
+    last_seen_datetime = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "{} ({}) [{}]".format(self.hostname, self.tier, self.pk)
+
+    def get_benchmark_fps(self, codec: str, preset: str) -> typing.Optional[float]:
+        """
+        Get the fps the worker measured for a codec & preset when it started.
+
+        :param codec: codec (h264/h265 or libx264/libx265)
+        :param preset: encoder preset
+        :return: fps of the 1080p benchmark encode, or None if that combination wasn't measured
+        """
+        codec = {"h264": "libx264", "h265": "libx265"}.get(codec, codec)
+        fps = self.benchmarks.get(codec, {}).get(preset, None)
+        return float(fps) if fps else None
@@ -0,0 +1,382 @@
+import collections
+import concurrent.futures
+import datetime
+import decimal
+import pathlib
+import threading
+import typing
+
+import django
+from django.db import connections, transaction
+from django.utils import timezone
+
+import distributor.duplicates
+import distributor.models
+
+from utils import config
+from utils import ffprobe
+from utils import fingerprint
+from utils import log
+from utils import mkvtoolnix
+
+
+# Fields of `File` that come from probing, and are updated if a file has changed since it was last scanned
+PROBED_FIELDS = ["size", "duration", "frame_rate", "frames", "width", "height", "fingerprint", "modified_time"]
+
+
+########################################################################################################################
+# Probing (runs in the process pool, so nothing in here can touch the database)
+########################################################################################################################
+def probe_file(file_path: str) -> typing.Optional[dict]:
+    """
+    Probe and fingerprint a file for its `File` fields, adding mkvtoolnix statistics first if needed.
+
+    :param file_path: file to probe
+    :return: field values, None if the file is still being written, or {"error": message} if probing failed
+    """
+    path = pathlib.Path(file_path)
+    try:
+        mkvtoolnix.add_media_statistics_if_necessary(path)
+        file_information = ffprobe.get_file_info(path)
+        file_fingerprint = fingerprint.get_fingerprint(path)
+    except (RuntimeError, ValueError, OSError) as e:
+        return {"error": str(e)}
+
+    size = int(file_information.format.get("size", 0))
+    seconds = round(float(file_information.format.get("duration", 0)))
+
+    # If file is being written to this location, ignore it
+    if seconds == 0 or size == 0:
+        return None
+
+    # After adding statistics, which rewrites the file
+    try:
+        modified_time = path.stat().st_mtime_ns
+    except OSError as e:
+        return {"error": str(e)}
+
+    return {
+        "size": size,
+        "duration": round(file_information.duration, 3),
+        "frame_rate": round(eval(file_information.video_stream["avg_frame_rate"]), 3),
+        "frames": file_information.frames,
+        "width": file_information.width,
+        "height": file_information.height,
+        "fingerprint": file_fingerprint,
+        "modified_time": modified_time
+    }
+
+
+########################################################################################################################
+# Progress
+########################################################################################################################
+class ScanProgress:
+    def __init__(self, total: int):
+        self.total: int = total
+        self.probed: int = 0
+        self.created: int = 0
+        self.updated: int = 0
+        self.renamed: int = 0
+        self.unchanged: int = 0
+        self.skipped: int = 0
+        self.errors: int = 0
+        self.devices: typing.Dict[str, typing.Dict[str, int]] = {}
+        self.start_datetime: datetime.datetime = timezone.now()
+        self.end_datetime: typing.Optional[datetime.datetime] = None
+
+    def to_dict(self) -> dict:
+        end_datetime = self.end_datetime or timezone.now()
+        elapsed_seconds = (end_datetime - self.start_datetime).total_seconds()
+        return {
+            "running": self.end_datetime is None,
+            "total": self.total,
+            "probed": self.probed,
+            "created": self.created,
+            "updated": self.updated,
+            "renamed": self.renamed,
+            "unchanged": self.unchanged,
+            "skipped": self.skipped,
+            "errors": self.errors,
+            "percent": round(self.probed / self.total * 100, 2) if self.total else 100.0,
+            "files_per_second": round(self.probed / elapsed_seconds, 2) if elapsed_seconds > 0 else 0.0,
+            "devices": self.devices,
+            "start_datetime": self.start_datetime.isoformat(),
+            "end_datetime": self.end_datetime.isoformat() if self.end_datetime else None
+        }
+
+
+# Progress of the most recently started scan
+_current_progress: typing.Optional[ScanProgress] = None
+_progress_lock = threading.Lock()
+
+
+def get_progress() -> typing.Optional[dict]:
+    """
+    :return: progress of the most recently started scan, or None if nothing has been scanned since startup
+    """
+    with _progress_lock:
+        return _current_progress.to_dict() if _current_progress else None
+
+
+def is_scanning() -> bool:
+    with _progress_lock:
+        return _current_progress is not None and _current_progress.end_datetime is None
+
+
+########################################################################################################################
+# Scanning
+########################################################################################################################
+def _get_device(file_path: pathlib.Path) -> int:
+    try:
+        return file_path.stat().st_dev
+    except OSError:
+        return -1
+
+
+def save_probe_results(results: typing.List[typing.Tuple[pathlib.Path, dict]],
+                       progress: ScanProgress = None) -> typing.List[distributor.models.File]:
+    """
+    Write a batch of probe results to the database: one query to find existing rows, one bulk insert for new files,
+    one bulk update for files that changed, and one query to get everything back with primary keys.
+
+    A file without a row at its path, but with the same fingerprint as a row whose file is gone, was renamed or moved:
+    that row is moved to the new path instead of a new one being created, so its tasks stay with it.
+
+    :param results: (file path, fields from `probe_file`) of each file
+    :param progress: progress to update, if any
+    :return: File objects of every file in the batch
+    """
+    if not results:
+        return []
+    progress = progress or ScanProgress(len(results))
+
+    directories = set(str(x.parent) for x, _ in results)
+    names = set(x.name for x, _ in results)
+    existing_files = {
+        (x.directory, x.name): x
+        for x in distributor.models.File.objects.filter(directory__in=directories, name__in=names)
+    }
+    renamed_files = distributor.duplicates.find_renamed_files(
+        x["fingerprint"] for y, x in results if (str(y.parent), y.name) not in existing_files
+    )
+
+    files_to_create = []
+    files_to_update = []
+    for file_path, fields in results:
+        file_object = existing_files.get((str(file_path.parent), file_path.name))
+        renamed = False
+        if file_object is None and fields["fingerprint"] in renamed_files:
+            file_object = renamed_files.pop(fields["fingerprint"])
+            log.info("[{}] was renamed to [{}]".format(file_object.get_full_path(), file_path))
+            file_object.name = file_path.name
+            file_object.directory = str(file_path.parent)
+            renamed = True
+            progress.renamed += 1
+        elif file_object is None:
+            files_to_create.append(
+                distributor.models.File(name=file_path.name, directory=str(file_path.parent), **fields)
+            )
+            continue
+
+        current_values = [getattr(file_object, x) for x in PROBED_FIELDS]
+        current_values = [float(x) if isinstance(x, decimal.Decimal) else x for x in current_values]
+        if renamed or current_values != [fields[x] for x in PROBED_FIELDS]:
+            # A full hash is of the old contents
+            if file_object.fingerprint != fields["fingerprint"]:
+                file_object.hash = ""
+            # So are the keyframes, the index is rebuilt the next time it's asked for
+            if any(getattr(file_object, x) != fields[x] for x in ["fingerprint", "size"]) or \
+                    float(file_object.duration or 0) != float(fields["duration"] or 0):
+                file_object.keyframe_index = None
+                file_object.__dict__.pop("_keyframe_index_cache", None)
+            for key, value in fields.items():
+                setattr(file_object, key, value)
+            files_to_update.append(file_object)
+        else:
+            progress.unchanged += 1
+
+    with transaction.atomic():
+        if files_to_create:
+            distributor.models.File.objects.bulk_create(files_to_create)
+        if files_to_update:
+            distributor.models.File.objects.bulk_update(
+                files_to_update, PROBED_FIELDS + ["name", "directory", "hash", "keyframe_index"]
+            )
+
+    progress.created += len(files_to_create)
+    progress.updated += len(files_to_update)
+
+    paths = set((str(x.parent), x.name) for x, _ in results)
+    return [
+        x for x in distributor.models.File.objects.filter(directory__in=directories, name__in=names)
+        if (x.directory, x.name) in paths
+    ]
+
+
+def find_unchanged_files(files: typing.List[pathlib.Path]) -> typing.Dict[pathlib.Path, distributor.models.File]:
+    """
+    Find the files whose row is current: the file on disk has the size and modification time it had when it was last
+    probed, so probing it again would give the same result.
+
+    :param files: files to check
+    :return: File objects of the unchanged files, by path
+    """
+    file_stats = {}
+    for file_path in files:
+        try:
+            file_stat = file_path.stat()
+        except OSError:
+            continue
+        file_stats[(str(file_path.parent), file_path.name)] = (file_stat.st_size, file_stat.st_mtime_ns, file_path)
+
+    unchanged_files = {}
+    keys = list(file_stats.keys())
+    batch_size = config.load_scanner_config()["batch_size"]
+    for i in range(0, len(keys), batch_size):
+        batch = keys[i:i + batch_size]
+        file_objects = distributor.models.File.objects.filter(
+            directory__in=set(x[0] for x in batch), name__in=set(x[1] for x in batch), modified_time__isnull=False
+        )
+        for file_object in file_objects:
+            file_stat = file_stats.get((file_object.directory, file_object.name))
+            if file_stat and (file_object.size, file_object.modified_time) == file_stat[:2]:
+                unchanged_files[file_stat[2]] = file_object
+    return unchanged_files
+
+
+def scan_files(files: typing.List[pathlib.Path],
+               progress: ScanProgress = None) -> typing.List[distributor.models.File]:
+    """
+    Probe files and create/update their `File` entries.
+
+    Files that haven't changed since they were last probed (see `find_unchanged_files`) aren't probed again.  The rest
+    are probed in a process pool, with at most `files_per_device` files in flight on each storage device so a slow disk
+    doesn't get buried in random reads (and a fast one isn't held back by a slow one).  Results are written to the
+    database in batches of `batch_size`.  Progress can be followed with `get_progress`.
+
+    :param files: files to scan
+    :param progress: progress to fill in (already the current one, see `start_scan`), a new one if not given
+    :return: File objects of every file that could be probed, sorted by name
+    """
+    global _current_progress
+
+    scanner_config = config.load_scanner_config()
+    unchanged_files = find_unchanged_files(files)
+    files = [x for x in files if x not in unchanged_files]
+
+    if progress is None:
+        progress = ScanProgress(len(files))
+        with _progress_lock:
+            _current_progress = progress
+    progress.total = len(files)
+    progress.unchanged = len(unchanged_files)
+
+    files_by_device: typing.Dict[int, typing.Deque[pathlib.Path]] = collections.defaultdict(collections.deque)
+    for file_path in files:
+        files_by_device[_get_device(file_path)].append(file_path)
+    for device, device_files in files_by_device.items():
+        progress.devices[str(device)] = {"total": len(device_files), "probed": 0}
+
+    process_count = min(scanner_config["processes"], len(files_by_device) * scanner_config["files_per_device"])
+    log.debug("Scanning [{}] files on [{}] devices with [{}] processes".format(
+        len(files), len(files_by_device), process_count
+    ))
+
+    file_objects = list(unchanged_files.values())
+    pending_results = []
+    in_flight: typing.Dict[concurrent.futures.Future, typing.Tuple[int, pathlib.Path]] = {}
+
+    # Forked processes mustn't share the parent's database connections
+    connections.close_all()
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max(process_count, 1),
+                                                    initializer=django.setup) as executor:
+            def submit_next(device: int) -> None:
+                if files_by_device[device]:
+                    file_path = files_by_device[device].popleft()
+                    in_flight[executor.submit(probe_file, str(file_path))] = (device, file_path)
+
+            for device in files_by_device.keys():
+                for _ in range(scanner_config["files_per_device"]):
+                    submit_next(device)
+
+            while in_flight:
+                done, _ = concurrent.futures.wait(in_flight.keys(), return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    device, file_path = in_flight.pop(future)
+                    submit_next(device)
+
+                    progress.probed += 1
+                    progress.devices[str(device)]["probed"] += 1
+                    try:
+                        fields = future.result()
+                    except Exception as e:
+                        fields = {"error": str(e)}
+
+                    if fields is None:
+                        progress.skipped += 1
+                    elif "error" in fields:
+                        progress.errors += 1
+                        log.warning("Could not scan [{}]: {}".format(file_path, fields["error"]))
+                    else:
+                        pending_results.append((file_path, fields))
+
+                if len(pending_results) >= scanner_config["batch_size"]:
+                    file_objects.extend(save_probe_results(pending_results, progress))
+                    pending_results = []
+
+        file_objects.extend(save_probe_results(pending_results, progress))
+    finally:
+        progress.end_datetime = timezone.now()
+
+    log.debug("Scan finished: {}".format(progress.to_dict()))
+    if scanner_config["full_hash"]:
+        distributor.duplicates.queue_hashes(x.pk for x in file_objects if not x.hash)
+    return sorted(file_objects, key=lambda k: k.name)
+
+
+def scan_directories(directories: typing.List[pathlib.Path],
+                     progress: ScanProgress = None) -> typing.List[distributor.models.File]:
+    """
+    Scan every mkv file under some directories, see `scan_files`.
+
+    :param directories: directories to scan (recursively)
+    :param progress: progress to fill in, see `scan_files`
+    :return: File objects of every file that could be probed, sorted by name
+    """
+    files = []
+    for directory in directories:
+        files.extend([x for x in directory.rglob("*.mkv") if x.is_file()])
+    return scan_files(files, progress=progress)
+
+
+def start_scan(directories: typing.List[pathlib.Path]) -> bool:
+    """
+    Scan directories in a background thread, see `scan_files`.
+
+    :param directories: directories to scan (recursively)
+    :return: True if the scan was started, False if a scan is already running
+    """
+    global _current_progress
+
+    # Claimed before the thread starts (listing and checking the files can take a while), so two requests close
+    # together can't both start a scan
+    progress = ScanProgress(0)
+    with _progress_lock:
+        if _current_progress is not None and _current_progress.end_datetime is None:
+            return False
+        _current_progress = progress
+
+    def run_scan():
+        try:
+            scan_directories(directories, progress=progress)
+        except Exception as e:
+            log.error("Background scan failed: {}".format(e))
+        finally:
+            if progress.end_datetime is None:
+                progress.end_datetime = timezone.now()
+            connections.close_all()
+
+    threading.Thread(target=run_scan, name="library-scan", daemon=True).start()
+    return True
@@ -0,0 +1,398 @@
+import datetime
+import math
+import typing
+
+from django.apps import apps
+from django.utils import timezone
+
+import distributor.models
+
+from utils import config
+from utils import log
+from utils import rabbit_handler
+
+
+########################################################################################################################
+# Cost Estimation
+########################################################################################################################
+# Rough encode time of each preset relative to `medium`.  These don't need to be exact, they only have to put tasks in
+# the right order.  Taken from x264/x265 benchmarks at 1080p, which both scale about the same between presets.
+PRESET_FACTORS = {
+    "ultrafast": 0.1,
+    "superfast": 0.15,
+    "veryfast": 0.25,
+    "faster": 0.45,
+    "fast": 0.65,
+    "medium": 1.0,
+    "slow": 1.6,
+    "slower": 3.0,
+    "veryslow": 6.0,
+    "placebo": 20.0
+}
+
+# x265 is roughly four times slower than x264 at the same preset.
+CODEC_FACTORS = {
+    "h264": 1.0,
+    "libx264": 1.0,
+    "h265": 4.0,
+    "libx265": 4.0
+}
+
+# VMAF (with PSNR and MS-SSIM) runs a little faster than a medium x264 encode of the same file.
+METRICS_FACTOR = 0.8
+
+# A 45-minute 1080p episode at 23.976 fps encoded with x264 medium.  Tasks around this cost land in the middle of the
+# priority range, and every doubling/halving of cost moves a task one priority level.
+REFERENCE_COST = 45 * 60 * 23.976 * 1920 * 1080
+
+
+def _get_pixel_count(file: distributor.models.File) -> int:
+    if file.width and file.height:
+        return file.width * file.height
+    # Files scanned before width/height were tracked, assume 1080p.
+    return 1920 * 1080
+
+
+def estimate_encode_cost(source_file: distributor.models.File, codec: str, preset: str) -> float:
+    """
+    Estimate the relative cost of encoding a file: frames * pixels * preset factor * codec factor.
+
+    :param source_file: file to encode
+    :param codec: codec of the encode (h264/h265, or libx264/libx265)
+    :param preset: encoder preset
+    :return: unitless cost, only meaningful compared to other costs
+    """
+    preset_factor = PRESET_FACTORS.get(preset, 1.0)
+    codec_factor = CODEC_FACTORS.get(codec, 1.0)
+    return (source_file.frames or 0) * _get_pixel_count(source_file) * preset_factor * codec_factor
+
+
+def estimate_metrics_cost(source_file: distributor.models.File, subsample_rate: int = 1) -> float:
+    """
+    Estimate the relative cost of calculating metrics for a file.  Both files are decoded in full regardless of the
+    subsample rate, so only the metric calculations themselves get cheaper with subsampling.
+
+    :param source_file: reference file
+    :param subsample_rate: calculate metrics every X frames
+    :return: unitless cost, only meaningful compared to other costs
+    """
+    decode_cost = (source_file.frames or 0) * _get_pixel_count(source_file) * METRICS_FACTOR / 2
+    return decode_cost + decode_cost / max(subsample_rate, 1)
+
+
+########################################################################################################################
+# Routing
+########################################################################################################################
+# Pixel count of the synthetic encode workers benchmark with when registering.
+BENCHMARK_PIXELS = 1920 * 1080
+
+# Encode speed to assume for a small worker when there's no history or benchmark to go off: x264 medium at 1080p.
+DEFAULT_SMALL_WORKER_FPS = 40.0
+
+# Workers that haven't been seen in this long are assumed to be gone, and don't count towards a tier being available.
+WORKER_TIMEOUT = datetime.timedelta(days=1)
+
+# Workers that haven't sent a heartbeat in this long might not be running anymore, so tasks aren't sent to their own
+# queue even if they have the source file cached.
+HEARTBEAT_TIMEOUT = datetime.timedelta(minutes=5)
+
+
+def get_worker_tier(cores: int) -> str:
+    """
+    Get the tier a worker belongs in based on its capabilities.
+
+    :param cores: number of cores the worker has
+    :return: tier of the worker
+    """
+    if cores >= config.load_routing_config()["large_worker_cores"]:
+        return distributor.models.Worker.Tier.LARGE
+    return distributor.models.Worker.Tier.SMALL
+
+
+def get_tier_queue(task_type: str, tier: str) -> str:
+    """
+    Get the queue for a task type and worker tier.  Small tier queues are the plain task type queues, so workers that
+    never registered with the manager still get work.
+
+    :param task_type: "encode" or "metrics"
+    :param tier: worker tier
+    :return: name of the queue
+    """
+    rabbitmq_config = config.load_rabbitmq_config()
+    if task_type not in ["encode", "metrics"]:
+        raise ValueError("Task type [{}] not supported".format(task_type))
+
+    queue = rabbitmq_config["{}_queue".format(task_type)]
+    if tier == distributor.models.Worker.Tier.LARGE:
+        queue = "{}-large".format(queue)
+    return queue
+
+
+def _get_consumed_tiers(tier: str) -> typing.List[str]:
+    # Large workers also take small tasks so they're never idle while small workers have a backlog.
+    if tier == distributor.models.Worker.Tier.LARGE:
+        return [distributor.models.Worker.Tier.LARGE, distributor.models.Worker.Tier.SMALL]
+    return [distributor.models.Worker.Tier.SMALL]
+
+
+def get_worker_queues(tier: str) -> typing.Dict[str, typing.List[str]]:
+    """
+    Get the queues a worker of a tier should consume.
+
+    :param tier: worker tier
+    :return: queues to consume for each task type, in order of preference
+    """
+    return {x: [get_tier_queue(x, y) for y in _get_consumed_tiers(tier)] for x in ["encode", "metrics"]}
+
+
+def get_affinity_queue(task_type: str, tier: str, hostname: str) -> str:
+    """
+    Get a worker's own queue for tasks of a type and tier, see `schedule_task`.  Tasks that wait in it too long expire
+    into the tier queue, see `get_worker_affinity_queues`.
+
+    The TTL is part of the name, since RabbitMQ refuses to redeclare a queue with different arguments.  Changing
+    `affinity_seconds` moves tasks to new queues instead of breaking every declaration of the old ones, which are left
+    to expire (see `rabbit_handler.DEAD_LETTER_QUEUE_EXPIRY_MS`).  A worker consumes the new ones once it registers
+    again, until then its tasks expire into the tier queue.
+
+    :param task_type: "encode" or "metrics"
+    :param tier: tier of the task
+    :param hostname: worker the queue belongs to
+    :return: name of the queue
+    """
+    affinity_ms = int(config.load_routing_config()["affinity_seconds"] * 1000)
+    return "{}.{}.ttl{}".format(get_tier_queue(task_type, tier), hostname, affinity_ms)
+
+
+def get_worker_affinity_queues(tier: str, hostname: str) -> typing.Dict[str, typing.Dict[str, str]]:
+    """
+    Get a worker's own queues, along with the queue each one's expired tasks are moved to (which has to be part of the
+    queue's declaration).
+
+    :param tier: worker tier
+    :param hostname: worker hostname
+    :return: {task type: {affinity queue: tier queue}}, empty if cache affinity is turned off
+    """
+    if not config.load_routing_config()["affinity_seconds"]:
+        return {}
+    return {
+        x: {get_affinity_queue(x, y, hostname): get_tier_queue(x, y) for y in _get_consumed_tiers(tier)}
+        for x in ["encode", "metrics"]
+    }
+
+
+def _get_active_workers() -> typing.List[distributor.models.Worker]:
+    return list(distributor.models.Worker.objects.filter(last_seen_datetime__gte=timezone.now() - WORKER_TIMEOUT))
+
+
+def estimate_small_worker_fps(source_file: distributor.models.File, codec: str, preset: str,
+                              profile_id: int = None) -> typing.Optional[float]:
+    """
+    Estimate how fast a small worker would encode a file.
+
+    Completed encodes of the same profile on small workers are used first, since they're real files with the real
+    settings.  Their fps is normalized by pixel count so a 720p history can predict a 2160p encode.  If there is no
+    history, the benchmarks the small workers measured at startup are used instead.
+
+    :param source_file: file to encode
+    :param codec: codec of the encode
+    :param preset: encoder preset
+    :param profile_id: profile of the encode, if any
+    :return: estimated fps, or None if there's nothing to base an estimate on
+    """
+    pixels = _get_pixel_count(source_file)
+    small_workers = [x for x in _get_active_workers() if x.tier == distributor.models.Worker.Tier.SMALL]
+
+    if profile_id is not None and small_workers:
+        encode_task_model = apps.get_model("encodes", "EncodeTask")
+        history = encode_task_model.objects.filter(
+            profile_id=profile_id,
+            status=encode_task_model.TaskStatus.COMPLETE,
+            worker__in=[x.hostname for x in small_workers],
+            encode_framerate__gt=0
+        ).order_by("-encode_end_datetime").values_list(
+            "encode_framerate", "source_file__width", "source_file__height"
+        )[:50]
+
+        pixel_rates = [float(fps) * ((width or 1920) * (height or 1080)) for fps, width, height in history]
+        if pixel_rates:
+            return sum(pixel_rates) / len(pixel_rates) / pixels
+
+    benchmark_fps = [x.get_benchmark_fps(codec, preset) for x in small_workers]
+    benchmark_fps = [x for x in benchmark_fps if x]
+    if benchmark_fps:
+        return sum(benchmark_fps) / len(benchmark_fps) * BENCHMARK_PIXELS / pixels
+
+    return None
+
+
+def _has_room(worker: distributor.models.Worker, source_file: distributor.models.File) -> bool:
+    # The source and the encode of it (nearly always smaller) have to fit in the working directory.  Workers that
+    # didn't report their free space are assumed to have room.
+    return not worker.free_space or worker.free_space >= (source_file.size or 0) * 2
+
+
+def route_task(task_type: str, source_file: distributor.models.File, cost: float,
+               codec: str = None, preset: str = None, profile_id: int = None) -> str:
+    """
+    Pick the worker tier for a task.  Tasks that would take a small worker longer than `large_task_hours` go to the
+    large tier, if there are any large workers.  Only workers with room for the source file count, so a file too big
+    for every small worker goes to the large tier however quick it is.
+
+    :param task_type: "encode" or "metrics"
+    :param source_file: file the task processes
+    :param cost: estimated cost of the task
+    :param codec: codec of the encode (encode tasks only)
+    :param preset: encoder preset (encode tasks only)
+    :param profile_id: profile of the encode (encode tasks only)
+    :return: tier to send the task to
+    """
+    active_tiers = set(x.tier for x in _get_active_workers() if _has_room(x, source_file))
+    if distributor.models.Worker.Tier.LARGE not in active_tiers:
+        return distributor.models.Worker.Tier.SMALL
+    if distributor.models.Worker.Tier.SMALL not in active_tiers:
+        return distributor.models.Worker.Tier.LARGE
+
+    fps = None
+    if task_type == "encode" and codec and preset:
+        fps = estimate_small_worker_fps(source_file, codec, preset, profile_id=profile_id)
+
+    if fps:
+        estimated_seconds = (source_file.frames or 0) / fps
+    else:
+        estimated_seconds = cost / (DEFAULT_SMALL_WORKER_FPS * BENCHMARK_PIXELS)
+
+    if estimated_seconds / 3600 > config.load_routing_config()["large_task_hours"]:
+        return distributor.models.Worker.Tier.LARGE
+    return distributor.models.Worker.Tier.SMALL
+
+
+def requeue_stranded_tasks() -> int:
+    """
+    Move the tasks waiting in the large tier queues to the small tier queues once no large worker has been seen for
+    `WORKER_TIMEOUT`.  Small workers never consume the large tier queues, so tasks routed there while a large worker
+    was around would otherwise wait forever once it's gone.
+
+    :return: number of tasks moved
+    """
+    large_workers = distributor.models.Worker.objects.filter(tier=distributor.models.Worker.Tier.LARGE)
+    if not large_workers.exists() or large_workers.filter(
+        last_seen_datetime__gte=timezone.now() - WORKER_TIMEOUT
+    ).exists():
+        return 0
+
+    moved = 0
+    for task_type in ["encode", "metrics"]:
+        moved += rabbit_handler.move_messages(
+            get_tier_queue(task_type, distributor.models.Worker.Tier.LARGE),
+            get_tier_queue(task_type, distributor.models.Worker.Tier.SMALL)
+        )
+    if moved:
+        log.info("Moved [{}] tasks from the large tier to the small tier, no large worker is running".format(moved))
+    return moved
+
+
+def find_cached_worker(source_file: distributor.models.File,
+                       tier: str = distributor.models.Worker.Tier.SMALL) -> typing.Optional[distributor.models.Worker]:
+    """
+    Find a running worker that has a file in its source cache and takes tasks of a tier, so a task on that file can
+    skip the download (e.g. metrics after an encode, or the encode of another profile).
+
+    :param source_file: file the task processes
+    :param tier: tier the task was routed to
+    :return: worker with the file cached that was seen most recently, None if there isn't one
+    """
+    cache_key = source_file.get_cache_key()
+    if not cache_key:
+        return None
+
+    workers = distributor.models.Worker.objects.filter(
+        last_seen_datetime__gte=timezone.now() - HEARTBEAT_TIMEOUT
+    ).order_by("-last_seen_datetime")
+    # Inventories are small and there are only ever a handful of workers, and SQLite can't search inside JSON lists
+    for worker in workers:
+        if tier in _get_consumed_tiers(worker.tier) and cache_key in worker.cache_inventory:
+            return worker
+    return None
+
+
+########################################################################################################################
+# Priority
+########################################################################################################################
+def get_priority(cost: float, profile_priority: int = 0, queued_in_group: int = 0) -> int:
+    """
+    Get the queue priority of a task based on the configured scheduler policy.
+
+    * fifo: only the profile priority
+    * sjf: one priority level per doubling/halving of cost compared to REFERENCE_COST, cheapest first
+    * fair-share: the first task of each group (e.g. profile) gets the highest priority, each task after that is one
+      level lower, so tasks from different groups are interleaved instead of processed batch by batch.  Once a group
+      has used every level, the rest of its tasks stay at the lowest priority, so a group's tasks are never reordered
+      among themselves.
+
+    :param cost: estimated cost of the task
+    :param profile_priority: priority of the task's profile, added to the result
+    :param queued_in_group: number of tasks of the same group already waiting in the queue, not counting this one
+                            (for fair-share)
+    :return: priority to send the task with (0 to max_priority)
+    """
+    policy = config.load_scheduler_config()["policy"]
+    max_priority = config.load_rabbitmq_config()["max_priority"]
+    middle_priority = max_priority // 2
+
+    if policy == "sjf":
+        if cost > 0:
+            priority = middle_priority + round(math.log2(REFERENCE_COST / cost))
+        else:
+            priority = middle_priority
+    elif policy == "fair-share":
+        priority = max_priority - queued_in_group
+    else:
+        priority = middle_priority
+
+    return max(0, min(priority + profile_priority, max_priority))
+
+
+########################################################################################################################
+# Scheduling
+########################################################################################################################
+def schedule_task(task_type: str, message: dict, cost: float,
+                  profile_priority: int = 0, queued_in_group: int = 0,
+                  tier: str = distributor.models.Worker.Tier.SMALL,
+                  source_file: distributor.models.File = None) -> int:
+    """
+    Send a task to the queue for its type and worker tier, with a priority based on the scheduler policy.
+
+    If a worker already has the task's source file cached, the task goes to that worker's own queue instead.  If the
+    worker doesn't get to it within `affinity_seconds`, it expires into the tier queue for any worker to take.
+
+    :param task_type: "encode" or "metrics"
+    :param message: message to send to the workers
+    :param cost: estimated cost of the task
+    :param profile_priority: priority of the task's profile
+    :param queued_in_group: number of tasks of the same group already waiting in the queue
+    :param tier: worker tier to send the task to, see `route_task`
+    :param source_file: file the task processes, to send the task to a worker that has it cached
+    :return: priority the task was queued with
+    """
+    queue = get_tier_queue(task_type, tier)
+    priority = get_priority(cost, profile_priority=profile_priority, queued_in_group=queued_in_group)
+
+    affinity_seconds = config.load_routing_config()["affinity_seconds"]
+    cached_worker = find_cached_worker(source_file, tier) if source_file and affinity_seconds else None
+    if cached_worker:
+        affinity_queue = get_affinity_queue(task_type, tier, cached_worker.hostname)
+        log.debug("Sending [{}] task [{}] to [{}] with priority [{}] (cost [{:.3g}]), it has the source cached".format(
+            task_type, message.get("id"), affinity_queue, priority, cost
+        ))
+        rabbit_handler.send_message(
+            message, queue=affinity_queue, priority=priority,
+            dead_letter_queue=queue, message_ttl_seconds=affinity_seconds
+        )
+        return priority
+
+    log.debug("Sending [{}] task [{}] to [{}] with priority [{}] (cost [{:.3g}])".format(
+        task_type, message.get("id"), queue, priority, cost
+    ))
+    rabbit_handler.send_message(message, queue=queue, priority=priority)
+    return priority
@@ -1,8 +1,26 @@
+import typing
+
 from rest_framework import serializers
 
+import distributor.api
 import distributor.models
 
 
+# Fields of files in list endpoints, see `distributor.api.list_response`
+FILE_LIST_FIELDS: typing.Dict[str, distributor.api.Field] = {
+    "id": "id",
+    "name": "name",
+    "size": "size",
+    "duration": "duration",
+    "frame_rate": "frame_rate",
+    "frames": "frames",
+    "width": "width",
+    "height": "height",
+    "fingerprint": "fingerprint",
+    "file_url_field": ("id", lambda x: distributor.models.File(pk=x).get_file_url())
+}
+
+
 class FileSerializer(serializers.ModelSerializer):
     file_url_field = serializers.ReadOnlyField(source="get_file_url")
     file_detail_url_field = serializers.ReadOnlyField(source="get_file_detail_url")
@@ -16,6 +34,9 @@ class FileSerializer(serializers.ModelSerializer):
             "duration",
             "frame_rate",
             "frames",
+            "width",
+            "height",
+            "fingerprint",
             "file_url_field",
             "file_detail_url_field"
         ]
@@ -1,3 +1,477 @@
+import json
+import os
+import pathlib
+import struct
+import tempfile
+import threading
+from unittest import mock
+
+import pika
+from django.conf import settings
+from django.test import SimpleTestCase
 from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+import distributor.models
+import distributor.scanner
+import distributor.scheduler
+
+from utils import config
+from utils import keyframes
+from utils import matroska
+from utils import rabbit_handler
+from utils import source_cache
+
+
+class FileListApiTests(TestCase):
+    """
+    List endpoints are paged by ID, can select their fields, and answer a repeated request with a 304.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        settings.ALLOWED_HOSTS.append("testserver")
+
+    @classmethod
+    def tearDownClass(cls):
+        settings.ALLOWED_HOSTS.remove("testserver")
+        super().tearDownClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(5):
+            distributor.models.File.objects.create(
+                name="source_{}.mkv".format(i), directory="/input", size=1000000, duration=60, frame_rate=23.976,
+                frames=1439, width=1920, height=1080
+            )
+
+    def test_pages(self):
+        ids = []
+        url = "{}?limit=2&fields=id,name".format(reverse("distributor:api-file-list"))
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            for item in response.json()["results"]:
+                self.assertEqual(set(item), {"id", "name"})
+                ids.append(item["id"])
+            url = response.json()["next"]
+        self.assertEqual(ids, list(distributor.models.File.objects.order_by("pk").values_list("pk", flat=True)))
+
+    def test_not_modified(self):
+        response = self.client.get(reverse("distributor:api-file-list"))
+        repeated_response = self.client.get(reverse("distributor:api-file-list"), HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(repeated_response.status_code, 304)
+
+        distributor.models.File.objects.filter(name="source_0.mkv").update(frames=1440)
+        changed_response = self.client.get(reverse("distributor:api-file-list"), HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(changed_response.status_code, 200)
+
+    def test_invalid_parameters(self):
+        for parameters in ["fields=id,unknown", "limit=0", "after=last"]:
+            with self.subTest(parameters=parameters):
+                response = self.client.get("{}?{}".format(reverse("distributor:api-file-list"), parameters))
+                self.assertEqual(response.status_code, 400)
+
+
+class CacheAffinityTests(TestCase):
+    """
+    Workers report their source cache with heartbeats, and tasks on a cached file go to that worker's own queue first.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        settings.ALLOWED_HOSTS.append("testserver")
+
+    @classmethod
+    def tearDownClass(cls):
+        settings.ALLOWED_HOSTS.remove("testserver")
+        super().tearDownClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.source_file = distributor.models.File.objects.create(
+            name="source.mkv", directory="/input", size=1000000, duration=60, frame_rate=23.976, frames=1439,
+            width=1920, height=1080, fingerprint="abc123"
+        )
+        distributor.models.Worker.objects.create(hostname="worker_1")
+
+    def _send_heartbeat(self, inventory: list):
+        return self.client.post(
+            reverse("distributor:api-worker-cache"), json.dumps({"hits": 1, "misses": 1, "inventory": inventory}),
+            content_type="application/json", HTTP_WORKER="worker_1"
+        )
+
+    def test_heartbeat(self):
+        response = self._send_heartbeat([self.source_file.get_cache_key()])
+        self.assertEqual(response.status_code, 200)
+
+        worker = distributor.models.Worker.objects.get(hostname="worker_1")
+        self.assertEqual(worker.cache_inventory, ["abc123-1000000"])
+        self.assertEqual(worker.cache_statistics, {"hits": 1, "misses": 1})
+
+    def test_schedule_to_cached_worker(self):
+        self._send_heartbeat([self.source_file.get_cache_key()])
+        with mock.patch("utils.rabbit_handler.send_message") as send_message:
+            distributor.scheduler.schedule_task("metrics", {"id": 1}, 1.0, source_file=self.source_file)
+
+        queue = distributor.scheduler.get_tier_queue("metrics", distributor.models.Worker.Tier.SMALL)
+        self.assertEqual(send_message.call_args.kwargs["queue"], "{}.worker_1.ttl120000".format(queue))
+        # Falls back to the tier queue if the worker doesn't get to it
+        self.assertEqual(send_message.call_args.kwargs["dead_letter_queue"], queue)
+        self.assertGreater(send_message.call_args.kwargs["message_ttl_seconds"], 0)
+
+    def test_affinity_queue_ttl(self):
+        # A TTL on the queue rather than on each message, which RabbitMQ only expires at the head of the queue
+        channel = mock.Mock()
+        rabbit_handler.declare_queue(channel, "encode.small.worker_1", dead_letter_queue="encode.small",
+                                     message_ttl_seconds=120)
+        arguments = channel.queue_declare.call_args.kwargs["arguments"]
+        self.assertEqual(arguments["x-message-ttl"], 120000)
+        self.assertEqual(arguments["x-dead-letter-routing-key"], "encode.small")
+
+    def test_change_affinity_seconds(self):
+        declared = {}
+
+        def queue_declare(queue, durable, arguments):
+            # Like RabbitMQ, which closes the channel with PRECONDITION_FAILED
+            if declared.setdefault(queue, arguments) != arguments:
+                raise pika.exceptions.ChannelClosedByBroker(406, "PRECONDITION_FAILED")
+
+        self._send_heartbeat([self.source_file.get_cache_key()])
+        connection = mock.Mock()
+        connection.channel.return_value.queue_declare.side_effect = queue_declare
+        with mock.patch("pika.BlockingConnection", return_value=connection):
+            distributor.scheduler.schedule_task("metrics", {"id": 1}, 1.0, source_file=self.source_file)
+            with mock.patch.dict(os.environ, {"ROUTING_AFFINITY_SECONDS": "60"}):
+                config.reload()
+                try:
+                    # Redeclared with the new TTL, under a new name
+                    distributor.scheduler.schedule_task("metrics", {"id": 2}, 1.0, source_file=self.source_file)
+                    affinity_queues = distributor.scheduler.get_worker_affinity_queues("small", "worker_1")
+                finally:
+                    config.reload()
+
+        queue = distributor.scheduler.get_tier_queue("metrics", distributor.models.Worker.Tier.SMALL)
+        self.assertEqual(declared["{}.worker_1.ttl120000".format(queue)]["x-message-ttl"], 120000)
+        self.assertEqual(declared["{}.worker_1.ttl60000".format(queue)]["x-message-ttl"], 60000)
+        # The worker is told to consume the queue the manager now sends to
+        self.assertIn("{}.worker_1.ttl60000".format(queue), affinity_queues["metrics"])
+
+    def test_schedule_without_cached_worker(self):
+        self._send_heartbeat([])
+        with mock.patch("utils.rabbit_handler.send_message") as send_message:
+            distributor.scheduler.schedule_task("metrics", {"id": 1}, 1.0, source_file=self.source_file)
+
+        queue = distributor.scheduler.get_tier_queue("metrics", distributor.models.Worker.Tier.SMALL)
+        self.assertEqual(send_message.call_args.kwargs, {"queue": queue, "priority": mock.ANY})
+
+
+class RoutingTests(TestCase):
+    """
+    Tasks only go to a tier with a worker that has room for the source, and don't wait on large workers that are gone.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.small_worker = distributor.models.Worker.objects.create(
+            hostname="small", tier=distributor.models.Worker.Tier.SMALL, free_space=10 ** 10
+        )
+        cls.large_worker = distributor.models.Worker.objects.create(
+            hostname="large", tier=distributor.models.Worker.Tier.LARGE, free_space=10 ** 12
+        )
+
+    def _create_file(self, size: int) -> distributor.models.File:
+        return distributor.models.File.objects.create(
+            name="source_{}.mkv".format(size), directory="/input", size=size, duration=60, frame_rate=23.976,
+            frames=1439, width=1920, height=1080
+        )
+
+    def _route(self, source_file: distributor.models.File) -> str:
+        cost = distributor.scheduler.estimate_encode_cost(source_file, "libx264", "medium")
+        return distributor.scheduler.route_task("encode", source_file, cost, codec="libx264", preset="medium")
+
+    def test_route_by_free_space(self):
+        self.assertEqual(self._route(self._create_file(10 ** 9)), distributor.models.Worker.Tier.SMALL)
+        # A short encode, but too big for the small worker
+        self.assertEqual(self._route(self._create_file(10 ** 10)), distributor.models.Worker.Tier.LARGE)
+
+    def test_requeue_stranded_tasks(self):
+        with mock.patch("utils.rabbit_handler.move_messages", return_value=1) as move_messages:
+            self.assertEqual(distributor.scheduler.requeue_stranded_tasks(), 0)
+            move_messages.assert_not_called()
+
+            distributor.models.Worker.objects.filter(pk=self.large_worker.pk).update(
+                last_seen_datetime=timezone.now() - distributor.scheduler.WORKER_TIMEOUT * 2
+            )
+            self.assertEqual(distributor.scheduler.requeue_stranded_tasks(), 2)
+
+        queues = [x.args for x in move_messages.call_args_list]
+        self.assertEqual(queues, [
+            (distributor.scheduler.get_tier_queue(x, distributor.models.Worker.Tier.LARGE),
+             distributor.scheduler.get_tier_queue(x, distributor.models.Worker.Tier.SMALL))
+            for x in ["encode", "metrics"]
+        ])
+        # The tasks go to the small tier from now on
+        self.assertEqual(self._route(self._create_file(10 ** 10)), distributor.models.Worker.Tier.SMALL)
+
+
+class ScannerTests(TestCase):
+    """
+    Rescans update changed rows and drop what was derived from the old contents; renamed files keep their row.
+    """
+
+    FIELDS = {
+        "size": 1000000, "duration": 60.0, "frame_rate": 23.976, "frames": 1439, "width": 1920, "height": 1080,
+        "fingerprint": "abc123", "modified_time": 1700000000000000000
+    }
+
+    def setUp(self):
+        self.file_object = distributor.models.File.objects.create(
+            name="source.mkv", directory="/input", hash="def456", keyframe_index=b"\x01", **self.FIELDS
+        )
+
+    def test_unchanged(self):
+        progress = distributor.scanner.ScanProgress(1)
+        distributor.scanner.save_probe_results([(pathlib.Path("/input/source.mkv"), dict(self.FIELDS))], progress)
+        self.file_object.refresh_from_db()
+        self.assertEqual(progress.unchanged, 1)
+        self.assertEqual(bytes(self.file_object.keyframe_index), b"\x01")
+
+    def test_find_unchanged_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = pathlib.Path(directory, "source.mkv")
+            file_path.write_bytes(bytes(100))
+            file_object = distributor.models.File.objects.create(
+                name=file_path.name, directory=directory, **dict(
+                    self.FIELDS, size=100, modified_time=file_path.stat().st_mtime_ns
+                )
+            )
+            self.assertEqual(distributor.scanner.find_unchanged_files([file_path]), {file_path: file_object})
+
+            file_path.write_bytes(bytes(200))
+            self.assertEqual(distributor.scanner.find_unchanged_files([file_path]), {})
+
+    def test_changed_contents(self):
+        fields = dict(self.FIELDS, size=2000000, fingerprint="abc124")
+        distributor.scanner.save_probe_results([(pathlib.Path("/input/source.mkv"), fields)])
+        self.file_object.refresh_from_db()
+        self.assertEqual(self.file_object.size, 2000000)
+        self.assertEqual(self.file_object.hash, "")
+        self.assertIsNone(self.file_object.keyframe_index)
+
+    def test_renamed(self):
+        progress = distributor.scanner.ScanProgress(1)
+        results = distributor.scanner.save_probe_results(
+            [(pathlib.Path("/input/renamed.mkv"), dict(self.FIELDS))], progress
+        )
+        self.assertEqual(progress.renamed, 1)
+        self.assertEqual([x.pk for x in results], [self.file_object.pk])
+        self.file_object.refresh_from_db()
+        self.assertEqual(self.file_object.name, "renamed.mkv")
+        self.assertEqual(bytes(self.file_object.keyframe_index), b"\x01")
+
+    @mock.patch.object(distributor.scanner, "_current_progress", None)
+    def test_one_scan_at_a_time(self):
+        listing = threading.Event()
+        finished = threading.Event()
+
+        def scan_directories(directories, progress=None):
+            # Still listing the files, so the scan hasn't filled in its progress yet
+            listing.wait(5)
+            progress.end_datetime = timezone.now()
+            finished.set()
+
+        with mock.patch("distributor.scanner.scan_directories", side_effect=scan_directories):
+            self.assertTrue(distributor.scanner.start_scan([pathlib.Path("/input")]))
+            self.assertFalse(distributor.scanner.start_scan([pathlib.Path("/input")]))
+            self.assertTrue(distributor.scanner.get_progress()["running"])
+
+            listing.set()
+            self.assertTrue(finished.wait(5))
+            self.assertFalse(distributor.scanner.is_scanning())
+
+
+class KeyframeIndexTests(SimpleTestCase):
+    """
+    The stored keyframe index survives a round trip, and lookups at or past either end behave as documented.
+    """
+
+    def setUp(self):
+        # Unsorted with a duplicate, like timestamps straight from ffprobe can be
+        self.index = keyframes.KeyframeIndex([4004, 0, 2002, 6006, 2002, 8008])
+
+    def test_round_trip(self):
+        data = self.index.to_bytes()
+        self.assertIsInstance(data, bytes)
+        self.assertEqual(list(keyframes.KeyframeIndex.from_bytes(data).timestamps), [0, 2002, 4004, 6006, 8008])
+        self.assertEqual(len(keyframes.KeyframeIndex.from_bytes(keyframes.KeyframeIndex([]).to_bytes())), 0)
+
+    def test_previous(self):
+        self.assertIsNone(self.index.previous(-1))
+        self.assertEqual(self.index.previous(0), 0)
+        self.assertEqual(self.index.previous(4003), 2002)
+        self.assertEqual(self.index.previous(4004), 4004)
+        self.assertEqual(self.index.previous(8008), 8008)
+        self.assertEqual(self.index.previous(100000), 8008)
+
+    def test_next(self):
+        self.assertEqual(self.index.next(-1), 0)
+        self.assertEqual(self.index.next(0), 0)
+        self.assertEqual(self.index.next(4005), 6006)
+        self.assertEqual(self.index.next(8008), 8008)
+        self.assertIsNone(self.index.next(8009))
+
+    def test_nearest(self):
+        self.assertEqual(self.index.nearest(-1000), 0)
+        self.assertEqual(self.index.nearest(3000), 2002)
+        self.assertEqual(self.index.nearest(3004), 4004)
+        # Ties go to the earlier keyframe
+        self.assertEqual(self.index.nearest(3003), 2002)
+        self.assertEqual(self.index.nearest(100000), 8008)
+        self.assertIsNone(keyframes.KeyframeIndex([]).nearest(0))
+
+
+class MatroskaTests(SimpleTestCase):
+    """
+    Matroska headers are read into the same shape ffprobe gives, and anything uncertain is left to ffprobe.
+    """
+
+    @staticmethod
+    def _element(element_id: int, payload: bytes) -> bytes:
+        # Sizes are always written as 8 byte vints, which is valid (if wasteful) EBML
+        return element_id.to_bytes((element_id.bit_length() + 7) // 8, "big") + b"\x01" + \
+            len(payload).to_bytes(7, "big") + payload
+
+    def _uint(self, element_id: int, value: int) -> bytes:
+        return self._element(element_id, value.to_bytes(max(1, (value.bit_length() + 7) // 8), "big"))
+
+    def _string(self, element_id: int, value: str) -> bytes:
+        return self._element(element_id, value.encode())
+
+    def _create_file(self, file_path: pathlib.Path, interlaced: int = 2) -> None:
+        info = self._element(matroska.INFO, (
+            self._uint(matroska.TIMESTAMP_SCALE, 1000000) + self._element(matroska.DURATION, struct.pack(">d", 60000.0))
+            + self._string(matroska.TITLE, "Title") + self._string(matroska.MUXING_APP, "libebml")
+        ))
+        video = self._element(matroska.TRACK_ENTRY, (
+            self._uint(matroska.TRACK_UID, 11) + self._uint(matroska.TRACK_TYPE, 1)
+            + self._string(matroska.CODEC_ID, "V_MPEG4/ISO/AVC") + self._uint(matroska.DEFAULT_DURATION, 41708333)
+            + self._element(matroska.VIDEO, (
+                self._uint(matroska.PIXEL_WIDTH, 1920) + self._uint(matroska.PIXEL_HEIGHT, 1080)
+                + self._uint(matroska.FLAG_INTERLACED, interlaced)
+            ))
+        ))
+        audio = self._element(matroska.TRACK_ENTRY, (
+            self._uint(matroska.TRACK_UID, 12) + self._uint(matroska.TRACK_TYPE, 2)
+            + self._string(matroska.CODEC_ID, "A_FLAC") + self._string(matroska.LANGUAGE, "jpn")
+            + self._uint(matroska.FLAG_DEFAULT, 0)
+            + self._element(matroska.AUDIO, (
+                self._element(matroska.SAMPLING_FREQUENCY, struct.pack(">f", 48000.0))
+                + self._uint(matroska.CHANNELS, 2)
+            ))
+        ))
+        tags = self._element(matroska.TAGS, self._element(matroska.TAG, (
+            self._element(matroska.TARGETS, self._uint(matroska.TAG_TRACK_UID, 11))
+            + self._element(matroska.SIMPLE_TAG, (
+                self._string(matroska.TAG_NAME, "NUMBER_OF_FRAMES") + self._string(matroska.TAG_STRING, "1439")
+            ))
+        )))
+        body = info + self._element(matroska.TRACKS, video + audio) + tags + self._element(matroska.CLUSTER, bytes(64))
+        file_path.write_bytes(
+            self._element(matroska.EBML, self._string(matroska.DOC_TYPE, "matroska"))
+            + self._element(matroska.SEGMENT, body)
+        )
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_path = pathlib.Path(self.directory.name, "source.mkv")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_header(self):
+        self._create_file(self.file_path)
+        output = matroska.get_ffprobe_output(self.file_path)
+
+        self.assertEqual(output["format"]["duration"], "60.000000")
+        self.assertEqual(output["format"]["tags"], {"title": "Title", "encoder": "libebml"})
+        video, audio = output["streams"]
+        self.assertEqual(
+            {x: video[x] for x in ["index", "codec_name", "codec_type", "width", "height", "field_order"]},
+            {"index": 0, "codec_name": "h264", "codec_type": "video", "width": 1920, "height": 1080,
+             "field_order": "progressive"}
+        )
+        self.assertEqual(video["r_frame_rate"], "24000/1001")
+        self.assertEqual(video["tags"], {"language": "eng", "NUMBER_OF_FRAMES": "1439"})
+        self.assertEqual((audio["codec_name"], audio["channels"], audio["sample_rate"]), ("flac", 2, "48000"))
+        self.assertEqual(audio["tags"], {"language": "jpn"})
+        self.assertEqual(audio["disposition"]["default"], 0)
+
+    def test_fall_back_to_ffprobe(self):
+        # Undetermined interlacing
+        self._create_file(self.file_path, interlaced=0)
+        self.assertIsNone(matroska.get_ffprobe_output(self.file_path))
+
+        # Not Matroska, or cut short
+        self.file_path.write_bytes(b"RIFF" + bytes(64))
+        self.assertIsNone(matroska.get_ffprobe_output(self.file_path))
+        self._create_file(self.file_path)
+        self.file_path.write_bytes(self.file_path.read_bytes()[:40])
+        self.assertIsNone(matroska.get_ffprobe_output(self.file_path))
+
+
+class SourceCacheTests(SimpleTestCase):
+    """
+    The worker's source cache keeps the most recently used files under its size cap.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = source_cache.SourceCache(pathlib.Path(self.directory.name, "cache"), max_bytes=250)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _add(self, key: str, size: int, mtime: int) -> None:
+        file_path = pathlib.Path(self.directory.name, key)
+        file_path.write_bytes(bytes(size))
+        self.cache.add(key, file_path)
+        # Explicit times, the filesystem's resolution could make the order ambiguous
+        os.utime(self.cache.directory.joinpath(key), ns=(mtime, mtime))
+
+    def test_get_key(self):
+        self.assertEqual(source_cache.SourceCache.get_key({"id": 1, "size": 10, "fingerprint": "abc"}), "abc-10")
+        self.assertEqual(source_cache.SourceCache.get_key({"id": 1, "size": 10, "fingerprint": ""}), "file1-10")
+        self.assertIsNone(source_cache.SourceCache.get_key({"id": 1, "size": -1}))
+
+    def test_fetch(self):
+        destination = pathlib.Path(self.directory.name, "destination.mkv")
+        self.assertFalse(self.cache.fetch("a", destination))
+        self._add("a", 100, 1000000000)
+        self.assertTrue(self.cache.fetch("a", destination))
+        self.assertEqual(destination.stat().st_size, 100)
+        self.assertEqual((self.cache.hits, self.cache.misses, self.cache.bytes_saved), (1, 1, 100))
+
+    def test_eviction(self):
+        self._add("a", 100, 1000000000)
+        self._add("b", 100, 2000000000)
+        # Using "a" makes "b" the least recently used
+        self.cache.fetch("a", pathlib.Path(self.directory.name, "destination.mkv"))
+        # Directories in the cache directory are left alone, and not reported as cached files
+        self.cache.directory.joinpath("other").mkdir()
+
+        self._add("c", 100, 3000000000)
+        self.assertEqual(self.cache.get_keys(), ["a", "c"])
+        self.assertEqual(self.cache.evictions, 1)
+        statistics = self.cache.get_statistics()
+        self.assertEqual((statistics["entries"], statistics["size"]), (2, 200))
+        self.assertTrue(self.cache.directory.joinpath("other").is_dir())
 
-# Create your tests here.
+        # Too big to ever fit
+        file_path = pathlib.Path(self.directory.name, "d")
+        file_path.write_bytes(bytes(300))
+        self.cache.add("d", file_path)
+        self.assertEqual(self.cache.get_keys(), ["a", "c"])
@@ -14,4 +14,12 @@ urlpatterns = [
     # API - Files
     path("api/files/", views.api_file_list, name="api-file-list"),
     path("api/files/<int:file_id>/file", views.api_file, name="api-file"),
+    path("api/files/<int:file_id>/keyframes", views.api_file_keyframes, name="api-file-keyframes"),
+
+    # API - Workers
+    path("api/workers/", views.api_worker_list, name="api-worker-list"),
+    path("api/workers/cache/", views.api_worker_cache, name="api-worker-cache"),
+
+    # API - Scanning
+    path("api/scan/", views.api_scan, name="api-scan"),
 ]
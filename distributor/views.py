@@ -1,17 +1,19 @@
+import json
 import pathlib
 
 from django.http import FileResponse, HttpResponse, JsonResponse
 from django.shortcuts import get_object_or_404, render
+from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
 
+import distributor.api
 import distributor.models
+import distributor.scanner
+import distributor.scheduler
 import distributor.serializers
 
-
-########################################################################################################################
-# Global Values
-########################################################################################################################
-ITEMS_PER_PAGE = 50
+from utils import config
+from utils import log
 
 
 ########################################################################################################################
@@ -35,9 +37,9 @@ def api_file_list(request):
             status=405
         )
 
-    files = distributor.models.File.objects.all()
-    serializer = distributor.serializers.FileSerializer(files, many=True)
-    return JsonResponse(serializer.data, safe=False, json_dumps_params={"indent": 2})
+    return distributor.api.list_response(
+        request, distributor.models.File.objects.all(), distributor.serializers.FILE_LIST_FIELDS
+    )
 
 
 @csrf_exempt
@@ -52,3 +54,139 @@ def api_file(request, file_id: int):
     file = get_object_or_404(distributor.models.File, pk=file_id)
 
     return FileResponse(open(pathlib.Path(file.directory, file.name), "rb"))
+
+
+@csrf_exempt
+def api_file_keyframes(request, file_id: int):
+    if request.method != "GET":
+        return JsonResponse(
+            {"error": "this endpoint only supports GET requests, not [{}]".format(request.method)},
+            json_dumps_params={"indent": 2},
+            status=405
+        )
+
+    file = get_object_or_404(distributor.models.File, pk=file_id)
+    keyframe_index = file.get_keyframe_index()
+
+    # Without a timestamp, just dump the index.  With one (in seconds), find the keyframes around it.
+    if "timestamp" not in request.GET:
+        return JsonResponse(
+            {"count": len(keyframe_index), "keyframes": [x / 1000 for x in keyframe_index.timestamps]},
+            json_dumps_params={"indent": 2}
+        )
+
+    try:
+        timestamp = round(float(request.GET["timestamp"]) * 1000)
+    except ValueError:
+        return JsonResponse(
+            {"error": "invalid timestamp [{}]".format(request.GET["timestamp"])},
+            json_dumps_params={"indent": 2},
+            status=400
+        )
+
+    lookups = {
+        "previous": keyframe_index.previous(timestamp),
+        "next": keyframe_index.next(timestamp),
+        "nearest": keyframe_index.nearest(timestamp)
+    }
+    return JsonResponse(
+        {x: (y / 1000 if y is not None else None) for x, y in lookups.items()},
+        json_dumps_params={"indent": 2}
+    )
+
+
+@csrf_exempt
+def api_worker_list(request):
+    # GET to list workers
+    # POST for a worker to register its capabilities, the response tells it which queues to consume
+    if request.method == "POST":
+        capabilities = json.loads(request.body)
+        hostname = request.headers.get("Worker", capabilities.get("hostname", None))
+        if not hostname:
+            return JsonResponse({"error": "Missing worker hostname"}, json_dumps_params={"indent": 2}, status=400)
+
+        cores = int(capabilities.get("cores", 1))
+        worker, created = distributor.models.Worker.objects.update_or_create(
+            hostname=hostname,
+            defaults={
+                "tier": distributor.scheduler.get_worker_tier(cores),
+                "cores": cores,
+                "avx512": bool(capabilities.get("avx512", False)),
+                "free_space": int(capabilities.get("free_space", 0)),
+                "benchmarks": capabilities.get("benchmarks", {})
+            }
+        )
+        log.info("Worker [{}] {} as [{}] tier".format(hostname, "registered" if created else "updated", worker.tier))
+
+        return JsonResponse(
+            {
+                "tier": worker.tier,
+                "queues": distributor.scheduler.get_worker_queues(worker.tier),
+                "affinity_queues": distributor.scheduler.get_worker_affinity_queues(worker.tier, hostname),
+                # TTL of the affinity queues, which has to be part of their declaration too
+                "affinity_seconds": config.load_routing_config()["affinity_seconds"]
+            },
+            json_dumps_params={"indent": 2}
+        )
+    elif request.method == "GET":
+        workers = distributor.models.Worker.objects.all().values(
+            "hostname", "tier", "cores", "avx512", "free_space", "benchmarks", "cache_statistics",
+            "registration_datetime", "last_seen_datetime"
+        )
+        return JsonResponse(list(workers), safe=False, json_dumps_params={"indent": 2})
+
+    return JsonResponse(
+        {"error": "this endpoint only supports GET/POST requests, not [{}]".format(request.method)},
+        json_dumps_params={"indent": 2},
+        status=405
+    )
+
+
+@csrf_exempt
+def api_worker_cache(request):
+    # POST for a worker's heartbeat: the statistics of its source cache, and the keys of the files in it
+    if request.method != "POST":
+        return JsonResponse(
+            {"error": "this endpoint only supports POST requests, not [{}]".format(request.method)},
+            json_dumps_params={"indent": 2},
+            status=405
+        )
+
+    hostname = request.headers.get("Worker", None)
+    if not hostname:
+        return JsonResponse({"error": "Missing worker hostname"}, json_dumps_params={"indent": 2}, status=400)
+
+    cache_statistics = json.loads(request.body)
+    fields = {"last_seen_datetime": timezone.now()}
+    # Workers from before cache affinity only send statistics, leave their (empty) inventory alone
+    if "inventory" in cache_statistics:
+        fields["cache_inventory"] = cache_statistics.pop("inventory")
+    fields["cache_statistics"] = cache_statistics
+
+    updated = distributor.models.Worker.objects.filter(hostname=hostname).update(**fields)
+    if not updated:
+        return JsonResponse(
+            {"error": "Worker [{}] isn't registered".format(hostname)}, json_dumps_params={"indent": 2}, status=404
+        )
+
+    # Heartbeats keep coming from the small workers after the large ones are gone, so they're a regular place to check
+    distributor.scheduler.requeue_stranded_tasks()
+    return JsonResponse({"success": "cache statistics updated"}, json_dumps_params={"indent": 2})
+
+
+@csrf_exempt
+def api_scan(request):
+    # GET for the progress of the latest scan
+    # POST to start scanning the input directory in the background
+    if request.method == "POST":
+        if not distributor.scanner.start_scan([config.load_input_directory()]):
+            return JsonResponse({"error": "A scan is already running"}, json_dumps_params={"indent": 2}, status=409)
+        return JsonResponse({"started": True}, json_dumps_params={"indent": 2}, status=202)
+    elif request.method == "GET":
+        return JsonResponse({"progress": distributor.scanner.get_progress()}, json_dumps_params={"indent": 2})
+
+    return JsonResponse(
+        {"error": "this endpoint only supports GET/POST requests, not [{}]".format(request.method)},
+        json_dumps_params={"indent": 2},
+        status=405
+    )
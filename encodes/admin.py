@@ -6,6 +6,14 @@ import encodes.models
 ########################################################################################################################
 # Admin objects
 ########################################################################################################################
+class EncodeStatisticsAdmin(admin.ModelAdmin):
+    list_display = (
+        "profile", "worker", "completed_tasks", "total_frames", "total_duration", "total_encode_seconds",
+        "last_completion_datetime"
+    )
+    ordering = ("profile", "worker")
+
+
 class EncodeTaskAdmin(admin.ModelAdmin):
     list_display = (
         "id", "source_file", "profile", "worker", "encode_type", "encode_value", "status", "progress",
@@ -19,7 +27,7 @@ class ProfileAdmin(admin.ModelAdmin):
         "name", "description",
         "codec", "encode_type", "encode_value", "encoder_preset", "encoder_tune",
         "additional_arguments",
-        "keep_original_main_audio"
+        "keep_original_main_audio", "priority"
     )
     ordering = ("pk", )
 
@@ -27,5 +35,6 @@ class ProfileAdmin(admin.ModelAdmin):
 ########################################################################################################################
 # Default Admin models
 ########################################################################################################################
+admin.site.register(encodes.models.EncodeStatistics, EncodeStatisticsAdmin)
 admin.site.register(encodes.models.EncodeTask, EncodeTaskAdmin)
 admin.site.register(encodes.models.Profile, ProfileAdmin)
@@ -0,0 +1,262 @@
+import datetime
+import heapq
+import statistics
+import typing
+
+from django.utils import timezone
+
+import distributor.models
+import distributor.scheduler
+
+import encodes.models
+
+
+########################################################################################################################
+# Cost Model
+########################################################################################################################
+# Only the most recent completed tasks are used, so the model follows upgrades to workers and encoders.
+TRAINING_TASK_LIMIT = 2000
+
+# Samples needed before a (codec, preset, worker) or (codec, preset) rate is trusted over the next level down.
+MINIMUM_SAMPLES = 3
+
+
+class CostModel:
+    """
+    Predicts how long an encode takes, trained on completed encode tasks.
+
+    Every completed task gives a pixel rate: frames * pixels per frame / wall time of the task.  Wall time covers the
+    download and upload too, which is what matters for projecting the queue.  A prediction uses the median pixel rate
+    of the most specific group with enough samples:
+
+    1. codec, preset and worker
+    2. codec and preset, on any worker
+    3. codec, on any worker, scaled by the preset factors in `distributor.scheduler`
+    4. everything, scaled by the preset and codec factors in `distributor.scheduler`
+
+    With no history at all, the default small worker speed from `distributor.scheduler` is used.
+    """
+
+    def __init__(self):
+        self.worker_rates: typing.Dict[typing.Tuple[str, str, str], typing.List[float]] = {}
+        self.preset_rates: typing.Dict[typing.Tuple[str, str], typing.List[float]] = {}
+        self.codec_rates: typing.Dict[str, typing.List[float]] = {}
+        self.global_rates: typing.List[float] = []
+        self._medians: typing.Dict[typing.Any, float] = {}
+
+    def __repr__(self):
+        return "<CostModel trained on {} tasks>".format(len(self.global_rates))
+
+    @classmethod
+    def train(cls, limit: int = TRAINING_TASK_LIMIT) -> "CostModel":
+        """
+        Train a model on the most recently completed encode tasks.
+
+        :param limit: maximum number of tasks to train on
+        :return: trained model
+        """
+        model = cls()
+        completed_tasks = encodes.models.EncodeTask.objects.filter(
+            status=encodes.models.EncodeTask.TaskStatus.COMPLETE,
+            encode_start_datetime__isnull=False,
+            encode_end_datetime__isnull=False,
+            source_file__frames__gt=0
+        ).order_by("-encode_end_datetime").values_list(
+            "profile__codec", "profile__encoder_preset", "worker", "encode_start_datetime", "encode_end_datetime",
+            "source_file__frames", "source_file__width", "source_file__height"
+        )[:limit]
+
+        for codec, preset, worker, start, end, frames, width, height in completed_tasks:
+            seconds = (end - start).total_seconds()
+            if seconds <= 0:
+                continue
+            model.add_sample(codec, preset, worker, frames * (width or 1920) * (height or 1080) / seconds)
+        return model
+
+    def add_sample(self, codec: str, preset: str, worker: typing.Optional[str], pixel_rate: float) -> None:
+        """
+        Add a completed task to the model.
+
+        :param codec: codec of the encode
+        :param preset: encoder preset
+        :param worker: hostname of the worker that did the encode
+        :param pixel_rate: pixels encoded per second of wall time
+        :return: None
+        """
+        if worker:
+            self.worker_rates.setdefault((codec, preset, worker), []).append(pixel_rate)
+        self.preset_rates.setdefault((codec, preset), []).append(pixel_rate)
+        # Normalized to `medium` (and to x264 for the global rates), so they can be scaled to any preset & codec
+        self.codec_rates.setdefault(codec, []).append(pixel_rate * _get_preset_factor(preset))
+        self.global_rates.append(pixel_rate * _get_preset_factor(preset) * _get_codec_factor(codec))
+        self._medians.clear()
+
+    def _median(self, key: typing.Any, rates: typing.List[float]) -> float:
+        if key not in self._medians:
+            self._medians[key] = statistics.median(rates)
+        return self._medians[key]
+
+    def get_pixel_rate(self, codec: str, preset: str, worker: str = None) -> float:
+        """
+        Get the expected pixel rate of an encode.
+
+        :param codec: codec of the encode
+        :param preset: encoder preset
+        :param worker: hostname of the worker doing the encode, if known
+        :return: pixels encoded per second of wall time
+        """
+        rates = self.worker_rates.get((codec, preset, worker), [])
+        if worker and len(rates) >= MINIMUM_SAMPLES:
+            return self._median((codec, preset, worker), rates)
+
+        rates = self.preset_rates.get((codec, preset), [])
+        if len(rates) >= MINIMUM_SAMPLES:
+            return self._median((codec, preset), rates)
+
+        rates = self.codec_rates.get(codec, [])
+        if rates:
+            return self._median(codec, rates) / _get_preset_factor(preset)
+
+        if self.global_rates:
+            return self._median(None, self.global_rates) / _get_preset_factor(preset) / _get_codec_factor(codec)
+
+        return (
+            distributor.scheduler.DEFAULT_SMALL_WORKER_FPS * distributor.scheduler.BENCHMARK_PIXELS
+            / _get_preset_factor(preset) / _get_codec_factor(codec)
+        )
+
+    def predict_seconds(self, task: encodes.models.EncodeTask, worker: str = None) -> float:
+        """
+        Predict how long an encode task takes from start to finish.
+
+        :param task: task to predict
+        :param worker: hostname of the worker doing the encode, if known
+        :return: predicted duration in seconds
+        """
+        pixels = (task.source_file.width or 1920) * (task.source_file.height or 1080)
+        pixel_rate = self.get_pixel_rate(task.profile.codec, task.profile.encoder_preset, worker=worker)
+        return (task.source_file.frames or 0) * pixels / pixel_rate
+
+    def predict_remaining_seconds(self, task: encodes.models.EncodeTask, now: datetime.datetime = None) -> float:
+        """
+        Predict how long an encode task that has been started has left.  Early on this is mostly the model's prediction
+        for the whole task scaled by the reported progress; the further along the task is, the more weight goes to
+        extrapolating the time it has taken so far.
+
+        :param task: task in progress
+        :param now: current time
+        :return: predicted seconds remaining
+        """
+        now = now or timezone.now()
+        predicted = self.predict_seconds(task, worker=task.worker)
+        progress = float(task.progress or 0) / 100
+
+        remaining = predicted * (1 - progress)
+        if task.encode_start_datetime and 0 < progress < 1:
+            elapsed = (now - task.encode_start_datetime).total_seconds()
+            remaining = (1 - progress) * remaining + progress * (elapsed / progress - elapsed)
+        return max(remaining, 0.0)
+
+
+def _get_preset_factor(preset: str) -> float:
+    return distributor.scheduler.PRESET_FACTORS.get(preset, 1.0)
+
+
+def _get_codec_factor(codec: str) -> float:
+    return distributor.scheduler.CODEC_FACTORS.get(codec, 1.0)
+
+
+########################################################################################################################
+# Projection
+########################################################################################################################
+def _get_encode_workers(in_progress_tasks: typing.List[encodes.models.EncodeTask]) -> typing.List[str]:
+    """
+    Get the workers that can process encodes.  Registered workers seen recently, plus any worker that's currently on a
+    task (unregistered workers still get work).  If there's nobody at all, assume a single anonymous worker.
+
+    :param in_progress_tasks: tasks currently being processed
+    :return: worker hostnames
+    """
+    workers = set(
+        distributor.models.Worker.objects.filter(
+            last_seen_datetime__gte=timezone.now() - distributor.scheduler.WORKER_TIMEOUT
+        ).values_list("hostname", flat=True)
+    )
+    workers.update(x.worker for x in in_progress_tasks if x.worker)
+    return sorted(workers) or [None]
+
+
+def _get_queue_order(queued_tasks: typing.List[encodes.models.EncodeTask]) -> typing.List[encodes.models.EncodeTask]:
+    """
+    Sort queued tasks into the order workers will receive them, using the same priorities the scheduler gave them.
+    Tasks with the same priority come out oldest first.
+
+    :param queued_tasks: tasks waiting in the queue
+    :return: tasks in processing order
+    """
+    queued_in_profile: typing.Dict[int, int] = {}
+    priorities = {}
+    for task in sorted(queued_tasks, key=lambda x: (x.creation_datetime, x.pk)):
+        cost = distributor.scheduler.estimate_encode_cost(
+            task.source_file, task.profile.codec, task.profile.encoder_preset
+        )
+        priorities[task.pk] = distributor.scheduler.get_priority(
+            cost, profile_priority=task.profile.priority, queued_in_group=queued_in_profile.get(task.profile_id, 0)
+        )
+        queued_in_profile[task.profile_id] = queued_in_profile.get(task.profile_id, 0) + 1
+
+    return sorted(queued_tasks, key=lambda x: (-priorities[x.pk], x.creation_datetime, x.pk))
+
+
+def project_queue(model: CostModel = None, now: datetime.datetime = None) -> dict:
+    """
+    Project when every incomplete encode task finishes, and when the whole backlog is done.
+
+    The queue is simulated by handing tasks, in priority order, to whichever worker frees up first.  Each worker
+    starts free at the end of its current task.
+
+    :param model: cost model to predict with, trained on the spot if not given
+    :param now: time to project from
+    :return: dict of "workers", "backlog_seconds", "backlog_completion" and "tasks" (id -> projection)
+    """
+    model = model or CostModel.train()
+    now = now or timezone.now()
+
+    incomplete_tasks = list(
+        encodes.models.EncodeTask.objects.exclude(
+            status=encodes.models.EncodeTask.TaskStatus.COMPLETE
+        ).select_related("source_file", "profile")
+    )
+    queued_statuses = [encodes.models.EncodeTask.TaskStatus.CREATED, encodes.models.EncodeTask.TaskStatus.QUEUED]
+    queued_tasks = [x for x in incomplete_tasks if x.status in queued_statuses]
+    in_progress_tasks = [x for x in incomplete_tasks if x.status not in queued_statuses]
+
+    workers = _get_encode_workers(in_progress_tasks)
+    free_at = {x: 0.0 for x in workers}
+    projections = {}
+
+    for task in in_progress_tasks:
+        remaining = model.predict_remaining_seconds(task, now=now)
+        free_at[task.worker] = free_at.get(task.worker, 0.0) + remaining
+        projections[task.pk] = {"worker": task.worker, "start_seconds": 0.0, "end_seconds": free_at[task.worker]}
+
+    # (seconds until free, hostname); hostname breaks ties so the order is stable
+    worker_heap = [(seconds, worker or "") for worker, seconds in free_at.items()]
+    heapq.heapify(worker_heap)
+
+    for task in _get_queue_order(queued_tasks):
+        start, worker = heapq.heappop(worker_heap)
+        end = start + model.predict_seconds(task, worker=worker or None)
+        projections[task.pk] = {"worker": worker or None, "start_seconds": start, "end_seconds": end}
+        heapq.heappush(worker_heap, (end, worker))
+
+    backlog_seconds = max([x["end_seconds"] for x in projections.values()], default=0.0)
+    for projection in projections.values():
+        projection["projected_completion"] = now + datetime.timedelta(seconds=projection["end_seconds"])
+
+    return {
+        "workers": len(free_at),
+        "backlog_seconds": backlog_seconds,
+        "backlog_completion": now + datetime.timedelta(seconds=backlog_seconds),
+        "tasks": projections
+    }
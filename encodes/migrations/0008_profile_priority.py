@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 04:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('encodes', '0007_rename_encoder_profile_codec'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='priority',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-19 05:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('encodes', '0008_profile_priority'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='encodetask',
+            index=models.Index(fields=['status', 'profile'], name='encodetask_status_profile_idx'),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 4.2.7 on 2026-10-19 05:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_statistics(apps, schema_editor):
+    # Totals of every task completed before statistics were kept
+    EncodeTask = apps.get_model("encodes", "EncodeTask")
+    EncodeStatistics = apps.get_model("encodes", "EncodeStatistics")
+
+    totals = {}
+    completed_tasks = EncodeTask.objects.filter(status=5).values_list(
+        "profile_id", "worker", "source_file__frames", "source_file__duration", "encode_framerate",
+        "encode_start_datetime", "encode_end_datetime"
+    )
+    for profile_id, worker, frames, duration, framerate, start, end in completed_tasks.iterator():
+        worker = worker or ""
+        statistics = totals.setdefault((profile_id, worker), EncodeStatistics(profile_id=profile_id, worker=worker))
+        statistics.completed_tasks += 1
+        statistics.total_frames += frames or 0
+        statistics.total_duration += float(duration or 0)
+        statistics.total_encode_framerate += float(framerate or 0)
+        if start and end:
+            statistics.total_encode_seconds += max((end - start).total_seconds(), 0.0)
+        if end and (statistics.last_completion_datetime is None or end > statistics.last_completion_datetime):
+            statistics.last_completion_datetime = end
+
+    EncodeStatistics.objects.bulk_create(totals.values())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('encodes', '0009_encodetask_status_profile_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EncodeStatistics',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('worker', models.CharField(blank=True, max_length=128)),
+                ('completed_tasks', models.IntegerField(default=0)),
+                ('total_frames', models.BigIntegerField(default=0)),
+                ('total_duration', models.FloatField(default=0.0)),
+                ('total_encode_seconds', models.FloatField(default=0.0)),
+                ('total_encode_framerate', models.FloatField(default=0.0)),
+                ('last_completion_datetime', models.DateTimeField(null=True)),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='encodes.profile')),
+            ],
+            options={
+                'verbose_name': 'Encode Statistics',
+                'verbose_name_plural': 'Encode Statistics',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='encodestatistics',
+            constraint=models.UniqueConstraint(fields=('profile', 'worker'), name='encodestatistics_profile_worker_unique'),
+        ),
+        migrations.RunPython(backfill_statistics, migrations.RunPython.noop),
+    ]
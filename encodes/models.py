@@ -20,6 +20,9 @@ class Profile(models.Model):
     additional_arguments = models.TextField(blank=True)
     keep_original_main_audio = models.BooleanField()
 
+    # Added to the scheduler's priority for every task of this profile, higher is processed sooner.  Can be negative.
+    priority = models.IntegerField(default=0)
+
     def __str__(self):
         return self.name
 
@@ -71,6 +74,10 @@ class EncodeTask(models.Model):
 
     class Meta:
         verbose_name = "Encode Task"
+        indexes = [
+            # Task lists and the scheduler filter by status, the scheduler also by profile within a status
+            models.Index(fields=["status", "profile"], name="encodetask_status_profile_idx"),
+        ]
 
     def __str__(self):
         return "{} ({}) [{}]".format(str(self.source_file), self.profile, self.status)
@@ -113,3 +120,63 @@ class EncodeTask(models.Model):
             return "https://{}{}".format(request_host, reverse("encodes:api-task-file", args=(self.pk,)))
         else:
             return "http://{}{}".format(request_host, reverse("encodes:api-task-file", args=(self.pk,)))
+
+
+class EncodeStatistics(models.Model):
+    """
+    Running totals of the completed encode tasks of each profile on each worker, added to as each task completes (see
+    `record_completion`).  Dashboards read these instead of aggregating every task ever completed.
+    """
+    profile = models.ForeignKey(Profile, on_delete=models.CASCADE)
+    worker = models.CharField(max_length=128, blank=True)  # blank for tasks completed without a worker
+
+    completed_tasks = models.IntegerField(default=0)
+    total_frames = models.BigIntegerField(default=0)
+    total_duration = models.FloatField(default=0.0)  # seconds of source video encoded
+    total_encode_seconds = models.FloatField(default=0.0)  # seconds spent encoding
+    total_encode_framerate = models.FloatField(default=0.0)  # sum of the average fps of each task
+    last_completion_datetime = models.DateTimeField(null=True)
+
+    class Meta:
+        verbose_name = "Encode Statistics"
+        verbose_name_plural = "Encode Statistics"
+        constraints = [
+            models.UniqueConstraint(fields=["profile", "worker"], name="encodestatistics_profile_worker_unique"),
+        ]
+
+    def __str__(self):
+        return "{} on {} ({} tasks)".format(self.profile, self.worker or "?", self.completed_tasks)
+
+    def get_average_framerate(self) -> float:
+        if self.completed_tasks == 0:
+            return 0.0
+        return round(self.total_encode_framerate / self.completed_tasks, 2)
+
+    def get_encode_rate(self) -> float:
+        # Seconds of video encoded per second, i.e. 2.0 means twice as fast as real time
+        if self.total_encode_seconds <= 0:
+            return 0.0
+        return round(self.total_duration / self.total_encode_seconds, 2)
+
+    @classmethod
+    def record_completion(cls, task: EncodeTask) -> None:
+        """
+        Add a completed task to the totals of its profile & worker.
+
+        :param task: task that just completed
+        :return: None
+        """
+        encode_seconds = 0.0
+        if task.encode_start_datetime and task.encode_end_datetime:
+            encode_seconds = max((task.encode_end_datetime - task.encode_start_datetime).total_seconds(), 0.0)
+
+        statistics, _ = cls.objects.get_or_create(profile_id=task.profile_id, worker=task.worker or "")
+        # Incremented in the database, so tasks completing at the same time don't overwrite each other's totals
+        cls.objects.filter(pk=statistics.pk).update(
+            completed_tasks=models.F("completed_tasks") + 1,
+            total_frames=models.F("total_frames") + (task.source_file.frames or 0),
+            total_duration=models.F("total_duration") + float(task.source_file.duration or 0),
+            total_encode_seconds=models.F("total_encode_seconds") + encode_seconds,
+            total_encode_framerate=models.F("total_encode_framerate") + float(task.encode_framerate or 0),
+            last_completion_datetime=task.encode_end_datetime
+        )
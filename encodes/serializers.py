@@ -1,9 +1,35 @@
+import typing
+
 from rest_framework import serializers
 
+import distributor.api
 import distributor.serializers
 import encodes.models
 
 
+# Fields of profiles and tasks in list endpoints, see `distributor.api.list_response`
+PROFILE_LIST_FIELDS: typing.Dict[str, distributor.api.Field] = {
+    x: x for x in [
+        "id", "name", "description", "codec", "encode_type", "encode_value", "encoder_preset", "encoder_tune",
+        "additional_arguments", "keep_original_main_audio", "priority"
+    ]
+}
+
+TASK_LIST_FIELDS: typing.Dict[str, distributor.api.Field] = {
+    "id": "id",
+    **distributor.api.nest_fields("source_file", distributor.serializers.FILE_LIST_FIELDS),
+    **distributor.api.nest_fields("compressed_file", distributor.serializers.FILE_LIST_FIELDS),
+    **distributor.api.nest_fields("profile", PROFILE_LIST_FIELDS),
+    **{
+        x: x for x in [
+            "encode_type", "encode_value", "worker", "status", "progress", "encode_framerate", "seconds_remaining",
+            "creation_datetime", "encode_start_datetime", "encode_end_datetime"
+        ]
+    },
+    "encode_task_file_url_field": ("id", lambda x: encodes.models.EncodeTask(pk=x).get_encode_task_file_url())
+}
+
+
 class ProfileSerializer(serializers.ModelSerializer):
     class Meta:
         model = encodes.models.Profile
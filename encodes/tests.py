@@ -1,3 +1,481 @@
+import datetime
+import io
+import math
+import pathlib
+import os
+import tempfile
+from unittest import mock
+
+from django.conf import settings
+from django.db import connection
+from django.test import SimpleTestCase
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+import distributor.models
+import distributor.scheduler
+import encodes.cost_model
+import encodes.models
+import encodes.views
+
+from utils import config
+from utils import ffmpeg
+from utils import progress
+
+
+class ViewQueryCountTests(TestCase):
+    """
+    Every listing view runs the same number of queries however many tasks there are.  A view that starts querying per
+    task (e.g. a template reaching through a relation that wasn't `select_related`) fails here.
+    """
+
+    # Queries each view is allowed, whatever the number of tasks
+    EXPECTED_QUERIES = {
+        "encodes:index": 3,
+        "encodes:completed-tasks": 3,
+        "encodes:incomplete-tasks": 5,
+        "encodes:api-task-list": 1,
+        "encodes:api-tasks-in-progress": 1,
+        "encodes:api-task-projection": 3,
+        "encodes:worker-stats": 2,
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        settings.ALLOWED_HOSTS.append("testserver")
+
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.environment = mock.patch.dict(os.environ, {
+            "INPUT_PATH": os.path.join(cls.directory.name, "input"),
+            "OUTPUT_PATH": os.path.join(cls.directory.name, "output")
+        })
+        cls.environment.start()
+        config.reload()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.environment.stop()
+        config.reload()
+        cls.directory.cleanup()
+        settings.ALLOWED_HOSTS.remove("testserver")
+        super().tearDownClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.profiles = [
+            encodes.models.Profile.objects.create(
+                name="profile_{}".format(i), codec="libx264", encode_type="crf", encode_value=18,
+                encoder_preset="slow", keep_original_main_audio=True
+            )
+            for i in range(2)
+        ]
+
+    def _create_tasks(self, count: int) -> None:
+        statuses = list(encodes.models.EncodeTask.TaskStatus)
+        now = timezone.now()
+        for i in range(count):
+            source_file = distributor.models.File.objects.create(
+                name="source_{}.mkv".format(i), directory="/input", size=1000000, duration=60,
+                frame_rate=23.976, frames=1439, width=1920, height=1080
+            )
+            compressed_file = distributor.models.File.objects.create(
+                name="source_{}.mkv".format(i), directory="/output/profile", size=500000, duration=60,
+                frame_rate=23.976, frames=1439, width=1920, height=1080
+            )
+            task = encodes.models.EncodeTask.objects.create(
+                source_file=source_file, compressed_file=compressed_file, profile=self.profiles[i % 2],
+                encode_type="crf", encode_value=18, status=statuses[i % len(statuses)],
+                worker="worker_{}".format(i % 3), progress=50, encode_framerate=100, seconds_remaining=30,
+                encode_start_datetime=now - datetime.timedelta(minutes=10), encode_end_datetime=now
+            )
+            if task.status == encodes.models.EncodeTask.TaskStatus.COMPLETE:
+                encodes.models.EncodeStatistics.record_completion(task)
+
+    def _count_queries(self, view_name: str) -> int:
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse(view_name))
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_query_counts(self):
+        for task_count in [1, 12]:
+            self._create_tasks(task_count)
+            for view_name, expected_queries in self.EXPECTED_QUERIES.items():
+                with self.subTest(view=view_name, tasks=encodes.models.EncodeTask.objects.count()):
+                    self.assertEqual(self._count_queries(view_name), expected_queries)
+
+
+class FairShareTests(TestCase):
+    """
+    With the fair-share policy, profiles that queue tasks at the same time take turns, however big their batches are.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.environment = mock.patch.dict(os.environ, {"SCHEDULER_POLICY": "fair-share", "RABBITMQ_MAX_PRIORITY": "10"})
+        cls.environment.start()
+        config.reload()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.environment.stop()
+        config.reload()
+        super().tearDownClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.profiles = [
+            encodes.models.Profile.objects.create(
+                name="profile_{}".format(i), codec="libx264", encode_type="crf", encode_value=18,
+                encoder_preset="slow", keep_original_main_audio=True
+            )
+            for i in range(2)
+        ]
+
+    def _create_task(self, profile: encodes.models.Profile) -> encodes.models.EncodeTask:
+        source_file = distributor.models.File.objects.create(
+            name="source_{}.mkv".format(distributor.models.File.objects.count()), directory="/input", size=1000000,
+            duration=60, frame_rate=23.976, frames=1439, width=1920, height=1080
+        )
+        return encodes.models.EncodeTask.objects.create(
+            source_file=source_file, profile=profile, encode_type="crf", encode_value=18
+        )
+
+    def test_large_batch(self):
+        priorities = [distributor.scheduler.get_priority(1.0, queued_in_group=x) for x in range(12)]
+        self.assertEqual(priorities, [10, 9, 8, 7, 6, 5, 4, 3, 2, 1, 0, 0])
+
+    def test_profile_keeps_creation_order(self):
+        sent = []
+        with mock.patch("utils.rabbit_handler.send_message") as send_message:
+            # More tasks than priority levels
+            tasks = [self._create_task(self.profiles[0]) for _ in range(13)]
+            for task in tasks:
+                encodes.views._queue_task(task)
+                sent.append((send_message.call_args.kwargs["priority"], len(sent), task.pk))
+
+        order = [x[2] for x in sorted(sent, key=lambda x: (-x[0], x[1]))]
+        self.assertEqual(order, [x.pk for x in tasks])
+        # The cost model projects the same order
+        queued_tasks = list(encodes.models.EncodeTask.objects.select_related("source_file", "profile"))
+        self.assertEqual([x.pk for x in encodes.cost_model._get_queue_order(queued_tasks)], [x.pk for x in tasks])
+
+    def test_profiles_interleave(self):
+        sent = []
+        with mock.patch("utils.rabbit_handler.send_message") as send_message:
+            # One profile queues its whole batch before the other queues anything
+            for profile in self.profiles:
+                for _ in range(3):
+                    task = self._create_task(profile)
+                    encodes.views._queue_task(task)
+                    sent.append((send_message.call_args.kwargs["priority"], len(sent), profile.name))
+
+        # Highest priority first, then in the order they were sent (like RabbitMQ)
+        order = [x[2] for x in sorted(sent, key=lambda x: (-x[0], x[1]))]
+        self.assertEqual(order, ["profile_0", "profile_1"] * 3)
+
+    def test_grouped_tasks_count_like_single_tasks(self):
+        with mock.patch("utils.rabbit_handler.send_message") as send_message:
+            encodes.views._queue_task(self._create_task(self.profiles[0]))
+            # Only the task already waiting counts, not the tasks being queued
+            encodes.views._queue_tasks_together([self._create_task(self.profiles[0]) for _ in range(2)])
+            self.assertEqual(send_message.call_args.kwargs["priority"], 9)
+            encodes.views._queue_task(self._create_task(self.profiles[0]))
+            self.assertEqual(send_message.call_args.kwargs["priority"], 7)
+
+
+class CostModelTests(TestCase):
+    """
+    The cost model falls back to less specific history when it has too little, and the projection hands tasks out in
+    the order the scheduler would.
+    """
+
+    def test_pixel_rate_fallback(self):
+        model = encodes.cost_model.CostModel()
+        self.assertGreater(model.get_pixel_rate("libx264", "slow"), 0)
+
+        model.add_sample("libx264", "slow", "worker_1", 1000.0)
+        # One sample isn't enough for the preset, so it comes from the codec rate scaled to the preset
+        self.assertAlmostEqual(model.get_pixel_rate("libx264", "slow"), 1000.0)
+        self.assertLess(model.get_pixel_rate("libx264", "veryslow"), 1000.0)
+
+        for rate in [2000.0, 3000.0]:
+            model.add_sample("libx264", "slow", "worker_2", rate)
+        self.assertEqual(model.get_pixel_rate("libx264", "slow"), 2000.0)
+        self.assertEqual(model.get_pixel_rate("libx264", "slow", worker="worker_2"), 2000.0)
+
+    def test_projection_order(self):
+        profile = encodes.models.Profile.objects.create(
+            name="profile", codec="libx264", encode_type="crf", encode_value=18, encoder_preset="slow",
+            keep_original_main_audio=True
+        )
+        tasks = {}
+        for name, frames in [("long", 14390), ("short", 1439)]:
+            source_file = distributor.models.File.objects.create(
+                name="{}.mkv".format(name), directory="/input", size=1000000, duration=frames / 23.976,
+                frame_rate=23.976, frames=frames, width=1920, height=1080
+            )
+            tasks[name] = encodes.models.EncodeTask.objects.create(
+                source_file=source_file, profile=profile, encode_type="crf", encode_value=18,
+                status=encodes.models.EncodeTask.TaskStatus.QUEUED
+            )
+
+        model = encodes.cost_model.CostModel()
+        model.add_sample("libx264", "slow", None, 1920 * 1080 * 100.0)
+        with mock.patch.dict(os.environ, {"SCHEDULER_POLICY": "sjf"}):
+            config.reload()
+            projection = encodes.cost_model.project_queue(model=model)
+        config.reload()
+
+        # One worker, shortest job first: the short task runs first and the long one right after it
+        self.assertEqual(projection["workers"], 1)
+        short_task, long_task = [projection["tasks"][tasks[x].pk] for x in ["short", "long"]]
+        self.assertEqual(short_task["start_seconds"], 0.0)
+        self.assertAlmostEqual(short_task["end_seconds"], 14.39)
+        self.assertAlmostEqual(long_task["start_seconds"], short_task["end_seconds"])
+        self.assertAlmostEqual(projection["backlog_seconds"], 158.29)
+
+
+class ProgressTrackerTests(SimpleTestCase):
+    """
+    Running fps statistics and the ETA of an ffmpeg command.
+    """
+
+    @staticmethod
+    def _step(frame: int, fps: float) -> mock.Mock:
+        return mock.Mock(frame=frame, fps=fps)
+
+    def test_statistics(self):
+        tracker = progress.ProgressTracker(1000, alpha=0.5, history=2)
+        self.assertEqual(tracker.eta, -1)
+        self.assertEqual(tracker.average_fps, 0.0)
+
+        tracker.update(self._step(100, 100.0), now=1.0)
+        tracker.update(self._step(300, 150.0), now=2.0)
+        tracker.update(self._step(400, 200.0), now=3.0)
+
+        self.assertEqual(tracker.updates, 3)
+        self.assertEqual(tracker.average_fps, 150.0)
+        # 100 (ffmpeg's fps for the first update), then 200 and 100 frames/s between updates
+        self.assertEqual(tracker.ewma_fps, 125.0)
+        self.assertEqual(tracker.remaining_frames, 600)
+        self.assertEqual(tracker.eta, 600 / 125.0)
+        # Only the most recent updates are kept
+        self.assertEqual([x.frame for x in tracker.steps], [300, 400])
+
+    def test_finished(self):
+        tracker = progress.ProgressTracker(100)
+        tracker.update(self._step(120, 50.0), now=1.0)
+        self.assertEqual(tracker.remaining_frames, 0)
+        self.assertEqual(tracker.eta, 0)
+
+
+class ProgressParserTests(SimpleTestCase):
+    """
+    ffmpeg's `-progress` output is read one key/value block at a time.
+    """
+
+    # Captured from `ffmpeg -progress pipe:N`: the first block, before any packet was written, and the last one
+    PROGRESS_OUTPUT = (
+        "frame=0\n"
+        "fps=0.00\n"
+        "stream_0_0_q=0.0\n"
+        "bitrate=N/A\n"
+        "total_size=N/A\n"
+        "out_time_us=N/A\n"
+        "out_time_ms=N/A\n"
+        "out_time=N/A\n"
+        "dup_frames=0\n"
+        "drop_frames=0\n"
+        "speed=N/A\n"
+        "progress=continue\n"
+        "frame=2931\n"
+        "fps=185.81\n"
+        "stream_0_0_q=-1.0\n"
+        "bitrate=4078.7kbits/s\n"
+        "total_size=60817408\n"
+        "out_time_us=119287000\n"
+        "out_time_ms=119287000\n"
+        "out_time=00:01:59.287000\n"
+        "dup_frames=0\n"
+        "drop_frames=0\n"
+        "speed=7.56x\n"
+        "progress=end\n"
+    )
+
+    def test_read_progress(self):
+        steps = list(ffmpeg.read_progress(io.StringIO(self.PROGRESS_OUTPUT)))
+        self.assertEqual(len(steps), 2)
+
+        self.assertEqual((steps[0].frame, steps[0].bitrate, steps[0].total_size, steps[0].speed), (0, -1, -1, -1))
+        self.assertEqual(steps[0].out_time, "-1")
+        self.assertEqual(steps[0].progress, "continue")
+
+        self.assertEqual(steps[1].frame, 2931)
+        self.assertEqual(steps[1].fps, 185.81)
+        self.assertEqual(steps[1].bitrate, 4078.7)
+        self.assertEqual(steps[1].total_size, 60817408)
+        self.assertEqual(steps[1].out_time, "00:01:59.287000")
+        self.assertEqual(steps[1].speed, 7.56)
+        self.assertEqual(steps[1].progress, "end")
+
+    def test_unknown_and_partial_lines(self):
+        # Keys in any order, unknown keys and stray lines are ignored, an unfinished block isn't yielded
+        stream = "speed=N/A\nnew_key=1\nnot a key value line\nfps=24.0\nframe=48\nprogress=continue\nframe=72\n"
+        steps = list(ffmpeg.read_progress(io.StringIO(stream), file_framerate=24.0))
+        self.assertEqual(len(steps), 1)
+        self.assertEqual(steps[0].frame, 48)
+        # Speed is calculated from the frame rate when ffmpeg doesn't know it
+        self.assertEqual(steps[0].speed, 1.0)
+
+    def test_stream_sizes(self):
+        lines = [
+            "[libx264 @ 0x55d0] kb/s:4078.70",
+            "video:58750kB audio:1865kB subtitle:0kB other streams:0kB global headers:0kB muxing overhead: 0.32%"
+        ]
+        sizes = ffmpeg.read_stream_sizes(lines)
+        # Upper bounds of the rounded sizes, the real video stream is somewhere from 58749.5 to 58750.5 KiB
+        self.assertEqual(sizes, {"video": 58750 * 1024 + 512, "audio": 1865 * 1024 + 512, "subtitle": 512})
+        self.assertLessEqual(sizes["video"] - math.ceil(58749.5 * 1024), 1024)
+        self.assertIsNone(ffmpeg.read_stream_sizes(lines[:1]))
+
+
+class FFmpegProcessTests(SimpleTestCase):
+    """
+    An ffmpeg run that's abandoned part way is killed and cleaned up, rather than left running.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        # Stands in for ffmpeg (as a single process, like ffmpeg), ignoring the arguments it's given
+        self.program = pathlib.Path(self.directory.name, "ffmpeg")
+        self.program.write_text("#!/bin/sh\nexec sleep 30\n")
+        self.program.chmod(0o755)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_kill(self):
+        process = ffmpeg.FFmpegProcess("\"{}\" -i source.mkv output.mkv".format(self.program))
+        process.kill()
+        self.assertIsNotNone(process.process.returncode)
+        self.assertTrue(process._progress_stream.closed)
+        # Nothing left to do the second time
+        process.kill()
+
+    def test_kill_after_wait(self):
+        self.program.write_text("#!/bin/sh\nexit 0\n")
+        process = ffmpeg.FFmpegProcess("\"{}\" -i source.mkv output.mkv".format(self.program))
+        self.assertEqual(process.wait(), 0)
+        process.kill()
+        self.assertEqual(process.process.returncode, 0)
+
+
+class EncodeStatisticsTests(TestCase):
+    """
+    Completed tasks are added to the running totals of their profile & worker.
+    """
+
+    def test_record_completion(self):
+        profile = encodes.models.Profile.objects.create(
+            name="profile", codec="libx264", encode_type="crf", encode_value=18, encoder_preset="slow",
+            keep_original_main_audio=True
+        )
+        source_file = distributor.models.File.objects.create(
+            name="source.mkv", directory="/input", size=1000000, duration=60, frame_rate=23.976, frames=1439,
+            width=1920, height=1080
+        )
+        now = timezone.now()
+        for worker, encode_framerate in [("worker_1", 100), ("worker_1", 50), (None, 10)]:
+            encodes.models.EncodeStatistics.record_completion(encodes.models.EncodeTask.objects.create(
+                source_file=source_file, profile=profile, encode_type="crf", encode_value=18, worker=worker,
+                encode_framerate=encode_framerate, encode_start_datetime=now - datetime.timedelta(seconds=30),
+                encode_end_datetime=now
+            ))
+
+        statistics = encodes.models.EncodeStatistics.objects.get(profile=profile, worker="worker_1")
+        self.assertEqual(statistics.completed_tasks, 2)
+        self.assertEqual(statistics.total_frames, 2878)
+        self.assertEqual(statistics.total_encode_seconds, 60.0)
+        self.assertEqual(statistics.get_average_framerate(), 75.0)
+        self.assertEqual(statistics.get_encode_rate(), 2.0)
+        self.assertEqual(statistics.last_completion_datetime, now)
+        # Tasks without a worker get their own totals
+        self.assertEqual(encodes.models.EncodeStatistics.objects.get(profile=profile, worker="").completed_tasks, 1)
+
+
+class MultiCrfCommandTests(SimpleTestCase):
+    """
+    Several CRF encodes of one source share a single decode, and split the threads between their encoders.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.output_directory = pathlib.Path(self.directory.name, "output")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _create_command(self, field_order: str) -> str:
+        file_info = mock.Mock(
+            video_stream={"field_order": field_order, "height": 1080, "r_frame_rate": "24000/1001"},
+            audio_streams=[], subtitle_streams=[{"index": 2}]
+        )
+        outputs = [
+            {"output_path": self.output_directory.joinpath("a.mkv"), "codec": "h264", "crf": 18, "preset": "slow"},
+            {"output_path": self.output_directory.joinpath("b.mkv"), "codec": "h265", "crf": 20, "preset": "medium",
+             "tune": "grain"}
+        ]
+        with mock.patch("utils.ffprobe.get_file_info", return_value=file_info), \
+                mock.patch("utils.mkvtoolnix.add_media_statistics_if_necessary"):
+            return ffmpeg.create_multi_crf_command(pathlib.Path("/input/source.mkv"), outputs, threads=8)
+
+    def test_progressive(self):
+        command = self._create_command("progressive")
+        self.assertEqual(command.count(" -i "), 1)
+        self.assertNotIn("-filter_complex", command)
+        self.assertIn("-map 0:v:0 -c:v:0 libx264 -preset slow -threads:v 4 -crf 18 -level:v 4.1", command)
+        self.assertIn("-map 0:v:0 -c:v:0 libx265 -preset medium -tune grain -crf 20", command)
+        self.assertIn("pools=4", command)
+        self.assertEqual(command.count("-map 0:s -c:s copy"), 2)
+        self.assertTrue(command.endswith("\"{}\"".format(self.output_directory.joinpath("b.mkv"))))
+
+    def test_interlaced(self):
+        # Deinterlaced once, then split between the encoders
+        command = self._create_command("tt")
+        self.assertIn("-filter_complex \"[0:v:0]bwdif=0,split=2[v0][v1]\"", command)
+        self.assertIn("-map \"[v0]\" -c:v:0 libx264", command)
+        self.assertIn("-map \"[v1]\" -c:v:0 libx265", command)
+
+
+class AudioTranscodeTests(SimpleTestCase):
+    """
+    Background audio encodes can be waited on, or cancelled without leaving processes or sidecar files behind.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.sidecar = pathlib.Path(self.directory.name, "source_audio0.mka")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _start(self, command: str) -> ffmpeg.AudioTranscode:
+        with mock.patch("utils.ffmpeg.create_audio_commands", return_value=[(command, self.sidecar)]):
+            return ffmpeg.AudioTranscode(pathlib.Path("/input/source.mkv"), self.sidecar.parent).start()
+
+    def test_wait(self):
+        audio_transcode = self._start("touch \"{}\"".format(self.sidecar))
+        self.assertEqual(audio_transcode.wait(), [self.sidecar])
+        self.assertTrue(self.sidecar.exists())
 
-# Create your tests here.
+    def test_cancel(self):
+        self.sidecar.touch()
+        audio_transcode = self._start("sleep 30")
+        audio_transcode.cancel()
+        self.assertTrue(all(x.done() for x in audio_transcode._futures))
+        self.assertFalse(self.sidecar.exists())
@@ -21,6 +21,7 @@ urlpatterns = [
     # API - Tasks
     path("api/tasks/", views.api_task_list, name="api-task-list"),
     path("api/tasks/in-progress/", views.api_tasks_in_progress, name="api-tasks-in-progress"),
+    path("api/tasks/projection/", views.api_task_projection, name="api-task-projection"),
     path("api/tasks/<int:task_pk>", views.api_task_detail, name="api-task-detail"),
     path("api/tasks/<int:task_pk>/file", views.api_task_file, name="api-task-file"),
 
@@ -1,19 +1,25 @@
-import concurrent.futures
 import json
 import pathlib
+import typing
 
 import django.core.handlers.wsgi
-from django.db.models import Avg, Count, Q
+from django.db.models import F, Max, Q, Sum, Window
+from django.db.models.functions import RowNumber
 from django.http import FileResponse, HttpResponse, HttpResponseRedirect, JsonResponse
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
 from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
 
+import distributor.api
+import distributor.duplicates
 import distributor.models
+import distributor.scanner
+import distributor.scheduler
 import distributor.serializers
 import distributor.utilities
 
+import encodes.cost_model
 import encodes.models
 import encodes.serializers
 
@@ -21,12 +27,31 @@ from utils import config
 from utils import ffprobe
 from utils import log
 from utils import mkvtoolnix
-from utils import rabbit_handler
+
+
+########################################################################################################################
+# Global Values
+########################################################################################################################
+# Most recent tasks of each profile listed on the completed tasks page
+COMPLETED_TASKS_PER_PROFILE = 50
 
 
 ########################################################################################################################
 # Helpers
 ########################################################################################################################
+def _count_queued_in_profile(profile: encodes.models.Profile, tasks: typing.List[encodes.models.EncodeTask]) -> int:
+    """
+    Count the tasks of a profile already waiting in the queue, so fair-share scheduling can interleave profiles.
+
+    :param profile: profile to count the tasks of
+    :param tasks: tasks being queued, not counted
+    :return: number of queued tasks
+    """
+    return encodes.models.EncodeTask.objects.filter(
+        profile=profile, status=encodes.models.EncodeTask.TaskStatus.QUEUED
+    ).exclude(pk__in=[x.pk for x in tasks]).count()
+
+
 def _queue_task(task: encodes.models.EncodeTask, is_secure: bool = False) -> None:
     """
     Queue a task.  Creates and sends message to rabbitmq for processing by workers, then sets
@@ -42,13 +67,73 @@ def _queue_task(task: encodes.models.EncodeTask, is_secure: bool = False) -> Non
         "url": task.get_encode_task_url(is_secure=is_secure)
     }
 
+    queued_in_profile = _count_queued_in_profile(task.profile, [task])
+
+    cost = distributor.scheduler.estimate_encode_cost(task.source_file, task.profile.codec, task.profile.encoder_preset)
+    tier = distributor.scheduler.route_task(
+        "encode", task.source_file, cost,
+        codec=task.profile.codec, preset=task.profile.encoder_preset, profile_id=task.profile_id
+    )
+
     log.info("Queuing Encode Task [{}] - [{}]".format(task.pk, task.source_file.name))
-    rabbit_handler.send_message(message_data)
+    distributor.scheduler.schedule_task(
+        "encode", message_data, cost,
+        profile_priority=task.profile.priority, queued_in_group=queued_in_profile, tier=tier,
+        source_file=task.source_file
+    )
 
     task.status = task.TaskStatus.QUEUED
     task.save()
 
 
+def _queue_tasks_together(tasks: typing.List[encodes.models.EncodeTask], is_secure: bool = False) -> None:
+    """
+    Queue CRF tasks of the same source (e.g. one for each profile) as a single message, so one worker encodes them all
+    from a single decode of the source.  A lone task is queued on its own.
+
+    :param tasks: tasks to queue, all with the same source file and a CRF encode type
+    :param is_secure: whether we're using https or not
+    :return: None
+    """
+    if len(tasks) == 1:
+        _queue_task(tasks[0], is_secure=is_secure)
+        return
+
+    source_file = tasks[0].source_file
+    message_data = {
+        "type": "multi-encode",
+        "id": tasks[0].id,
+        "url": tasks[0].get_encode_task_url(is_secure=is_secure),
+        "ids": [x.id for x in tasks],
+        "urls": [x.get_encode_task_url(is_secure=is_secure) for x in tasks]
+    }
+
+    # The source is decoded once, but each task still gets its own encoder
+    costs = [
+        distributor.scheduler.estimate_encode_cost(source_file, x.profile.codec, x.profile.encoder_preset)
+        for x in tasks
+    ]
+    # Routed by the slowest encode, the others run alongside it
+    slowest_task = tasks[costs.index(max(costs))]
+    tier = distributor.scheduler.route_task(
+        "encode", source_file, sum(costs),
+        codec=slowest_task.profile.codec, preset=slowest_task.profile.encoder_preset,
+        profile_id=slowest_task.profile_id
+    )
+    queued_in_profile = _count_queued_in_profile(slowest_task.profile, tasks)
+
+    log.info("Queuing Encode Tasks [{}] - [{}]".format(",".join(str(x.pk) for x in tasks), source_file.name))
+    distributor.scheduler.schedule_task(
+        "encode", message_data, sum(costs),
+        profile_priority=max(x.profile.priority for x in tasks), queued_in_group=queued_in_profile, tier=tier,
+        source_file=source_file
+    )
+
+    encodes.models.EncodeTask.objects.filter(pk__in=[x.pk for x in tasks]).update(
+        status=encodes.models.EncodeTask.TaskStatus.QUEUED
+    )
+
+
 ########################################################################################################################
 # User Views
 ########################################################################################################################
@@ -64,11 +149,13 @@ def index(request):
         import_files = [x for x in import_directory.iterdir() if x.is_file() and x.name.endswith("mkv")]
 
         # Get all completed files in the output directory (which may not be in the DB)
-        output_files = [x for x in output_directory.rglob("*.mkv")]
+        output_file_names = set(x.name for x in output_directory.rglob("*.mkv"))
 
         # Get list of incomplete Jobs
         query = ~Q(status=encodes.models.EncodeTask.TaskStatus.COMPLETE)
-        pending_task_files = [x.source_file.name for x in encodes.models.EncodeTask.objects.filter(query)]
+        pending_task_files = set(
+            encodes.models.EncodeTask.objects.filter(query).values_list("source_file__name", flat=True)
+        )
         log.debug("Found [{}] queued encode tasks in DB".format(len(pending_task_files)))
 
         # Check if any pending jobs have the same file name as the scanned files
@@ -77,20 +164,26 @@ def index(request):
         # of an earlier encode task.
         files_to_scan = []
         for file in import_files:
-            if file.name not in pending_task_files and file.name not in [x.name for x in output_files]:
+            if file.name not in pending_task_files and file.name not in output_file_names:
                 files_to_scan.append(file)
 
-        log.debug("Scanning [{}] files not already queued".format(len(files_to_scan)))
+        # Same again by contents: a renamed (or copied) file that's already been queued or encoded isn't shown either.
+        # Files that haven't changed since they were last scanned are checked by their stored fingerprint first, so
+        # they aren't probed again just to be hidden.
+        task_fingerprints = set(
+            encodes.models.EncodeTask.objects.exclude(source_file__fingerprint="")
+            .values_list("source_file__fingerprint", flat=True)
+        )
+        unchanged_files = distributor.scanner.find_unchanged_files(files_to_scan)
+        files_to_scan = [
+            x for x in files_to_scan
+            if x not in unchanged_files or unchanged_files[x].fingerprint not in task_fingerprints
+        ]
 
-        files_information = []
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future_to_file = {executor.submit(distributor.utilities.create_file, x): x for x in files_to_scan}
-            for future in concurrent.futures.as_completed(future_to_file):
-                file_object = future.result()
-                if file_object:
-                    files_information.append(file_object)
+        log.debug("Scanning [{}] files not already queued".format(len(files_to_scan)))
 
-        files_information = sorted(files_information, key=lambda k: k.name)
+        files_information = distributor.utilities.scan_files(files_to_scan)
+        files_information = [x for x in files_information if x.fingerprint not in task_fingerprints]
 
         context = {
             "files": files_information,
@@ -106,29 +199,49 @@ def ingest(request):
     output_directory = config.load_output_directory()
 
     if request.method == "POST":
-        if not request.POST.get("profile"):
+        if not request.POST.getlist("profile"):
             return HttpResponse("Missing profile response", status=400)
-        profile = encodes.models.Profile.objects.filter(pk=request.POST.get("profile")).first()
+        profiles = list(encodes.models.Profile.objects.filter(pk__in=request.POST.getlist("profile")))
 
         for file in request.POST.getlist("files_to_scan"):
             log.debug("Scanning [{}]".format(file))
 
             full_file_path = pathlib.Path(import_directory, file)
             source_file = distributor.utilities.create_file(full_file_path)
+            duplicate_files = [source_file] + distributor.duplicates.get_duplicates(source_file)
+
+            crf_tasks = []
+            for profile in profiles:
+                # Never encode the same contents with the same profile twice, whatever the file is called now
+                duplicate_task = encodes.models.EncodeTask.objects.filter(
+                    profile=profile, source_file__in=duplicate_files
+                ).first()
+                if duplicate_task:
+                    log.warning("[{}] has the same contents as the source of task [{}], not encoding it again".format(
+                        file, duplicate_task.pk
+                    ))
+                    continue
+
+                compressed_file, created = distributor.models.File.objects.get_or_create(
+                    name=file,
+                    directory=str(output_directory.joinpath(profile.name)),
+                )
 
-            compressed_file, created = distributor.models.File.objects.get_or_create(
-                name=file,
-                directory=str(output_directory.joinpath(profile.name)),
-            )
+                task = encodes.models.EncodeTask.objects.create(
+                    source_file=source_file,
+                    compressed_file=compressed_file,
+                    profile=profile,
+                    encode_type=profile.encode_type,
+                    encode_value=profile.encode_value
+                )
+                # Two-pass encodes each need their own first pass, so only CRF encodes share a decode
+                if task.encode_type == "crf":
+                    crf_tasks.append(task)
+                else:
+                    _queue_task(task)
 
-            task = encodes.models.EncodeTask.objects.create(
-                source_file=source_file,
-                compressed_file=compressed_file,
-                profile=profile,
-                encode_type=profile.encode_type,
-                encode_value=profile.encode_value
-            )
-            _queue_task(task)
+            if crf_tasks:
+                _queue_tasks_together(crf_tasks)
 
         return HttpResponseRedirect(reverse("encodes:incomplete-tasks"))
     else:
@@ -136,29 +249,52 @@ def ingest(request):
 
 
 def completed_tasks(request):
-    # TODO: benchmark current implementation vs. task query per profile
-    relevant_tasks = encodes.models.EncodeTask.objects.filter(status=encodes.models.EncodeTask.TaskStatus.COMPLETE)
-    all_profiles = encodes.models.Profile.objects.all()
-    tasks_by_profile = {x.name: {} for x in all_profiles}
+    # Only the most recent tasks of each profile are listed; the totals come from `EncodeStatistics`, so the page
+    # doesn't load every task ever completed
+    relevant_tasks = encodes.models.EncodeTask.objects.filter(
+        status=encodes.models.EncodeTask.TaskStatus.COMPLETE
+    ).annotate(
+        profile_row=Window(
+            RowNumber(),
+            partition_by=[F("profile_id")],
+            order_by=[F("encode_end_datetime").desc(nulls_last=True), F("pk").desc()]
+        )
+    ).filter(profile_row__lte=COMPLETED_TASKS_PER_PROFILE).select_related("source_file", "compressed_file", "profile")
+    all_profiles = list(encodes.models.Profile.objects.all())
+
+    tasks_in_profile = {x.pk: [] for x in all_profiles}
+    for task in relevant_tasks:
+        tasks_in_profile[task.profile_id].append(task)
+
+    statistics_by_profile = {
+        x["profile_id"]: x
+        for x in encodes.models.EncodeStatistics.objects.values("profile_id").annotate(
+            completed_jobs=Sum("completed_tasks"), total_encode_framerate=Sum("total_encode_framerate")
+        ).order_by()
+    }
 
+    tasks_by_profile = {}
     for profile in all_profiles:
         profile_information: dict = {
             "id": profile.pk,
-            "jobs": [x for x in relevant_tasks if x.profile.pk == profile.pk],
+            "jobs": tasks_in_profile[profile.pk],
         }
 
-        if len(profile_information["jobs"]) > 0:
-            encode_rates = [x.encode_framerate for x in profile_information.get("jobs", [])]
+        profile_statistics = statistics_by_profile.get(profile.pk)
+        if profile_statistics and profile_statistics["completed_jobs"] > 0:
             profile_information["stats"] = {
-                "average_fps": round(sum(encode_rates) / len(profile_information["jobs"]), 2),
-                "completed_jobs": len(profile_information["jobs"]),
+                "average_fps": round(
+                    profile_statistics["total_encode_framerate"] / profile_statistics["completed_jobs"], 2
+                ),
+                "completed_jobs": profile_statistics["completed_jobs"],
             }
 
         tasks_by_profile[profile.name] = profile_information
 
     context = {
         "jobs_complete": tasks_by_profile,
-        "profile_tables": " ".join(["table_{}".format(x.id) for x in all_profiles])
+        "profile_tables": " ".join(["table_{}".format(x.id) for x in all_profiles]),
+        "tasks_per_profile": COMPLETED_TASKS_PER_PROFILE
     }
     return render(request, "encodes/encodes/completed.html", context)
 
@@ -174,11 +310,22 @@ def incomplete_tasks(request):
         encodes.models.EncodeTask.TaskStatus.UPLOADING
     ]
 
+    # Projected completion of each queued task and of the whole backlog, see `encodes.cost_model`
+    projection = encodes.cost_model.project_queue()
+    jobs_queued = list(
+        encodes.models.EncodeTask.objects.filter(status__in=queued_statuses).select_related("source_file", "profile")
+    )
+    for task in jobs_queued:
+        task.projected_completion = projection["tasks"][task.pk]["projected_completion"]
+
     # We create the `job_status_list` object as an easy way to get the display string for each enum
     # in a simple way.  I'm not married to this, but it gets the job done.
     context = {
-        "jobs_queued": encodes.models.EncodeTask.objects.filter(status__in=queued_statuses),
-        "jobs_in_progress": encodes.models.EncodeTask.objects.filter(status__in=in_progress_statuses),
+        "jobs_queued": jobs_queued,
+        "jobs_in_progress": encodes.models.EncodeTask.objects.filter(
+            status__in=in_progress_statuses
+        ).select_related("source_file", "profile"),
+        "projection": projection,
         "job_status": encodes.models.EncodeTask.TaskStatus,
         "job_status_list": json.dumps([x.label for x in encodes.models.EncodeTask.TaskStatus])
     }
@@ -193,26 +340,27 @@ def profiles(request):
 
 
 def worker_stats(request):
-    # NOTE: This was just for figuring out the encode rate of each worker.
-    # However, I think this would be useful as a stats page in the future.
-    # See how each worker performs, how many jobs they've completed, etc.
-    # For now, it's left here as a way to show aggregation and selection.
-
-    # TODO: Figure out a way to get the DB to spit this out.
-    relevant_jobs = encodes.models.EncodeTask.objects.filter(status=encodes.models.EncodeTask.TaskStatus.COMPLETE)
-    workers = [x["worker"] for x in relevant_jobs.values("worker").annotate(Count("id")).order_by()]
-    fps_by_worker = {}
-
+    statistics = encodes.models.EncodeStatistics.objects.all()
+
+    workers = statistics.values("worker").annotate(
+        completed_tasks=Sum("completed_tasks"),
+        total_frames=Sum("total_frames"),
+        total_duration=Sum("total_duration"),
+        total_encode_seconds=Sum("total_encode_seconds"),
+        total_encode_framerate=Sum("total_encode_framerate"),
+        last_completion_datetime=Max("last_completion_datetime")
+    ).order_by("worker")
     for worker in workers:
-        worker_jobs = relevant_jobs.filter(worker=worker)
-        fps_by_worker[worker] = float(worker_jobs.aggregate(Avg("encode_fps"))["encode_fps__avg"])
-
-    log.debug(fps_by_worker)
+        worker["average_fps"] = round(worker["total_encode_framerate"] / max(worker["completed_tasks"], 1), 2)
+        worker["encode_rate"] = 0.0
+        if worker["total_encode_seconds"] > 0:
+            worker["encode_rate"] = round(worker["total_duration"] / worker["total_encode_seconds"], 2)
 
     context = {
-        "profiles": encodes.models.Profile.objects.all()
+        "workers": workers,
+        "worker_profiles": statistics.select_related("profile").order_by("worker", "profile__name")
     }
-    return render(request, "encodes/profiles.html", context)
+    return render(request, "encodes/workers.html", context)
 
 
 ########################################################################################################################
@@ -226,15 +374,48 @@ def api_task_list(request):
             status=405
         )
 
-    tasks = encodes.models.EncodeTask.objects.all()
-    serializer = encodes.serializers.EncodeTaskSerializer(tasks, many=True)
-    return JsonResponse(serializer.data, safe=False, json_dumps_params={"indent": 2})
+    return distributor.api.list_response(
+        request, encodes.models.EncodeTask.objects.all(), encodes.serializers.TASK_LIST_FIELDS
+    )
 
 
 def api_tasks_in_progress(request):
-    tasks = encodes.models.EncodeTask.objects.all().exclude(status=encodes.models.EncodeTask.TaskStatus.COMPLETE)
-    serializer = encodes.serializers.EncodeTaskSerializer(tasks, many=True)
-    return JsonResponse(serializer.data, safe=False, json_dumps_params={"indent": 2})
+    if request.method != "GET":
+        return JsonResponse(
+            {"error": "this endpoint only supports GET requests, not [{}]".format(request.method)},
+            json_dumps_params={"indent": 2},
+            status=405
+        )
+
+    tasks = encodes.models.EncodeTask.objects.exclude(status=encodes.models.EncodeTask.TaskStatus.COMPLETE)
+    return distributor.api.list_response(request, tasks, encodes.serializers.TASK_LIST_FIELDS)
+
+
+def api_task_projection(request):
+    if request.method != "GET":
+        return JsonResponse(
+            {"error": "this endpoint only supports GET requests, not [{}]".format(request.method)},
+            json_dumps_params={"indent": 2},
+            status=405
+        )
+
+    projection = encodes.cost_model.project_queue()
+    return_data = {
+        "workers": projection["workers"],
+        "backlog_seconds": round(projection["backlog_seconds"]),
+        "backlog_completion": projection["backlog_completion"].isoformat(),
+        "tasks": [
+            {
+                "id": task_pk,
+                "worker": task_projection["worker"],
+                "start_seconds": round(task_projection["start_seconds"]),
+                "end_seconds": round(task_projection["end_seconds"]),
+                "projected_completion": task_projection["projected_completion"].isoformat()
+            }
+            for task_pk, task_projection in sorted(projection["tasks"].items(), key=lambda x: x[1]["end_seconds"])
+        ]
+    }
+    return JsonResponse(return_data, json_dumps_params={"indent": 2})
 
 
 @csrf_exempt
@@ -345,6 +526,8 @@ def api_task_file(request, task_pk: int):
             compressed_file.duration = file_information.duration
             compressed_file.frame_rate = round(eval(file_information.video_stream["avg_frame_rate"]), 3)
             compressed_file.frames = file_information.frames
+            compressed_file.width = file_information.width
+            compressed_file.height = file_information.height
             compressed_file.ffprobe_information = json.loads(str(file_information))
             compressed_file.save()
         else:
@@ -368,6 +551,7 @@ def api_task_file(request, task_pk: int):
             task.status = task.TaskStatus.COMPLETE
             task.encode_end_datetime = timezone.now()
             task.save()
+            encodes.models.EncodeStatistics.record_completion(task)
 
         if config.load_flags()["auto-delete"]:
             source_file.get_full_path().unlink(missing_ok=False)
@@ -390,6 +574,11 @@ def api_task_file(request, task_pk: int):
             task.seconds_remaining = -1
             task.encode_start_datetime = timezone.now()
             task.save()
+            distributor.models.Worker.objects.filter(hostname=task.worker).update(last_seen_datetime=timezone.now())
+
+        # A worker that already has the source (cached, or fetched for another task) only claims the task
+        if request.headers.get("Cached", None):
+            return JsonResponse({"success": "task claimed"}, json_dumps_params={"indent": 2})
         return FileResponse(open(pathlib.Path(task.source_file.directory, task.source_file.name), "rb"))
 
     return JsonResponse(
@@ -26,6 +26,7 @@ def main():
             "forget to activate a virtual environment?"
         ) from exc
     verify_directories()
+    config.install_reload_signal()
     execute_from_command_line(sys.argv)
 
 
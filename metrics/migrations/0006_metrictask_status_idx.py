@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-19 05:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metrics', '0005_alter_pooledmsssim_task_alter_pooledpsnr_task_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='metrictask',
+            index=models.Index(fields=['status'], name='metrictask_status_idx'),
+        ),
+    ]
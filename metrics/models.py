@@ -54,6 +54,9 @@ class MetricTask(models.Model):
 
     class Meta:
         verbose_name = "Metric Task"
+        indexes = [
+            models.Index(fields=["status"], name="metrictask_status_idx"),
+        ]
 
     def get_metrics_task_url(self, is_secure: bool = False) -> str:
         """
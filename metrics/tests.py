@@ -1,3 +1,72 @@
+from django.conf import settings
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 
-# Create your tests here.
+import distributor.models
+import metrics.models
+
+
+class ViewQueryCountTests(TestCase):
+    """
+    Every listing view runs the same number of queries however many tasks there are, see `encodes.tests`.
+    """
+
+    # Queries each view is allowed, whatever the number of tasks
+    EXPECTED_QUERIES = {
+        "metrics:tasks-incomplete": 2,
+        "metrics:tasks-completed": 1,
+        "metrics:api-task-list": 1,
+        "metrics:api-tasks-in-progress": 1,
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        settings.ALLOWED_HOSTS.append("testserver")
+
+    @classmethod
+    def tearDownClass(cls):
+        settings.ALLOWED_HOSTS.remove("testserver")
+        super().tearDownClass()
+
+    def _create_tasks(self, count: int) -> None:
+        statuses = list(metrics.models.MetricTask.TaskStatus)
+        for i in range(count):
+            source_file = distributor.models.File.objects.create(
+                name="source_{}.mkv".format(i), directory="/input", size=1000000, duration=60,
+                frame_rate=23.976, frames=1439, width=1920, height=1080
+            )
+            compressed_file = distributor.models.File.objects.create(
+                name="source_{}.mkv".format(i), directory="/output/profile", size=500000, duration=60,
+                frame_rate=23.976, frames=1439, width=1920, height=1080
+            )
+            task = metrics.models.MetricTask.objects.create(
+                source_file=source_file, compressed_file=compressed_file, status=statuses[i % len(statuses)],
+                worker="worker_{}".format(i % 3)
+            )
+            if task.status == metrics.models.MetricTask.TaskStatus.COMPLETE:
+                pooled_scores = [
+                    (metrics.models.PooledPSNR, 40),
+                    (metrics.models.PooledMSSSIM, 0.95),
+                    (metrics.models.PooledVMAF, 90)
+                ]
+                for model, score in pooled_scores:
+                    model.objects.create(
+                        task=task, min=score, one_percent_min=score, point_one_percent_min=score, max=score,
+                        mean=score, harmonic_mean=score
+                    )
+
+    def _count_queries(self, view_name: str) -> int:
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse(view_name))
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_query_counts(self):
+        for task_count in [1, 12]:
+            self._create_tasks(task_count)
+            for view_name, expected_queries in self.EXPECTED_QUERIES.items():
+                with self.subTest(view=view_name, tasks=metrics.models.MetricTask.objects.count()):
+                    self.assertEqual(self._count_queries(view_name), expected_queries)
@@ -9,6 +9,7 @@ from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
 
 import distributor.models
+import distributor.scheduler
 import distributor.utilities
 
 import metrics.models
@@ -16,7 +17,6 @@ import metrics.serializers
 
 from utils import config
 from utils import log
-from utils import rabbit_handler
 
 
 ########################################################################################################################
@@ -37,8 +37,18 @@ def _queue_task(task: metrics.models.MetricTask, is_secure: bool = False) -> Non
         "url": task.get_metrics_task_url(is_secure=is_secure)
     }
 
+    # Metrics tasks are all one group as far as fair-share scheduling is concerned.
+    queued_metrics_tasks = metrics.models.MetricTask.objects.filter(
+        status=metrics.models.MetricTask.TaskStatus.QUEUED
+    ).exclude(pk=task.pk).count()
+
+    cost = distributor.scheduler.estimate_metrics_cost(task.source_file, int(task.subsample_rate))
+    tier = distributor.scheduler.route_task("metrics", task.source_file, cost)
+
     log.info("Queuing Metrics Task [{}] - [{}]".format(task.pk, task.source_file.name))
-    rabbit_handler.send_message(message_data)
+    distributor.scheduler.schedule_task(
+        "metrics", message_data, cost, queued_in_group=queued_metrics_tasks, tier=tier, source_file=task.source_file
+    )
 
     task.status = task.TaskStatus.QUEUED
     task.save()
@@ -66,12 +76,12 @@ def index(request):
     distributor.utilities.scan_directory(config.load_output_directory())
 
     reference_files = []
-    for file in distributor.models.File.objects.filter(directory__iexact=str(config.load_input_directory())):
+    for file in distributor.models.File.objects.filter(directory=str(config.load_input_directory())):
         if file.get_full_path().exists() and file.get_full_path().stat().st_size == file.size:
             reference_files.append(file)
 
     compressed_files = []
-    for file in distributor.models.File.objects.filter(directory__istartswith=str(config.load_output_directory())):
+    for file in distributor.models.File.objects.filter(directory__startswith=str(config.load_output_directory())):
         if file.get_full_path().exists() and file.get_full_path().stat().st_size == file.size:
             compressed_files.append(file)
 
@@ -119,8 +129,12 @@ def tasks_incomplete(request):
     # We create the `job_status_list` object as an easy way to get the display string for each enum
     # in a simple way.  I'm not married to this, but it gets the job done.
     context = {
-        "jobs_queued": metrics.models.MetricTask.objects.filter(status__in=queued_statuses),
-        "jobs_in_progress": metrics.models.MetricTask.objects.filter(status__in=in_progress_statuses),
+        "jobs_queued": metrics.models.MetricTask.objects.filter(
+            status__in=queued_statuses
+        ).select_related("source_file", "compressed_file"),
+        "jobs_in_progress": metrics.models.MetricTask.objects.filter(
+            status__in=in_progress_statuses
+        ).select_related("source_file", "compressed_file"),
         "job_status": metrics.models.MetricTask.TaskStatus,
         "job_status_list": json.dumps([x.label for x in metrics.models.MetricTask.TaskStatus])
     }
@@ -130,7 +144,9 @@ def tasks_incomplete(request):
 def tasks_completed(request):
     # TODO: Fix the template and make this show task information
     # Then work on the task detail page so you can see more detailed information
-    completed_tasks = metrics.models.MetricTask.objects.filter(status=metrics.models.MetricTask.TaskStatus.COMPLETE)
+    completed_tasks = metrics.models.MetricTask.objects.filter(
+        status=metrics.models.MetricTask.TaskStatus.COMPLETE
+    ).select_related("source_file", "compressed_file", "pooledpsnr", "pooledmsssim", "pooledvmaf")
     context = {
         "completed_tasks": completed_tasks,
     }
@@ -164,13 +180,15 @@ def api_task_list(request):
             status=405
         )
 
-    tasks = metrics.models.MetricTask.objects.all()
+    tasks = metrics.models.MetricTask.objects.all().select_related("source_file", "compressed_file")
     serializer = metrics.serializers.MetricTaskSerializer(tasks, many=True)
     return JsonResponse(serializer.data, safe=False, json_dumps_params={"indent": 2})
 
 
 def api_tasks_in_progress(request):
-    tasks = metrics.models.MetricTask.objects.all().exclude(status=metrics.models.MetricTask.TaskStatus.COMPLETE)
+    tasks = metrics.models.MetricTask.objects.all().exclude(
+        status=metrics.models.MetricTask.TaskStatus.COMPLETE
+    ).select_related("source_file", "compressed_file")
     serializer = metrics.serializers.MetricTaskSerializer(tasks, many=True)
     return JsonResponse(serializer.data, safe=False, json_dumps_params={"indent": 2})
 
@@ -371,6 +389,7 @@ def api_task_source(request, task_pk: int):
             task.processing_framerate = 0.0
             task.seconds_remaining = -1
             task.save()
+            distributor.models.Worker.objects.filter(hostname=task.worker).update(last_seen_datetime=timezone.now())
         return FileResponse(open(pathlib.Path(task.source_file.directory, task.source_file.name), "rb"))
     else:
         return JsonResponse(
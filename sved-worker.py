@@ -1,14 +1,15 @@
 import json
 import math
+import multiprocessing
 import os
 import pathlib
 import platform
 import pika
 import requests
-import shlex
 import shutil
-import subprocess
+import threading
 import time
+import typing
 
 from utils import config
 from utils import ffmpeg
@@ -16,6 +17,10 @@ from utils import ffprobe
 from utils import log
 from utils import metrics
 from utils import mkvtoolnix
+from utils import progress
+from utils import rabbit_handler
+from utils import requests_handler
+from utils import source_cache
 
 
 # TODO: fix heartbeat / "rabbitmq closes connection too early because these are long af" issue
@@ -50,31 +55,276 @@ def _format_size(size_bytes: int) -> str:
     return "{}{}".format(s, size_name[i])
 
 
+# Slot number of this process when running more than one task at a time (see `run_slots`), None otherwise.
+WORKER_SLOT: typing.Optional[int] = None
+
+
 def _get_hostname() -> str:
     """
-    Get the hostname as defined in the environment variable HOSTNAME
+    Get the hostname as defined in the environment variable HOSTNAME.
+    Each slot of a multi-slot worker reports as its own worker, e.g. "hostname-slot2".
 
     :return: value of hostname environment variable
     """
-    return os.environ.get("HOSTNAME", platform.node())
+    hostname = os.environ.get("HOSTNAME", platform.node())
+    if WORKER_SLOT is not None:
+        hostname = "{}-slot{}".format(hostname, WORKER_SLOT)
+    return hostname
 
 
 def _get_temp_work_directory() -> pathlib.Path:
     """
-    Get the temporary directory for working files as defined by the environment variable WORKDIR
+    Get the temporary directory for working files as defined by the environment variable WORKDIR.
+    Each slot of a multi-slot worker gets its own subdirectory, since it's deleted after every task.
 
     :return: temp directory as a path
     """
     temp_directory = pathlib.Path(os.environ.get("WORKDIR", "sved-workdir"))
+    if WORKER_SLOT is not None:
+        temp_directory = temp_directory.joinpath("slot{}".format(WORKER_SLOT))
+
     if temp_directory.is_absolute():
         return temp_directory.resolve()
     else:
         return pathlib.Path.cwd().joinpath(temp_directory).resolve()
 
 
+_source_cache: typing.Optional[source_cache.SourceCache] = None
+
+
+def _get_source_cache() -> source_cache.SourceCache:
+    """
+    Get the cache of source files, shared by every slot on this machine (see `utils.source_cache`).
+
+    :return: source cache
+    """
+    global _source_cache
+    if _source_cache is None:
+        worker_config = config.load_worker_config()
+        _source_cache = source_cache.SourceCache(
+            worker_config["cache_directory"], int(worker_config["cache_size_gb"] * 1024 ** 3)
+        )
+    return _source_cache
+
+
+# First pass stats of two-pass encodes are kept next to the source cache, see `_encode_file_two_pass`.  They're a few
+# MB per hour of video, so this holds a lot of them.
+TWO_PASS_CACHE_BYTES = 2 * 1024 ** 3
+
+_two_pass_cache: typing.Optional[source_cache.SourceCache] = None
+
+
+def _get_two_pass_cache() -> source_cache.SourceCache:
+    """
+    Get the cache of first pass stats, turned off along with the source cache.
+
+    :return: two-pass stats cache
+    """
+    global _two_pass_cache
+    if _two_pass_cache is None:
+        worker_config = config.load_worker_config()
+        _two_pass_cache = source_cache.SourceCache(
+            # A sibling rather than a subdirectory, so its files don't count towards (or get evicted by) the source
+            # cache's limit
+            worker_config["cache_directory"].with_name("{}-two-pass".format(worker_config["cache_directory"].name)),
+            TWO_PASS_CACHE_BYTES if worker_config["cache_size_gb"] > 0 else 0
+        )
+    return _two_pass_cache
+
+
+def _get_two_pass_key(file_information: typing.Optional[dict], profile: dict) -> typing.Optional[str]:
+    """
+    Get the key first pass stats of a source are cached under.  The stats only depend on the source and the encoder
+    settings that change how frames are analyzed, not on the bitrate: the second pass rescales to whatever bitrate it's
+    given.
+
+    :param file_information: information about the source file from the manager
+    :param profile: profile of the encode
+    :return: cache key, None if the stats can't be cached
+    """
+    cache = _get_two_pass_cache()
+    source_key = cache.get_key(file_information) if file_information and cache.is_enabled() else None
+    if not source_key:
+        return None
+    return "{}-{}-{}-{}".format(
+        source_key, profile["codec"], profile["encoder_preset"], profile.get("encoder_tune", None) or "none"
+    )
+
+
+def _fetch_two_pass_logs(key: str, log_files: typing.List[pathlib.Path]) -> bool:
+    cache = _get_two_pass_cache()
+    # The stats log is required, the tree data is only there if the encoder settings use it
+    if not cache.fetch("{}-{}".format(key, 0), log_files[0]):
+        return False
+    for i, log_file in enumerate(log_files[1:], start=1):
+        cache.fetch("{}-{}".format(key, i), log_file)
+    return True
+
+
+def _store_two_pass_logs(key: str, log_files: typing.List[pathlib.Path]) -> None:
+    cache = _get_two_pass_cache()
+    for i, log_file in enumerate(log_files):
+        if log_file.exists():
+            cache.add("{}-{}".format(key, i), log_file)
+
+
+def _remove_two_pass_logs(key: str, log_files: typing.List[pathlib.Path]) -> None:
+    cache = _get_two_pass_cache()
+    for i in range(len(log_files)):
+        cache.remove("{}-{}".format(key, i))
+
+
+def report_cache_statistics() -> None:
+    """
+    Send the hit rate and contents of the source cache to the manager, along with the keys of the files in it so the
+    manager can send tasks on those files to this worker (see `distributor.scheduler.schedule_task`).
+
+    :return: None
+    """
+    worker_config = config.load_worker_config()
+    if not worker_config["manager_url"] or not _get_source_cache().is_enabled():
+        return
+
+    url = "{}{}".format(worker_config["manager_url"], "/distributor/api/workers/cache/")
+    cache_statistics = _get_source_cache().get_statistics()
+    heartbeat = dict(cache_statistics, inventory=_get_source_cache().get_keys())
+    try:
+        response = requests.post(url, data=json.dumps(heartbeat), headers={"worker": _get_hostname()})
+    except requests.exceptions.ConnectionError:
+        log.warning("Could not connect to manager at [{}]; not reporting cache statistics".format(url))
+        return
+
+    if response.status_code != 200:
+        log.warning("Reporting cache statistics to [{}] returned code [{}]".format(url, response.status_code))
+    else:
+        log.debug("Source cache statistics: {}".format(json.dumps(cache_statistics)))
+
+
+def start_heartbeat() -> threading.Event:
+    """
+    Report the source cache to the manager every `heartbeat_seconds` in the background, so the manager knows the
+    worker is still running and what it has cached even in the middle of a long task.
+
+    :return: event to set to stop the heartbeat
+    """
+    stop = threading.Event()
+
+    def run_heartbeat():
+        while not stop.wait(config.load_worker_config()["heartbeat_seconds"]):
+            try:
+                report_cache_statistics()
+            except Exception as e:
+                # A missed heartbeat isn't worth killing the worker over, the next one will probably make it
+                log.warning("Heartbeat failed: {}".format(e))
+
+    threading.Thread(target=run_heartbeat, name="heartbeat", daemon=True).start()
+    return stop
+
+
+def _get_cpus() -> typing.Set[int]:
+    """
+    Get the CPUs this process is allowed to run on.
+
+    :return: set of CPU numbers
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return os.sched_getaffinity(0)
+    return set(range(os.cpu_count()))
+
+
+def _get_thread_count() -> int:
+    """
+    Get the number of threads encoders (and VMAF) should use: the configured threads per slot,
+    or the number of CPUs this process is pinned to.
+
+    :return: thread count
+    """
+    return config.load_worker_config()["threads_per_slot"] or len(_get_cpus())
+
+
+def _has_avx512() -> bool:
+    """
+    Check if the CPU supports AVX-512, which x265 can use for a decent speedup at slower presets.
+    Only works on Linux, anything else is assumed to not support it.
+
+    :return: whether AVX-512 (foundation) is supported
+    """
+    cpu_info = pathlib.Path("/proc/cpuinfo")
+    if not cpu_info.exists():
+        return False
+    return " avx512f" in cpu_info.read_text()
+
+
+def _get_benchmarks(presets: typing.List[str]) -> dict:
+    """
+    Get the encode speed of this machine for each codec & preset.  These take a while to run at slower presets, so
+    results are saved next to the worker (like the VMAF models) and only re-run when the machine changes.
+
+    :param presets: presets to measure
+    :return: fps for each codec & preset, e.g. {"libx264": {"medium": 123.4}}
+    """
+    benchmark_file = pathlib.Path.cwd().joinpath("benchmarks.json")
+    machine = "{} ({} cores)".format(platform.processor() or platform.machine(), len(_get_cpus()))
+
+    benchmarks = {}
+    if benchmark_file.exists():
+        saved_benchmarks = json.loads(benchmark_file.read_text())
+        if saved_benchmarks.get("machine", "") == machine:
+            benchmarks = saved_benchmarks.get("results", {})
+
+    for codec in ["libx264", "libx265"]:
+        for preset in presets:
+            if preset in benchmarks.get(codec, {}):
+                continue
+            log.debug("Benchmarking [{}] [{}]".format(codec, preset))
+            benchmarks.setdefault(codec, {})[preset] = ffmpeg.benchmark_encoder(codec, preset)
+
+    benchmark_file.write_text(json.dumps({"machine": machine, "results": benchmarks}, indent=4))
+    return benchmarks
+
+
+def register_worker() -> typing.Optional[dict]:
+    """
+    Send this worker's capabilities to the manager, which responds with the worker's tier and the queues to consume.
+
+    :return: manager's response, or None if there's no manager configured or it couldn't be reached
+    """
+    worker_config = config.load_worker_config()
+    if not worker_config["manager_url"]:
+        log.debug("No manager URL configured; not registering worker")
+        return None
+
+    work_directory = _get_temp_work_directory()
+    work_directory.mkdir(exist_ok=True, parents=True)
+
+    capabilities = {
+        "hostname": _get_hostname(),
+        "cores": len(_get_cpus()),
+        "avx512": _has_avx512(),
+        "free_space": shutil.disk_usage(work_directory).free,
+        "benchmarks": _get_benchmarks(worker_config["benchmark_presets"])
+    }
+    log.debug("Worker capabilities: {}".format(json.dumps(capabilities)))
+
+    url = "{}{}".format(worker_config["manager_url"], "/distributor/api/workers/")
+    try:
+        response = requests.post(url, data=json.dumps(capabilities), headers={"worker": _get_hostname()})
+    except requests.exceptions.ConnectionError:
+        log.warning("Could not connect to manager at [{}]; not registering worker".format(url))
+        return None
+
+    if response.status_code != 200:
+        log.warning("Registering worker at [{}] returned code [{}]".format(url, response.status_code))
+        return None
+
+    return response.json()
+
+
 def _run_ffmpeg_command(command: str, frame_count: int, file_name: str,
                         callback_channel: pika.adapters.blocking_connection.BlockingChannel,
-                        file_framerate: float = None, report_to_sved=False, detail_url: str = None) -> None:
+                        file_framerate: float = None, report_to_sved=False,
+                        detail_url: str = None,
+                        extra_detail_urls: typing.List[str] = None) -> typing.Optional[typing.Dict[str, int]]:
     """
     Run an ffmpeg command.  Basically just the subprocess_handler run_command function,
     but with additional logic for handling ffmpeg output & sending status updates to the SVED manager.
@@ -86,114 +336,75 @@ def _run_ffmpeg_command(command: str, frame_count: int, file_name: str,
     :param file_framerate: optional parameter, provide this to calculate speed if ffmpeg returning 'N/A'
     :param report_to_sved: flag, whether to send updates to sved (if detail_url is defined)
     :param detail_url: URL to send updates to if report_to_sved is True
-    :return: None
+    :param extra_detail_urls: more URLs to send the same updates to, when one command encodes several tasks
+    :return: bytes written for each type of stream (see `ffmpeg.read_stream_sizes`), None if ffmpeg didn't say
     """
-    stdout = []
-    ffmpeg_output_parts = []
-    output_steps = []
-    in_progress = False  # Used so we can ignore output before we start running the task
-    hit_end = False
-
-    start_time = time.time()
+    tracker = progress.ProgressTracker(frame_count)
+    last_heartbeat = time.monotonic()
 
     log.debug(command)
-    process = subprocess.Popen(
-        shlex.split(command),
-        universal_newlines=True,
-        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-        encoding="utf-8", errors="backslashreplace"
-    )
-
-    while True:
-        output = process.stdout.readline().strip()
-        if output == "" and process.poll() is not None:
-            break
-
-        # Sending heartbeats while running long tasks
-        if int(time.time()) % 10 == 0:
-            callback_channel.connection.process_data_events()
-
-        stdout.append(output)
-        if output and not hit_end:
-            if not in_progress and "frame=" in output:
-                in_progress = True
-
-            if in_progress and "=" in output and output.count("=") == 1:
-                if output.startswith("["):
-                    if "frame=" in output:
-                        ffmpeg_output_parts.append(output.strip().split("] ")[1])
-                    continue
-                if " " in output.strip().split("=")[0]:
-                    continue
-
-                ffmpeg_output_parts.append(output)
-
-                if "progress=" in output:
-                    output_step = ffmpeg.format_ffmpeg_output(ffmpeg_output_parts, file_framerate=file_framerate)
-                    output_steps.append(output_step)
-
-                    remaining_frames = frame_count - output_step.frame
-                    if any([x.fps > 0 for x in output_steps]):
-                        average_eta = remaining_frames / (sum([x.fps for x in output_steps]) / len(output_steps))
-                        average_eta_string = ffmpeg.seconds_to_duration(average_eta)
-                    else:
-                        average_eta = -1
-                        average_eta_string = "?"
-
-                    log.debug(
-                        "{} | Avg. ETA: {:8s}".format(output_step.create_log_string(frame_count), average_eta_string)
-                    )
-                    ffmpeg_output_parts = []
-
-                    if any([x.fps > 0 for x in output_steps]):
-                        average_fps = sum([x.fps for x in output_steps]) / len(output_steps)
-                    else:
-                        average_fps = 0
-
-                    #  Send progress to SVED
-                    if report_to_sved and detail_url:
-                        data = {
-                            "progress": output_step.get_frame_as_percentage(frame_count),
-                            "fps": average_fps,
-                            "eta": average_eta
-                        }
-                        try:
-                            requests.post(detail_url, data=json.dumps(data), headers={"worker": _get_hostname()})
-                        except requests.exceptions.ConnectionError:
-                            log.warning("Could not send progress update to manager")
-
-                    if "progress=end" in output:
-                        hit_end = True
-
-    return_code = process.poll()
-    if return_code != 0:
-        if stdout:
-            log.debug(stdout)
-        raise RuntimeError("ffmpeg on [{}] returned code [{}]".format(file_name, return_code))
-
-    average_fps = sum([x.fps for x in output_steps]) / len(output_steps)
-    log.debug("Execution time: [{}]s (average FPS: [{}])".format(round(time.time() - start_time, 2), average_fps))
+    process = ffmpeg.FFmpegProcess(command, on_line=tracker.add_line)
 
+    reporters = []
     if report_to_sved and detail_url:
-        data = {
-            "fps": average_fps,
+        reporters = [
+            progress.ProgressReporter(x, headers={"worker": _get_hostname()})
+            for x in [detail_url] + (extra_detail_urls or [])
+        ]
+
+    final_update = None
+    try:
+        for output_step in process.read_progress(file_framerate=file_framerate):
+            tracker.update(output_step)
+
+            # Sending heartbeats while running long tasks
+            if time.monotonic() - last_heartbeat >= 10:
+                callback_channel.connection.process_data_events()
+                last_heartbeat = time.monotonic()
+
+            average_eta_string = ffmpeg.seconds_to_duration(tracker.eta) if tracker.eta >= 0 else "?"
+            log.debug("{} | Avg. ETA: {:8s}".format(output_step.create_log_string(frame_count), average_eta_string))
+
+            #  Send progress to SVED (in the background, the latest update replaces any that haven't been sent yet)
+            for reporter in reporters:
+                reporter.report({
+                    "progress": output_step.get_frame_as_percentage(frame_count),
+                    "fps": tracker.average_fps,
+                    "eta": tracker.eta
+                })
+
+        return_code = process.wait()
+        if return_code != 0:
+            if tracker.lines:
+                log.debug(list(tracker.lines))
+            raise RuntimeError("ffmpeg on [{}] returned code [{}]".format(file_name, return_code))
+
+        log.debug("Execution time: [{}]s (average FPS: [{}])".format(round(tracker.elapsed, 2), tracker.average_fps))
+        final_update = {
+            "fps": tracker.average_fps,
             "progress": 100.00,
             "eta": 0
         }
-        try:
-            requests.post(detail_url, data=json.dumps(data), headers={"worker": _get_hostname()})
-        except requests.exceptions.ConnectionError:
-            log.warning("Could not send completion update to manager")
+    finally:
+        # Whatever went wrong (the rabbitmq connection, parsing, a KeyboardInterrupt), ffmpeg and the reporter threads
+        # shouldn't outlive the task
+        process.kill()
+        for reporter in reporters:
+            reporter.close(final_update)
+            log.debug("Progress updates: {}".format(repr(reporter)))
+
+    return ffmpeg.read_stream_sizes(tracker.lines)
 
 
 def _encode_file_crf(input_file: pathlib.Path, output_file: pathlib.Path,
                      detail_url: str, crf: int, profile: dict,
-                     callback_channel: pika.adapters.blocking_connection.BlockingChannel) -> pathlib.Path:
+                     callback_channel: pika.adapters.blocking_connection.BlockingChannel) -> (pathlib.Path, int):
     file_info = ffprobe.get_file_info(input_file)
     encode_command, output_file = ffmpeg.create_crf_command(
         input_file, output_path=output_file,
         codec=profile["codec"], crf=crf,
-        preset=profile["encoder_preset"], tune=profile.get("encoder_tune", None)
+        preset=profile["encoder_preset"], tune=profile.get("encoder_tune", None),
+        threads=_get_thread_count(), include_audio=False
     )
 
     data = {
@@ -202,12 +413,12 @@ def _encode_file_crf(input_file: pathlib.Path, output_file: pathlib.Path,
         "encode_value": crf
     }
     try:
-        requests.post(detail_url, data=json.dumps(data), headers={"worker": _get_hostname()})
+        requests_handler.get_session().post(detail_url, data=json.dumps(data), headers={"worker": _get_hostname()})
     except requests.exceptions.ConnectionError:
         log.warning("Could not send completion update to manager")
 
     try:
-        _run_ffmpeg_command(
+        stream_sizes = _run_ffmpeg_command(
             encode_command, frame_count=file_info.frames, file_name=input_file.name,
             callback_channel=callback_channel, file_framerate=float(eval(file_info.video_stream["r_frame_rate"])),
             report_to_sved=True, detail_url=detail_url
@@ -221,18 +432,95 @@ def _encode_file_crf(input_file: pathlib.Path, output_file: pathlib.Path,
         raise RuntimeError("Encoding succeeded but the file doesn't exist!")
 
     log.debug("Encoded file size: [{}]".format(_format_size(output_file.stat().st_size)))
-    return output_file
+    return output_file, stream_sizes["video"] if stream_sizes else None
+
+
+def _encode_files_crf(input_file: pathlib.Path, encodes: typing.List[dict],
+                      callback_channel: pika.adapters.blocking_connection.BlockingChannel) -> typing.List[pathlib.Path]:
+    """
+    Encode a file for several tasks with one ffmpeg command, so the source is only decoded and filtered once.
+
+    :param input_file: file to encode
+    :param encodes: one dict per task, with its "profile" (including "encode_value") and "detail_url"
+    :param callback_channel: channel to send messages back to rabbitmq, to keep it from thinking we've disconnected
+    :return: encoded file of each task, in the same order
+    """
+    file_info = ffprobe.get_file_info(input_file)
+    outputs = [
+        {
+            "output_path": input_file.with_name("{}_compressed_{}.mkv".format(input_file.stem, i)),
+            "codec": x["profile"]["codec"],
+            "crf": x["profile"]["encode_value"],
+            "preset": x["profile"]["encoder_preset"],
+            "tune": x["profile"].get("encoder_tune", None)
+        }
+        for i, x in enumerate(encodes)
+    ]
+    encode_command = ffmpeg.create_multi_crf_command(
+        input_file, outputs, threads=_get_thread_count(), include_audio=False
+    )
+
+    for encode, output in zip(encodes, outputs):
+        data = {
+            "progress": 0.0,
+            "encode_type": "crf",
+            "encode_value": output["crf"]
+        }
+        try:
+            requests_handler.get_session().post(
+                encode["detail_url"], data=json.dumps(data), headers={"worker": _get_hostname()}
+            )
+        except requests.exceptions.ConnectionError:
+            log.warning("Could not send completion update to manager")
+
+    detail_urls = [x["detail_url"] for x in encodes]
+    try:
+        _run_ffmpeg_command(
+            encode_command, frame_count=file_info.frames, file_name=input_file.name,
+            callback_channel=callback_channel, file_framerate=float(eval(file_info.video_stream["r_frame_rate"])),
+            report_to_sved=True, detail_url=detail_urls[0], extra_detail_urls=detail_urls[1:]
+        )
+    except Exception as e:
+        input_file.unlink(missing_ok=True)
+        for output in outputs:
+            output["output_path"].unlink(missing_ok=True)
+        raise e
+
+    output_files = [x["output_path"] for x in outputs]
+    for output_file in output_files:
+        if not output_file.exists():
+            raise RuntimeError("Encoding succeeded but [{}] doesn't exist!".format(output_file.name))
+        log.debug("Encoded file size: [{}]".format(_format_size(output_file.stat().st_size)))
+
+    return output_files
 
 
 def _encode_file_two_pass(input_file: pathlib.Path, output_file: pathlib.Path,
                           detail_url: str, profile: dict,
-                          callback_channel: pika.adapters.blocking_connection.BlockingChannel) -> pathlib.Path:
+                          callback_channel: pika.adapters.blocking_connection.BlockingChannel,
+                          file_information: dict = None) -> (pathlib.Path, int):
+    """
+    Encode a file with two-pass ABR at the scene bitrate.
+
+    The first pass's stats are cached (see `_get_two_pass_key`), so encoding the same source with the same encoder
+    settings again (e.g. a re-queued task, or another profile) only runs the second pass.  If the second pass can't
+    use cached stats, they're thrown away and both passes run.
+
+    :param input_file: file to encode
+    :param output_file: encoded file
+    :param detail_url: URL of the task, for progress updates
+    :param profile: profile of the task
+    :param callback_channel: channel to send messages back to rabbitmq, to keep it from thinking we've disconnected
+    :param file_information: information about the source file from the manager, to cache the first pass's stats
+    :return: encoded file, and the size of its video stream if ffmpeg reported it
+    """
     file_info = ffprobe.get_file_info(input_file)
     file_bitrate = ffmpeg.get_bitrate_for_scene(input_file)
     analyze_command, encode_command, output_file = ffmpeg.create_two_pass_command(
         input_file, output_path=output_file,
         codec=profile["codec"], bitrate=file_bitrate,
-        preset=profile["encoder_preset"], tune=profile.get("encoder_tune", None)
+        preset=profile["encoder_preset"], tune=profile.get("encoder_tune", None),
+        threads=_get_thread_count(), include_audio=False
     )
 
     data = {
@@ -241,31 +529,55 @@ def _encode_file_two_pass(input_file: pathlib.Path, output_file: pathlib.Path,
         "encode_value": file_bitrate
     }
     try:
-        requests.post(detail_url, data=json.dumps(data), headers={"worker": _get_hostname()})
+        requests_handler.get_session().post(detail_url, data=json.dumps(data), headers={"worker": _get_hostname()})
     except requests.exceptions.ConnectionError:
         log.warning("Could not send completion update to manager")
 
-    try:
-        _run_ffmpeg_command(
-            analyze_command, frame_count=file_info.frames, file_name=input_file.name,
-            callback_channel=callback_channel, file_framerate=float(eval(file_info.video_stream["r_frame_rate"])),
-            report_to_sved=False
-        )
-        _run_ffmpeg_command(
-            encode_command, frame_count=file_info.frames, file_name=input_file.name,
-            callback_channel=callback_channel, file_framerate=float(eval(file_info.video_stream["r_frame_rate"])),
-            report_to_sved=True, detail_url=detail_url
-        )
-    except Exception as e:
-        input_file.unlink(missing_ok=True)
-        output_file.unlink(missing_ok=True)
-        raise e
+    file_framerate = float(eval(file_info.video_stream["r_frame_rate"]))
+    log_files = [pathlib.Path.cwd().joinpath(x) for x in ffmpeg.get_two_pass_log_files(input_file, profile["codec"])]
+    stats_key = _get_two_pass_key(file_information, profile)
+
+    stream_sizes = None
+    encoded = False
+    if stats_key and _fetch_two_pass_logs(stats_key, log_files):
+        log.debug("Reusing cached first pass stats of [{}]".format(input_file.name))
+        try:
+            stream_sizes = _run_ffmpeg_command(
+                encode_command, frame_count=file_info.frames, file_name=input_file.name,
+                callback_channel=callback_channel, file_framerate=file_framerate,
+                report_to_sved=True, detail_url=detail_url
+            )
+            encoded = True
+        except RuntimeError:
+            log.warning("Second pass of [{}] failed with cached stats; running both passes".format(input_file.name))
+            _remove_two_pass_logs(stats_key, log_files)
+            ffmpeg.delete_two_pass_logs(pathlib.Path.cwd(), input_file)
+            output_file.unlink(missing_ok=True)
+
+    if not encoded:
+        try:
+            _run_ffmpeg_command(
+                analyze_command, frame_count=file_info.frames, file_name=input_file.name,
+                callback_channel=callback_channel, file_framerate=file_framerate,
+                report_to_sved=False
+            )
+            if stats_key:
+                _store_two_pass_logs(stats_key, log_files)
+            stream_sizes = _run_ffmpeg_command(
+                encode_command, frame_count=file_info.frames, file_name=input_file.name,
+                callback_channel=callback_channel, file_framerate=file_framerate,
+                report_to_sved=True, detail_url=detail_url
+            )
+        except Exception as e:
+            input_file.unlink(missing_ok=True)
+            output_file.unlink(missing_ok=True)
+            raise e
 
     if not output_file.exists():
         raise RuntimeError("Encoding succeeded but the file doesn't exist!")
 
     log.debug("Encoded file size: [{}]".format(_format_size(output_file.stat().st_size)))
-    return output_file
+    return output_file, stream_sizes["video"] if stream_sizes else None
 
 
 def download_file(url: str, file_name: str) -> pathlib.Path:
@@ -303,52 +615,195 @@ def download_file(url: str, file_name: str) -> pathlib.Path:
     return local_file_path
 
 
+def claim_task_file(url: str) -> None:
+    """
+    Tell the manager a task was picked up without downloading its source file, e.g. because it's already here.
+
+    :param url: task's file URL
+    :return: None
+    """
+    response = requests.get(url, headers={"worker": _get_hostname(), "cached": "true"})
+    if response.status_code != 200:
+        log.warning("Claiming task at [{}] returned code [{}]".format(url, response.status_code))
+
+
+def fetch_source_file(url: str, file_name: str, file_information: dict, claim_task: bool = False) -> pathlib.Path:
+    """
+    Get a source file from the source cache, or download it (and add it to the cache) if it isn't there.
+
+    :param url: URL of the file to download
+    :param file_name: string to name the file
+    :param file_information: information about the file from the manager, with its ID, size and fingerprint
+    :param claim_task: if set, `url` is a task's file URL, which is still requested on a cache hit (without sending the
+                       file) so the manager knows the task was picked up
+    :return: path to the file
+    """
+    local_file_path = _get_temp_work_directory().joinpath(file_name)
+    local_file_path.parent.mkdir(exist_ok=True, parents=True)
+
+    cache = _get_source_cache()
+    cache_key = cache.get_key(file_information) if cache.is_enabled() else None
+    if cache_key and cache.fetch(cache_key, local_file_path):
+        if claim_task:
+            claim_task_file(url)
+        return local_file_path
+
+    local_file_path = download_file(url, file_name)
+    if cache_key:
+        cache.add(cache_key, local_file_path)
+        # Right away rather than on the next heartbeat, the manager queues the metrics task as soon as the encode is
+        # uploaded
+        report_cache_statistics()
+    return local_file_path
+
+
+def _passes_scene_rules(input_file: pathlib.Path, output_file: pathlib.Path, video_stream_size: int = None) -> bool:
+    """
+    Check an encode against scene rules, using the video stream size ffmpeg reported if there is one.  Only if there
+    isn't are statistics calculated from the output file (which means reading all of it).
+
+    :param input_file: file that was encoded
+    :param output_file: encoded file
+    :param video_stream_size: size of the encoded video stream, None if unknown
+    :return: whether the encoded file passes scene rules or not
+    """
+    if video_stream_size is None:
+        mkvtoolnix.add_media_statistics(output_file)
+    return ffmpeg.passes_scene_rules(input_file, output_file, video_stream_size=video_stream_size)
+
+
+def _start_audio_transcode(input_file: pathlib.Path) -> ffmpeg.AudioTranscode:
+    return ffmpeg.AudioTranscode(input_file, _get_temp_work_directory().joinpath("audio")).start()
+
+
+def _mux_audio(video_file: pathlib.Path, audio_files: typing.List[pathlib.Path]) -> pathlib.Path:
+    """
+    Add separately encoded audio tracks to an encoded video, replacing it.  mkvmerge writes statistics tags for every
+    track as it muxes, so the result has them without another read of the file.
+
+    :param video_file: encoded video (and subtitles)
+    :param audio_files: audio sidecar files, in track order
+    :return: path to the muxed file (the same as the video's)
+    """
+    if not audio_files:
+        return video_file
+
+    muxed_file = video_file.with_name("{}_muxed.mkv".format(video_file.stem))
+    mkvtoolnix.mux_tracks(video_file, audio_files, muxed_file)
+    muxed_file.replace(video_file)
+    ffprobe.invalidate_file_info(video_file)
+    return video_file
+
+
 def encode_file(input_file: pathlib.Path, profile: dict, detail_url: str,
-                callback_channel: pika.adapters.blocking_connection.BlockingChannel) -> (pathlib.Path, int, int):
+                callback_channel: pika.adapters.blocking_connection.BlockingChannel,
+                encoded_file: pathlib.Path = None,
+                audio_transcode: ffmpeg.AudioTranscode = None,
+                file_information: dict = None) -> pathlib.Path:
+    """
+    Encode a file with a profile, re-encoding at higher CRFs (then with two-pass ABR) until it passes scene rules.
+
+    Audio is encoded once in the background while the video encodes, then muxed in at the end, so the retries only
+    redo the video.
+
+    :param input_file: file to encode
+    :param profile: profile of the task, with the task's "encode_type" and "encode_value"
+    :param detail_url: URL of the task, for progress updates
+    :param callback_channel: channel to send messages back to rabbitmq, to keep it from thinking we've disconnected
+    :param encoded_file: file already encoded with the profile's CRF (see `encode_files`), only checked and retried
+    :param audio_transcode: audio encode already started for the file, to share it between tasks of the same file
+    :param file_information: information about the source file from the manager, to cache two-pass stats
+    :return: encoded file
+    """
     crf = profile["encode_value"]
 
     output_file = input_file.with_name("{}_compressed.mkv".format(input_file.stem))
 
-    if profile["encode_type"] == "abr":
-        output_file = _encode_file_two_pass(
-            input_file=input_file, output_file=output_file,
-            detail_url=detail_url, profile=profile, callback_channel=callback_channel
-        )
-    else:
-        output_file = _encode_file_crf(
-            input_file=input_file, output_file=output_file,
-            detail_url=detail_url, crf=crf, profile=profile, callback_channel=callback_channel
-        )
+    own_audio_transcode = audio_transcode is None
+    if own_audio_transcode:
+        audio_transcode = _start_audio_transcode(input_file)
 
-    mkvtoolnix.add_media_statistics(output_file)
-    compressed_file_passes_scene_rules = ffmpeg.passes_scene_rules(input_file, output_file)
-    while not compressed_file_passes_scene_rules:
-        log.warning("Output does not pass scene rules")
-        # TODO: send a request to the manager and track what encode we're on (e.g. attempt 3, attempt 4, etc.)
-        if crf == 24:
-            log.debug("Reached max CRF of 24; Encoding using ABR 2 Pass")
-            output_file = _encode_file_two_pass(
+    try:
+        if encoded_file:
+            output_file = encoded_file.replace(output_file)
+            video_stream_size = None
+        elif profile["encode_type"] == "abr":
+            output_file, video_stream_size = _encode_file_two_pass(
                 input_file=input_file, output_file=output_file,
-                detail_url=detail_url, profile=profile, callback_channel=callback_channel
+                detail_url=detail_url, profile=profile, callback_channel=callback_channel,
+                file_information=file_information
             )
-            break
         else:
-            crf += 1
-            log.debug("Attempting an encode at [{}]".format(crf))
-            output_file = _encode_file_crf(
+            output_file, video_stream_size = _encode_file_crf(
                 input_file=input_file, output_file=output_file,
                 detail_url=detail_url, crf=crf, profile=profile, callback_channel=callback_channel
             )
 
-        mkvtoolnix.add_media_statistics(output_file)
-        compressed_file_passes_scene_rules = ffmpeg.passes_scene_rules(input_file, output_file)
+        compressed_file_passes_scene_rules = _passes_scene_rules(input_file, output_file, video_stream_size)
+        while not compressed_file_passes_scene_rules:
+            log.warning("Output does not pass scene rules")
+            # TODO: send a request to the manager and track what encode we're on (e.g. attempt 3, attempt 4, etc.)
+            if crf == 24:
+                log.debug("Reached max CRF of 24; Encoding using ABR 2 Pass")
+                output_file, video_stream_size = _encode_file_two_pass(
+                    input_file=input_file, output_file=output_file,
+                    detail_url=detail_url, profile=profile, callback_channel=callback_channel,
+                    file_information=file_information
+                )
+                break
+            else:
+                crf += 1
+                log.debug("Attempting an encode at [{}]".format(crf))
+                output_file, video_stream_size = _encode_file_crf(
+                    input_file=input_file, output_file=output_file,
+                    detail_url=detail_url, crf=crf, profile=profile, callback_channel=callback_channel
+                )
+
+            compressed_file_passes_scene_rules = _passes_scene_rules(input_file, output_file, video_stream_size)
 
-    ffmpeg.delete_two_pass_logs(pathlib.Path.cwd())
-    mkvtoolnix.add_media_statistics(output_file)
+        ffmpeg.delete_two_pass_logs(pathlib.Path.cwd(), input_file)
 
+        output_file = _mux_audio(output_file, audio_transcode.wait())
+    finally:
+        # Stops the audio encodes if anything failed, otherwise just deletes the sidecars now they're muxed
+        if own_audio_transcode:
+            audio_transcode.cancel()
+
+    # No separate statistics pass over the output: mkvmerge wrote statistics tags while muxing the audio, and anything
+    # that needs them for a file without audio adds them itself (see `mkvtoolnix.add_media_statistics_if_necessary`)
     return output_file
 
 
+def encode_files(input_file: pathlib.Path, encodes: typing.List[dict],
+                 callback_channel: pika.adapters.blocking_connection.BlockingChannel,
+                 file_information: dict = None) -> typing.List[pathlib.Path]:
+    """
+    Encode a file for several CRF tasks (e.g. one per profile) in a single pass over the source.  Any encode that
+    doesn't pass scene rules is retried on its own, as `encode_file` would.  The audio is encoded once for all of them.
+
+    :param input_file: file to encode
+    :param encodes: one dict per task, with its "profile" (including "encode_type"/"encode_value") and "detail_url"
+    :param callback_channel: channel to send messages back to rabbitmq, to keep it from thinking we've disconnected
+    :param file_information: information about the source file from the manager, to cache two-pass stats
+    :return: encoded file of each task, in the same order
+    """
+    audio_transcode = _start_audio_transcode(input_file)
+    try:
+        encoded_files = _encode_files_crf(input_file, encodes, callback_channel)
+
+        output_files = []
+        for encode, encoded_file in zip(encodes, encoded_files):
+            output_file = encode_file(
+                input_file, encode["profile"], encode["detail_url"], callback_channel,
+                encoded_file=encoded_file, audio_transcode=audio_transcode, file_information=file_information
+            )
+            # Each task's final output gets its own name, the next one's checks and retries use `encode_file`'s name
+            output_files.append(output_file.replace(encoded_file))
+    finally:
+        audio_transcode.cancel()
+    return output_files
+
+
 def upload_file(url: str, file_path: pathlib.Path) -> None:
     log.info("Uploading [{}] to [{}]".format(str(file_path), url))
     headers = {
@@ -384,7 +839,8 @@ def calculate_metrics(reference_file: pathlib.Path, compressed_file: pathlib.Pat
     metrics_command = metrics.create_metrics_command(
         reference_file, compressed_file,
         neg_mode=neg_mode, subsample_rate=subsample_rate,
-        psnr=calculate_psnr, ms_ssim=calculate_ms_ssim
+        psnr=calculate_psnr, ms_ssim=calculate_ms_ssim,
+        threads=_get_thread_count()
     )
 
     file_info = ffprobe.get_file_info(reference_file)
@@ -402,20 +858,16 @@ def calculate_metrics(reference_file: pathlib.Path, compressed_file: pathlib.Pat
     return report_file
 
 
-def callback(callback_channel: pika.adapters.blocking_connection.BlockingChannel, method: pika.spec.Basic.Deliver,
-             properties: pika.spec.BasicProperties, body: bytes) -> None:
-
-    # Get the message and do work
-    decoded_message = json.loads(body.decode())
-
-    task_type = decoded_message.get("type", "")
-    log.info("Task [{}] [{}] pulled from queue, beginning processing".format(task_type, decoded_message["id"]))
+def get_task_information(url: str) -> dict:
+    """
+    Get the information about a task from the manager.
 
-    response = requests.get(decoded_message["url"])
+    :param url: URL of the task
+    :return: task information
+    """
+    response = requests.get(url)
     if response.status_code != 200:
-        log.warning(
-            "Received status code [{}] from request to [{}]".format(response.status_code, decoded_message["url"])
-        )
+        log.warning("Received status code [{}] from request to [{}]".format(response.status_code, url))
         if response.text:
             if "<html" in response.text:
                 html_file = _get_temp_work_directory().joinpath("error.html")
@@ -425,27 +877,70 @@ def callback(callback_channel: pika.adapters.blocking_connection.BlockingChannel
                     f.write(response.text)
             else:
                 log.debug("Response text: [{}]".format(response.text))
-        raise RuntimeError("Request to [{}] returned code [{}]".format(decoded_message["url"], response.status_code))
+        raise RuntimeError("Request to [{}] returned code [{}]".format(url, response.status_code))
+
+    return response.json()
 
-    task_information = response.json()
+
+def callback(callback_channel: pika.adapters.blocking_connection.BlockingChannel, method: pika.spec.Basic.Deliver,
+             properties: pika.spec.BasicProperties, body: bytes) -> None:
+
+    # Get the message and do work
+    decoded_message = json.loads(body.decode())
+
+    task_type = decoded_message.get("type", "")
+    log.info("Task [{}] [{}] pulled from queue, beginning processing".format(task_type, decoded_message["id"]))
+
+    task_information = get_task_information(decoded_message["url"])
 
     if task_type == "encode":
-        input_file = download_file(
+        input_file = fetch_source_file(
             task_information["encode_task_file_url_field"],
-            task_information["source_file"]["name"]
+            task_information["source_file"]["name"],
+            task_information["source_file"],
+            claim_task=True
         )
 
         profile = task_information["profile"]
         profile["encode_type"] = task_information["encode_type"]
         profile["encode_value"] = task_information["encode_value"]
 
-        output_file = encode_file(input_file, profile, decoded_message["url"], callback_channel)
+        output_file = encode_file(
+            input_file, profile, decoded_message["url"], callback_channel,
+            file_information=task_information["source_file"]
+        )
         upload_file(task_information["encode_task_file_url_field"], output_file)
 
+    elif task_type == "multi-encode":
+        # Several encode tasks of the same source (e.g. one for each profile), all encoded from a single decode
+        tasks_information = [task_information] + [get_task_information(x) for x in decoded_message["urls"][1:]]
+        input_file = fetch_source_file(
+            task_information["encode_task_file_url_field"],
+            task_information["source_file"]["name"],
+            task_information["source_file"],
+            claim_task=True
+        )
+        for other_task_information in tasks_information[1:]:
+            claim_task_file(other_task_information["encode_task_file_url_field"])
+
+        encodes = []
+        for url, information in zip(decoded_message["urls"], tasks_information):
+            profile = information["profile"]
+            profile["encode_type"] = information["encode_type"]
+            profile["encode_value"] = information["encode_value"]
+            encodes.append({"profile": profile, "detail_url": url})
+
+        output_files = encode_files(
+            input_file, encodes, callback_channel, file_information=task_information["source_file"]
+        )
+        for information, output_file in zip(tasks_information, output_files):
+            upload_file(information["encode_task_file_url_field"], output_file)
+
     elif task_type == "metrics":
         file_stem = task_information["source_file"]["name"].split(".mkv")[0]
-        reference_file = download_file(
-            task_information["source_file_url_field"], "{}_reference.mkv".format(file_stem)
+        reference_file = fetch_source_file(
+            task_information["source_file_url_field"], "{}_reference.mkv".format(file_stem),
+            task_information["source_file"]
         )
         compressed_file = download_file(
             task_information["compressed_file_url_field"], "{}_compressed.mkv".format(file_stem)
@@ -466,26 +961,63 @@ def callback(callback_channel: pika.adapters.blocking_connection.BlockingChannel
     else:
         raise ValueError("Message in queue has unexpected task type: [{}]".format(task_type))
 
+    # Sources stay in the source cache for the next task that needs them
     log.debug("Deleting input and output files")
     shutil.rmtree(_get_temp_work_directory())
 
     # Acknowledge the completed work, removing it from the rabbitmq queue
     callback_channel.basic_ack(delivery_tag=method.delivery_tag)
+    report_cache_statistics()
     log.info("Task [{}] [{}] processed; waiting for new tasks".format(task_type, decoded_message["id"]))
 
 
-if __name__ == "__main__":
+def run_worker() -> None:
+    """
+    Connect to rabbitmq and process tasks until interrupted.
+
+    :return: None
+    """
     # Setup connection
-    connection = pika.BlockingConnection(pika.ConnectionParameters(config.load_rabbitmq_config()["broker"]))
+    rabbitmq_config = config.load_rabbitmq_config()
+    connection = pika.BlockingConnection(pika.ConnectionParameters(rabbitmq_config["broker"]))
     channel = connection.channel()
 
     # Don't let rabbitmq send more than one message to a worker at a time.
-    channel.basic_qos(prefetch_count=1)
+    # This is channel-wide (global) since we consume from more than one queue.
+    channel.basic_qos(prefetch_count=1, global_qos=True)
+
+    # The manager decides which queues to consume based on what this machine can do.  Without a manager to ask,
+    # just consume the default queue of each task type.
+    registration = register_worker()
+    if registration:
+        log.info("Registered with manager as a [{}] tier worker".format(registration["tier"]))
+        worker_queues = registration["queues"]
+        # This worker's own queues, for tasks on files in its source cache.  Tasks expire from them into the tier
+        # queues after `affinity_seconds`, both have to be part of the declaration.
+        affinity_queues = registration.get("affinity_queues", {})
+        affinity_seconds = registration.get("affinity_seconds")
+    else:
+        worker_queues = {x: [rabbitmq_config["{}_queue".format(x)]] for x in ["encode", "metrics"]}
+        affinity_queues = {}
+        affinity_seconds = None
+
+    # Setup to receive messages, from each queue of the task types this worker handles
+    for task_type in config.load_worker_config()["task_types"]:
+        for queue, dead_letter_queue in affinity_queues.get(task_type, {}).items():
+            rabbit_handler.declare_queue(
+                channel, queue, dead_letter_queue=dead_letter_queue, message_ttl_seconds=affinity_seconds
+            )
+            channel.basic_consume(queue=queue, auto_ack=False, on_message_callback=callback)
+            log.debug("Consuming [{}] tasks on cached files from [{}]".format(task_type, queue))
+        for queue in worker_queues[task_type]:
+            rabbit_handler.declare_queue(channel, queue)
+            channel.basic_consume(queue=queue, auto_ack=False, on_message_callback=callback)
+            log.debug("Consuming [{}] tasks from [{}]".format(task_type, queue))
 
-    # Setup to receive messages
-    channel.basic_consume(queue=config.load_rabbitmq_config()["queue"], auto_ack=False, on_message_callback=callback)
+    report_cache_statistics()
+    stop_heartbeat = start_heartbeat() if registration else None
 
-    log.info("Ready to receive work!")
+    log.info("[{}] ready to receive work!".format(_get_hostname()))
 
     # Infinite loop of waiting for messages
     try:
@@ -493,3 +1025,80 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         log.debug("Interrupted")
         connection.close()
+    finally:
+        if stop_heartbeat:
+            stop_heartbeat.set()
+
+
+def _run_slot(slot: int, cpus: typing.Set[int]) -> None:
+    """
+    Entry point of a slot process: pin it to its CPUs, give it its own working directory, then process tasks.
+
+    Anything relative to the working directory (two-pass logs, VMAF reports & models, benchmarks) is per slot,
+    so slots working on files with the same name don't step on each other.
+
+    :param slot: slot number
+    :param cpus: CPUs to pin the slot (and every ffmpeg it runs) to
+    :return: None
+    """
+    global WORKER_SLOT
+    WORKER_SLOT = slot
+
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    else:
+        log.warning("CPU pinning isn't supported on this platform; slot [{}] can use any CPU".format(slot))
+
+    slot_directory = pathlib.Path.cwd().joinpath("slot{}".format(slot))
+    slot_directory.mkdir(exist_ok=True, parents=True)
+    os.chdir(slot_directory)
+
+    log.info("Slot [{}] pinned to CPUs [{}]".format(slot, ",".join([str(x) for x in sorted(cpus)])))
+    run_worker()
+
+
+def run_slots(slot_count: int) -> None:
+    """
+    Run several workers on this machine, each in its own process pinned to an equal share of the CPUs.
+
+    x264 and x265 stop scaling well somewhere past 16 threads at 1080p, so a big machine gets more done running a few
+    encodes side by side than one encode with every core.
+
+    :param slot_count: number of slots to run
+    :return: None
+    """
+    cpus = sorted(_get_cpus())
+    if slot_count > len(cpus):
+        raise ValueError("Can't run [{}] slots on [{}] CPUs".format(slot_count, len(cpus)))
+
+    # Contiguous blocks of CPUs, with any remainder spread over the first slots
+    cpus_per_slot, remainder = divmod(len(cpus), slot_count)
+    processes = []
+    start = 0
+    for slot in range(1, slot_count + 1):
+        end = start + cpus_per_slot + (1 if slot <= remainder else 0)
+        process = multiprocessing.Process(
+            target=_run_slot, args=(slot, set(cpus[start:end])), name="slot{}".format(slot)
+        )
+        process.start()
+        processes.append(process)
+        start = end
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        log.debug("Interrupted; waiting for slots to stop")
+        for process in processes:
+            process.join()
+
+
+if __name__ == "__main__":
+    config.install_reload_signal()
+    # Before slots change their working directory, so they all share the same cache
+    _get_source_cache()
+    worker_slots = config.load_worker_config()["slots"]
+    if worker_slots > 1:
+        run_slots(worker_slots)
+    else:
+        run_worker()
@@ -0,0 +1,61 @@
+import pathlib
+
+from utils import config
+
+
+ENGINES = {
+    "sqlite": "django.db.backends.sqlite3",
+    "postgresql": "django.db.backends.postgresql"
+}
+
+
+def get_databases(default_sqlite_path: pathlib.Path) -> dict:
+    """
+    Build Django's `DATABASES` setting from the database config, see `utils.config.load_database_config`.
+
+    :param default_sqlite_path: SQLite database file to use if the config doesn't name one
+    :return: `DATABASES` setting with the default database
+    """
+    database_config = config.load_database_config()
+
+    database = {
+        "ENGINE": ENGINES[database_config["engine"]],
+        "CONN_MAX_AGE": database_config["conn_max_age"],
+        # Connections kept open are checked before being reused, so a restarted database server isn't an error
+        "CONN_HEALTH_CHECKS": database_config["conn_max_age"] > 0
+    }
+
+    if database_config["engine"] == "sqlite":
+        database["NAME"] = pathlib.Path(database_config["name"] or default_sqlite_path)
+        # How long sqlite3 retries a locked database before raising "database is locked" (its busy timeout)
+        database["OPTIONS"] = {"timeout": database_config["busy_timeout"]}
+        # Set on every connection by `configure_connection`
+        database["PRAGMAS"] = {"journal_mode": database_config["journal_mode"]}
+        if database_config["journal_mode"] == "wal":
+            # Safe with WAL (a crash can't corrupt the database, a power cut loses at most the latest commits), and
+            # saves an fsync on every commit
+            database["PRAGMAS"]["synchronous"] = "normal"
+    else:
+        database["NAME"] = database_config["name"]
+        for key in ["host", "port", "user", "password"]:
+            if database_config[key]:
+                database[key.upper()] = str(database_config[key])
+
+    return {"default": database}
+
+
+def configure_connection(sender, connection, **kwargs) -> None:
+    """
+    Set the `PRAGMAS` of a SQLite database on each new connection.  Connected to Django's `connection_created` signal
+    in `distributor.apps.DistributorConfig`.
+
+    :param sender: database wrapper class
+    :param connection: new connection
+    :return: None
+    """
+    if connection.vendor != "sqlite":
+        return
+
+    with connection.cursor() as cursor:
+        for pragma, value in connection.settings_dict.get("PRAGMAS", {}).items():
+            cursor.execute("PRAGMA {} = {}".format(pragma, value))
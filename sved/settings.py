@@ -15,6 +15,8 @@ import pathlib
 import platform
 import socket
 
+from sved import database
+
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = pathlib.Path(__file__).resolve().parent.parent
@@ -84,13 +86,9 @@ WSGI_APPLICATION = 'sved.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
+# SQLite in the repository by default, see `utils.config.load_database_config` for using Postgres instead
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
-}
+DATABASES = database.get_databases(BASE_DIR / 'db.sqlite3')
 
 
 # Password validation
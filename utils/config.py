@@ -1,9 +1,21 @@
+import copy
+import functools
 import json
 import os
 import pathlib
+import signal
+import threading
+import time
+import typing
 
 
-CONFIG = dict()
+# Seconds between checks of whether the config file changed.  Between checks, settings come straight from memory.
+RELOAD_CHECK_SECONDS = 5.0
+
+# Flags with their defaults, see `Config.flags`
+FLAG_DEFAULTS = {
+    "auto-delete": False
+}
 
 
 def _get_config_directory() -> pathlib.Path:
@@ -19,69 +31,489 @@ def _load_config_file() -> dict:
     return json.loads(_get_config_directory().joinpath("config.json").read_text())
 
 
+def _get_config_file_version() -> typing.Optional[typing.Tuple[int, int]]:
+    # Modification time and size of the config file, None if there isn't one
+    try:
+        stat = _get_config_directory().joinpath("config.json").stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _to_bool(value: typing.Any) -> bool:
+    return str(value).lower() in ["1", "true", "yes"]
+
+
 def load_logging_config() -> dict:
     return json.loads(_get_config_directory().joinpath("logging.json").read_text())
 
 
+########################################################################################################################
+# Settings
+########################################################################################################################
+class RabbitMQConfig(typing.TypedDict):
+    broker: str
+    broker_port: str
+    queue: str
+    encode_queue: str
+    metrics_queue: str
+    max_priority: int
+
+
+class SchedulerConfig(typing.TypedDict):
+    policy: str
+
+
+class RoutingConfig(typing.TypedDict):
+    large_worker_cores: int
+    large_task_hours: float
+    affinity_seconds: float
+
+
+class WorkerConfig(typing.TypedDict):
+    task_types: typing.List[str]
+    manager_url: str
+    benchmark_presets: typing.List[str]
+    slots: int
+    threads_per_slot: int
+    cache_directory: pathlib.Path
+    cache_size_gb: float
+    heartbeat_seconds: float
+
+
+class ScannerConfig(typing.TypedDict):
+    processes: int
+    files_per_device: int
+    batch_size: int
+    full_hash: bool
+
+
+class DatabaseConfig(typing.TypedDict):
+    engine: str
+    name: typing.Optional[str]
+    host: typing.Optional[str]
+    port: typing.Optional[str]
+    user: typing.Optional[str]
+    password: typing.Optional[str]
+    conn_max_age: int
+    busy_timeout: float
+    journal_mode: str
+
+
+class Config:
+    """
+    Settings from the environment and config file (in that order), loaded once and kept until the config file changes
+    or `reload` is called.
+
+    Each section is read and validated the first time it's used, so a process only needs the sections it uses (e.g. a
+    worker doesn't need any paths).  Sections are cached here and shared, the `load_*` functions hand out copies.
+    """
+
+    def __init__(self, file_config: dict):
+        self._file_config = file_config
+        self._created_directories: typing.Set[pathlib.Path] = set()
+
+    def _get_section(self, name: str) -> dict:
+        return copy.deepcopy(self._file_config.get(name, {}))
+
+    @functools.cached_property
+    def flags(self) -> dict:
+        """
+        Various flags.  Environment flags are UPPERCASE of the config file key, e.g. "auto-delete" in environment is
+        "AUTO-DELETE" (or "AUTO_DELETE", since most shells can't set the former)
+
+        Flags supported:
+
+        * auto-delete: delete input files after being successfully encoded (default false)
+        """
+        flags = self._get_section("flags")
+
+        for key in set(flags) | set(FLAG_DEFAULTS):
+            environment_value = os.environ.get(key.upper(), os.environ.get(key.upper().replace("-", "_"), None))
+            flags[key] = environment_value if environment_value is not None else flags.get(key, FLAG_DEFAULTS.get(key))
+            if isinstance(FLAG_DEFAULTS.get(key), bool):
+                flags[key] = _to_bool(flags[key])
+
+        return flags
+
+    @functools.cached_property
+    def rabbitmq(self) -> RabbitMQConfig:
+        broker_config = self._get_section("rabbitmq")
+
+        # Loading from environment
+        broker_config["broker"] = os.environ.get("RABBITMQ_BROKER", broker_config.get("broker", None))
+        broker_config["broker_port"] = os.environ.get("RABBITMQ_BROKER_PORT", broker_config.get("broker_port", None))
+        broker_config["queue"] = os.environ.get("RABBITMQ_QUEUE", broker_config.get("queue", None))
+
+        error_message = ""
+        if not broker_config.get("broker", None):
+            error_message = "Missing address/host of RabbitMQ Broker in environment (RABBITMQ_BROKER)"
+            error_message += " or config file (rabbitmq->broker)"
+
+        if not broker_config.get("broker_port", None):
+            error_message = "Missing port of RabbitMQ Broker in environment (RABBITMQ_BROKER_PORT)"
+            error_message += " or config file (rabbitmq->broker_port)"
+
+        if not broker_config.get("queue", None):
+            error_message = "Missing RabbitMQ queue name in environment (RABBITMQ_QUEUE)"
+            error_message += " or config file (rabbitmq->queue)"
+
+        if error_message:
+            raise ValueError(error_message)
+
+        # Encodes and metrics get their own queues so they don't compete with each other.  These are priority queues,
+        # so they can't share a name with the (non-priority) queue from older versions.
+        broker_config["encode_queue"] = os.environ.get(
+            "RABBITMQ_ENCODE_QUEUE", broker_config.get("encode_queue", "{}-encode".format(broker_config["queue"]))
+        )
+        broker_config["metrics_queue"] = os.environ.get(
+            "RABBITMQ_METRICS_QUEUE", broker_config.get("metrics_queue", "{}-metrics".format(broker_config["queue"]))
+        )
+        broker_config["max_priority"] = int(
+            os.environ.get("RABBITMQ_MAX_PRIORITY", broker_config.get("max_priority", 10))
+        )
+
+        return broker_config
+
+    @functools.cached_property
+    def scheduler(self) -> SchedulerConfig:
+        """
+        Task scheduler settings.
+
+        Policies supported:
+
+        * fifo: tasks are processed in the order they're queued, only profile priority is taken into account
+        * sjf: shortest job first, cheaper tasks (frames * pixels * preset) are processed first
+        * fair-share: tasks are interleaved between profiles, so one large batch can't starve the others
+        """
+        scheduler_config = self._get_section("scheduler")
+        scheduler_config["policy"] = os.environ.get("SCHEDULER_POLICY", scheduler_config.get("policy", "sjf")).lower()
+
+        if scheduler_config["policy"] not in ["fifo", "sjf", "fair-share"]:
+            error_message = "Unknown scheduler policy [{}] in environment (SCHEDULER_POLICY)"
+            error_message += " or config file (scheduler->policy); expected one of (fifo,sjf,fair-share)"
+            raise ValueError(error_message.format(scheduler_config["policy"]))
+
+        return scheduler_config
+
+    @functools.cached_property
+    def routing(self) -> RoutingConfig:
+        """
+        Worker routing settings.
+
+        Settings supported:
+
+        * large_worker_cores: workers with at least this many cores are put in the "large" tier
+        * large_task_hours: tasks estimated to take longer than this on a "small" worker are sent to the "large" tier
+        * affinity_seconds: how long a task waits for a worker that already has its source file cached before any
+          worker can take it (default 120), 0 turns cache affinity off
+        """
+        routing_config = self._get_section("routing")
+
+        routing_config["large_worker_cores"] = int(
+            os.environ.get("ROUTING_LARGE_WORKER_CORES", routing_config.get("large_worker_cores", 32))
+        )
+        routing_config["large_task_hours"] = float(
+            os.environ.get("ROUTING_LARGE_TASK_HOURS", routing_config.get("large_task_hours", 4.0))
+        )
+        routing_config["affinity_seconds"] = float(
+            os.environ.get("ROUTING_AFFINITY_SECONDS", routing_config.get("affinity_seconds", 120))
+        )
+        if routing_config["affinity_seconds"] < 0:
+            raise ValueError(
+                "Routing affinity seconds can't be negative, got [{}]".format(routing_config["affinity_seconds"])
+            )
+
+        return routing_config
+
+    @functools.cached_property
+    def worker(self) -> WorkerConfig:
+        """
+        Worker settings.
+
+        Settings supported:
+
+        * task_types: comma separated list of task types this worker will pull from the queue ("encode", "metrics")
+        * manager_url: base URL of the manager (e.g. http://manager:8080), used to register the worker's capabilities.
+          Without it the worker doesn't register and only takes tasks from the "small" tier queues.
+        * benchmark_presets: comma separated list of presets to measure encode speed of when registering
+        * slots: number of tasks to run at once, each pinned to its own share of the CPUs (default 1)
+        * threads_per_slot: encoder threads per slot, defaults to the number of CPUs in the slot
+        * cache_directory: where source files are kept between tasks (environment CACHEDIR, default `sved-cache`).
+          Should be on the same filesystem as the working directory, so files can be hardlinked instead of copied.
+        * cache_size_gb: size cap of the source cache in GB (default 50), 0 turns it off
+        * heartbeat_seconds: how often the worker reports the contents of its source cache to the manager (default 60)
+        """
+        worker_config = self._get_section("worker")
+
+        worker_config["slots"] = int(os.environ.get("WORKER_SLOTS", worker_config.get("slots", 1)))
+        worker_config["threads_per_slot"] = int(
+            os.environ.get("WORKER_THREADS_PER_SLOT", worker_config.get("threads_per_slot", 0))
+        )
+        if worker_config["slots"] < 1:
+            raise ValueError("Worker slots must be at least 1, got [{}]".format(worker_config["slots"]))
+
+        worker_config["cache_directory"] = pathlib.Path(
+            os.environ.get("CACHEDIR", worker_config.get("cache_directory", "sved-cache"))
+        ).resolve()
+        worker_config["cache_size_gb"] = float(
+            os.environ.get("WORKER_CACHE_SIZE_GB", worker_config.get("cache_size_gb", 50))
+        )
+        if worker_config["cache_size_gb"] < 0:
+            raise ValueError("Worker cache size can't be negative, got [{}]".format(worker_config["cache_size_gb"]))
+        worker_config["heartbeat_seconds"] = float(
+            os.environ.get("WORKER_HEARTBEAT_SECONDS", worker_config.get("heartbeat_seconds", 60))
+        )
+        if worker_config["heartbeat_seconds"] <= 0:
+            raise ValueError(
+                "Worker heartbeat seconds must be positive, got [{}]".format(worker_config["heartbeat_seconds"])
+            )
+
+        worker_config["manager_url"] = os.environ.get("MANAGER_URL", worker_config.get("manager_url", "")).rstrip("/")
+
+        benchmark_presets = os.environ.get(
+            "WORKER_BENCHMARK_PRESETS", worker_config.get("benchmark_presets", "veryfast,medium,slow,veryslow")
+        )
+        worker_config["benchmark_presets"] = [x.strip() for x in benchmark_presets.split(",") if x.strip()]
+
+        task_types = os.environ.get("WORKER_TASK_TYPES", worker_config.get("task_types", "encode,metrics"))
+        worker_config["task_types"] = [x.strip().lower() for x in task_types.split(",") if x.strip()]
+
+        for task_type in worker_config["task_types"]:
+            if task_type not in ["encode", "metrics"]:
+                error_message = "Unknown task type [{}] in environment (WORKER_TASK_TYPES)"
+                error_message += " or config file (worker->task_types); expected one of (encode,metrics)"
+                raise ValueError(error_message.format(task_type))
+
+        return worker_config
+
+    @functools.cached_property
+    def scanner(self) -> ScannerConfig:
+        """
+        Library scanner settings.
+
+        Settings supported:
+
+        * processes: number of processes probing files, defaults to the number of CPUs
+        * files_per_device: files probed at once on each storage device (default 4).  Probing is mostly small random
+          reads, so a couple per spinning disk is plenty; SSDs and network shares can take more.
+        * batch_size: files written to the database at once (default 100)
+        * full_hash: whether to calculate the full hash of every scanned file in the background (default false).  Only
+          the fingerprint (a few MB of each file) is needed to find renamed and duplicate files, the hash confirms it.
+        """
+        scanner_config = self._get_section("scanner")
+
+        scanner_config["processes"] = int(
+            os.environ.get("SCANNER_PROCESSES", scanner_config.get("processes", os.cpu_count() or 1))
+        )
+        scanner_config["files_per_device"] = int(
+            os.environ.get("SCANNER_FILES_PER_DEVICE", scanner_config.get("files_per_device", 4))
+        )
+        scanner_config["batch_size"] = int(
+            os.environ.get("SCANNER_BATCH_SIZE", scanner_config.get("batch_size", 100))
+        )
+        scanner_config["full_hash"] = _to_bool(os.environ.get("SCANNER_FULL_HASH", scanner_config.get("full_hash")))
+
+        for key in ["processes", "files_per_device", "batch_size"]:
+            if scanner_config[key] < 1:
+                raise ValueError("Scanner setting [{}] must be at least 1, got [{}]".format(key, scanner_config[key]))
+
+        return scanner_config
+
+    @functools.cached_property
+    def database(self) -> DatabaseConfig:
+        """
+        Database settings.
+
+        Settings supported:
+
+        * engine: `sqlite` (default) or `postgresql`.  Postgres needs `psycopg` installed.
+        * name: path to the SQLite database file, or the name of the Postgres database
+        * host, port, user, password: how to connect to Postgres
+        * conn_max_age: seconds a connection is kept open between requests (default 60), 0 closes it after every request
+        * busy_timeout: seconds a SQLite write waits for the one before it to finish, instead of failing with "database
+          is locked" (default 20)
+        * journal_mode: SQLite journal mode (default `wal`).  In WAL mode, reads don't wait for writes and writes don't
+          wait for reads, only for each other.
+        """
+        database_config = self._get_section("database")
+
+        keys = ["engine", "name", "host", "port", "user", "password", "conn_max_age", "busy_timeout", "journal_mode"]
+        for key in keys:
+            database_config[key] = os.environ.get("DATABASE_{}".format(key.upper()), database_config.get(key, None))
+
+        database_config["engine"] = (database_config["engine"] or "sqlite").lower()
+        if database_config["engine"] not in ["sqlite", "postgresql"]:
+            error_message = "Unknown database engine [{}], expected sqlite/postgresql"
+            raise ValueError(error_message.format(database_config["engine"]))
+        if database_config["engine"] == "postgresql" and not database_config["name"]:
+            error_message = "Missing Postgres database name in environment (DATABASE_NAME)"
+            error_message += " or config file (database->name)"
+            raise ValueError(error_message)
+
+        defaults = {"conn_max_age": 60, "busy_timeout": 20, "journal_mode": "wal"}
+        for key, value in defaults.items():
+            if database_config[key] is None:
+                database_config[key] = value
+        database_config["conn_max_age"] = int(database_config["conn_max_age"])
+        database_config["busy_timeout"] = float(database_config["busy_timeout"])
+        database_config["journal_mode"] = str(database_config["journal_mode"]).lower()
+        if database_config["journal_mode"] not in ["delete", "truncate", "persist", "memory", "wal", "off"]:
+            raise ValueError("Unknown SQLite journal mode [{}]".format(database_config["journal_mode"]))
+
+        return database_config
+
+    @functools.cached_property
+    def input_directory(self) -> pathlib.Path:
+        # Load from environment, or config file if not defined in environment
+        input_path = os.environ.get("INPUT_PATH", self._file_config.get("paths", {}).get("input", None))
+
+        # Error checking
+        if not input_path:
+            error_message = "Missing input path definition in environment (INPUT_PATH)"
+            error_message += " or config file (paths->input)"
+            raise ValueError(error_message)
+
+        return pathlib.Path(input_path).resolve()
+
+    @functools.cached_property
+    def output_directory(self) -> pathlib.Path:
+        # Load from environment, or config file if not defined in environment
+        output_path = os.environ.get("OUTPUT_PATH", self._file_config.get("paths", {}).get("output", None))
+
+        # Error checking
+        if not output_path:
+            error_message = "Missing output path definition in environment (OUTPUT_PATH)"
+            error_message += " or config file (paths->output)"
+            raise ValueError(error_message)
+
+        return pathlib.Path(output_path).resolve()
+
+    def create_directory(self, directory: pathlib.Path) -> None:
+        # Only the first time, if it's deleted while running it's up to whatever uses it
+        if directory not in self._created_directories:
+            directory.mkdir(exist_ok=True, parents=True)
+            self._created_directories.add(directory)
+
+
+########################################################################################################################
+# Loading
+########################################################################################################################
+_config: typing.Optional[Config] = None
+_config_version: typing.Optional[typing.Tuple[int, int]] = None
+_config_checked = 0.0
+_config_lock = threading.Lock()
+# Set by `_request_reload` (e.g. from the SIGHUP handler), the next `get_config` reads everything again
+_reload_requested = False
+
+
+def get_config() -> Config:
+    """
+    Get the current settings.  The config file is read again when it changes, checked at most every
+    `RELOAD_CHECK_SECONDS`; otherwise this doesn't touch the filesystem.
+
+    :return: current settings
+    """
+    global _config, _config_version, _config_checked, _reload_requested
+
+    if _config is not None and not _reload_requested and time.monotonic() - _config_checked < RELOAD_CHECK_SECONDS:
+        return _config
+
+    with _config_lock:
+        config_version = _get_config_file_version()
+        if _config is None or _reload_requested or config_version != _config_version:
+            # Cleared first, so a request that comes in while reading is picked up by the next call
+            _reload_requested = False
+            _config = Config(_load_config_file() if config_version is not None else {})
+            _config_version = config_version
+        _config_checked = time.monotonic()
+        return _config
+
+
+def reload() -> Config:
+    """
+    Read the config file and environment again, whether or not the file changed.
+
+    :return: new settings
+    """
+    _request_reload()
+    return get_config()
+
+
+def _request_reload() -> None:
+    # Only sets a flag, so it's safe in a signal handler even if the interrupted code holds `_config_lock`
+    global _reload_requested
+    _reload_requested = True
+
+
+def install_reload_signal() -> None:
+    """
+    Reload the settings when the process gets a SIGHUP: the next `get_config` reads the config file and environment
+    again.  Has to be called from the main thread.
+
+    :return: None
+    """
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signal_number, frame: _request_reload())
+
+
 def load_flags() -> dict:
     """
-    Load various flags from environment and/or config file (in that order).
+    Load various flags from environment and/or config file (in that order), see `Config.flags`.
+
+    :return: Dictionary of flags to change behavior
+    """
+    return copy.deepcopy(get_config().flags)
 
-    Environment flags are UPPERCASE of the config file key, e.g. "auto-delete" in environment is "AUTO-DELETE"
 
-    Flags supported:
+def load_rabbitmq_config() -> RabbitMQConfig:
+    return copy.deepcopy(get_config().rabbitmq)
 
-    * auto-delete: delete input files after being successfully encoded
 
-    :return: Dictionary of flags to change behavior, see above for list of flags
+def load_scheduler_config() -> SchedulerConfig:
     """
+    Load the task scheduler settings from the environment or config file (in that order), see `Config.scheduler`.
 
-    global CONFIG
+    :return: Dictionary of scheduler settings
+    """
+    return copy.deepcopy(get_config().scheduler)
 
-    if CONFIG:
-        return CONFIG
-    else:
-        flags = _load_config_file().get("flags", {})
 
-        for key in flags.keys():
-            flags[key] = flags.get(key, os.environ.get(key.upper(), None))
+def load_routing_config() -> RoutingConfig:
+    """
+    Load worker routing settings from the environment or config file (in that order), see `Config.routing`.
 
-        for key, value in flags.items():
-            if value is None:
-                error_message = "Missing key [{}] in config file (flags->{})"
-                error_message += " or environment ({})"
-                raise ValueError(error_message.format(key, key, key.upper()))
+    :return: Dictionary of routing settings
+    """
+    return copy.deepcopy(get_config().routing)
 
-        CONFIG = flags
-        return flags
 
+def load_worker_config() -> WorkerConfig:
+    """
+    Load worker settings from the environment or config file (in that order), see `Config.worker`.
 
-def load_rabbitmq_config() -> dict:
-    # Load base config from file - this may or may not exist.
-    broker_config = _load_config_file()["rabbitmq"]
+    :return: Dictionary of worker settings
+    """
+    return copy.deepcopy(get_config().worker)
 
-    # Loading from environment
-    broker_config["broker"] = os.environ.get("RABBITMQ_BROKER", broker_config.get("broker", None))
-    broker_config["broker_port"] = os.environ.get("RABBITMQ_BROKER_PORT", broker_config.get("broker_port", None))
-    broker_config["queue"] = os.environ.get("RABBITMQ_QUEUE", broker_config.get("queue", None))
 
-    error_message = ""
-    if not broker_config.get("broker", None):
-        error_message = "Missing address/host of RabbitMQ Broker in environment (RABBITMQ_BROKER)"
-        error_message += " or config file (rabbitmq->broker)"
+def load_scanner_config() -> ScannerConfig:
+    """
+    Load library scanner settings from the environment or config file (in that order), see `Config.scanner`.
 
-    if not broker_config.get("broker_port", None):
-        error_message = "Missing port of RabbitMQ Broker in environment (RABBITMQ_BROKER_PORT)"
-        error_message += " or config file (rabbitmq->broker_port)"
+    :return: Dictionary of scanner settings
+    """
+    return copy.deepcopy(get_config().scanner)
 
-    if not broker_config.get("queue", None):
-        error_message = "Missing RabbitMQ queue name in environment (RABBITMQ_QUEUE)"
-        error_message += " or config file (rabbitmq->queue)"
 
-    if error_message:
-        raise ValueError(error_message)
+def load_database_config() -> DatabaseConfig:
+    """
+    Load database settings from the environment or config file (in that order), see `Config.database`.  These are read
+    when Django loads its settings.
 
-    return broker_config
+    :return: Dictionary of database settings
+    """
+    return copy.deepcopy(get_config().database)
 
 
 def load_input_directory(create_directory=True) -> pathlib.Path:
@@ -91,21 +523,10 @@ def load_input_directory(create_directory=True) -> pathlib.Path:
     :param create_directory: if set, will create the input folder if it doesn't exist (mostly for debug).
     :return: Path to input directory
     """
-
-    # Load from environment, or config file if not defined in environment
-    input_path = os.environ.get("INPUT_PATH", _load_config_file().get("paths", {}).get("input", None))
-
-    # Error checking
-    if not input_path:
-        error_message = "Missing input path definition in environment (INPUT_PATH)"
-        error_message += " or config file (paths->input)"
-        raise ValueError(error_message)
-
-    input_path = pathlib.Path(input_path).resolve()
-
+    current_config = get_config()
     if create_directory:
-        input_path.mkdir(exist_ok=True, parents=True)
-    return input_path
+        current_config.create_directory(current_config.input_directory)
+    return current_config.input_directory
 
 
 def load_output_directory(create_directory=True) -> pathlib.Path:
@@ -115,18 +536,7 @@ def load_output_directory(create_directory=True) -> pathlib.Path:
     :param create_directory: if set, will create the output folder if it doesn't exist (mostly for debug).
     :return: Path to output directory
     """
-
-    # Load from environment, or config file if not defined in environment
-    output_path = os.environ.get("OUTPUT_PATH", _load_config_file().get("paths", {}).get("output", None))
-
-    # Error checking
-    if not output_path:
-        error_message = "Missing output path definition in environment (OUTPUT_PATH)"
-        error_message += " or config file (paths->output)"
-        raise ValueError(error_message)
-
-    output_path = pathlib.Path(output_path).resolve()
-
+    current_config = get_config()
     if create_directory:
-        output_path.mkdir(exist_ok=True, parents=True)
-    return output_path
+        current_config.create_directory(current_config.output_directory)
+    return current_config.output_directory
@@ -36,23 +36,46 @@
 #   chroma sample location (--chromaloc) must be set to the same value as the source, or omitted if the source value is
 #   undefined.
 
+import concurrent.futures
 import json
 import math
 import os
 import pathlib
+import re
 import shlex
 import subprocess
+import threading
+import time
 import typing
 
 from utils import log
 from utils import ffprobe
 from utils import mkvtoolnix
+from utils import progress
+from utils import subprocess_handler
 
 
-BASE_FFMPEG_COMMAND = "ffmpeg -progress - -nostats -hide_banner -y -stats_period 1"
+# Progress is read from its own pipe (see `FFmpegProcess`), so there's no `-progress` here.
+BASE_FFMPEG_COMMAND = "ffmpeg -nostats -hide_banner -y -stats_period 1"
+
+# Summary ffmpeg logs at the end of a run, e.g. "video:1234kB audio:567kB subtitle:8kB other streams:0kB ..."
+# (newer versions write KiB, and prefix it with the output it's for).
+STREAM_SIZES_PATTERN = re.compile(
+    r"video:\s*([\d.]+)\s*Ki?B\s+audio:\s*([\d.]+)\s*Ki?B\s+subtitle:\s*([\d.]+)\s*Ki?B", re.IGNORECASE
+)
+
+
+def _parse_progress_number(value: typing.Optional[str], cast: typing.Callable, suffix: str = ""):
+    # ffmpeg reports "N/A" for anything it can't calculate yet (e.g. bitrate before the first packet is written)
+    if value is None or value == "N/A":
+        return cast(-1)
+    if suffix and value.endswith(suffix):
+        value = value[:-len(suffix)]
+    return cast(value)
 
 
 class FFmpegOutput:
+    # One block of ffmpeg's `-progress` output, e.g.:
     # frame=2931
     # fps=185.81
     # stream_0_0_q=23.0
@@ -65,9 +88,15 @@ class FFmpegOutput:
     # drop_frames=0
     # speed=7.56x
     # progress=continue
+    # There's one of these a second for the entire encode, hence the slots.
+    __slots__ = (
+        "frame", "fps", "bitrate", "total_size", "out_time_us", "out_time_ms", "out_time", "dup_frames",
+        "drop_frames", "speed", "progress"
+    )
+
     def __init__(self, frame: int, fps: float, bitrate: float, total_size: int, out_time_us: int,
                  out_time_ms: int, out_time: str, dup_frames: int, drop_frames: int, speed: float,
-                 file_framerate: float = None):
+                 file_framerate: float = None, progress: str = "continue"):
         self.frame: int = frame
         self.fps: float = fps
         self.bitrate: float = bitrate
@@ -78,12 +107,38 @@ class FFmpegOutput:
         self.dup_frames: int = dup_frames
         self.drop_frames: int = drop_frames
         self.speed: float = speed
+        self.progress: str = progress
 
         if file_framerate and fps and speed == -1:
             self.speed = fps / file_framerate
 
+    @classmethod
+    def from_progress(cls, values: typing.Dict[str, str], file_framerate: float = None) -> "FFmpegOutput":
+        """
+        Create an output object from the key/value pairs of a progress block.  Keys can be in any order, and missing
+        or "N/A" values become -1, so new/removed keys in future ffmpeg versions don't break anything.
+
+        :param values: key/value pairs of the block, including the trailing `progress` key
+        :param file_framerate: optional parameter, provide this to calculate speed if ffmpeg returning 'N/A'
+        :return: output object
+        """
+        return cls(
+            frame=_parse_progress_number(values.get("frame"), int),
+            fps=_parse_progress_number(values.get("fps"), float),
+            bitrate=_parse_progress_number(values.get("bitrate"), float, suffix="kbits/s"),
+            total_size=_parse_progress_number(values.get("total_size"), int),
+            out_time_us=_parse_progress_number(values.get("out_time_us"), int),
+            out_time_ms=_parse_progress_number(values.get("out_time_ms"), int),
+            out_time=values.get("out_time", "-1").replace("N/A", "-1"),
+            dup_frames=_parse_progress_number(values.get("dup_frames"), int),
+            drop_frames=_parse_progress_number(values.get("drop_frames"), int),
+            speed=_parse_progress_number(values.get("speed"), float, suffix="x"),
+            file_framerate=file_framerate,
+            progress=values.get("progress", "continue")
+        )
+
     def detailed_string(self):
-        return json.dumps(self.__dict__)
+        return json.dumps({x: getattr(self, x) for x in self.__slots__})
 
     def get_frame_as_percentage(self, frame_count: int):
         return self.frame / frame_count * 100.0
@@ -114,53 +169,161 @@ class FFmpegOutput:
         return "frame: {} | fps: {} | speed: {} | bitrate: {}".format(self.frame, self.fps, self.speed, self.bitrate)
 
 
-def format_ffmpeg_output(ffmpeg_output: typing.List[str], file_framerate: float = None) -> FFmpegOutput:
+def read_progress(stream: typing.Iterable[str], file_framerate: float = None) -> typing.Iterator[FFmpegOutput]:
     """
-    Takes ffmpeg progress output and returns an object to be better interact with it.
+    Read ffmpeg's `-progress` output, yielding an output object for each block.  A block ends with a `progress=` line,
+    so each one is yielded as soon as it's complete.  Lines that aren't `key=value` are ignored.
+
+    :param stream: progress output, one line at a time (e.g. a file object)
+    :param file_framerate: optional parameter, provide this to calculate speed if ffmpeg returning 'N/A'
+    :return: iterator of output objects
+    """
+    values = {}
+    for line in stream:
+        key, separator, value = line.partition("=")
+        if not separator:
+            continue
+
+        key = key.strip()
+        values[key] = value.strip()
+        if key == "progress":
+            yield FFmpegOutput.from_progress(values, file_framerate=file_framerate)
+            values = {}
 
-    Needed since the way I print ffmpeg output it's one metric per line, not one progress step per line.
+
+def format_ffmpeg_output(ffmpeg_output: typing.List[str], file_framerate: float = None) -> FFmpegOutput:
+    """
+    Takes one block of ffmpeg progress output and returns an object to be better interact with it.
 
     :param ffmpeg_output: list of lines from ffmpeg encoding output
     :param file_framerate: optional parameter, provide this to calculate speed if ffmpeg returning 'N/A'
     :return: output object that's easier to manipulate
     """
-    # Ignoring output like "stream_0_1_q=0.0"
-    temp_stdout = [x for x in ffmpeg_output if "stream_" not in x]
-
-    if "bitrate=N/A" in temp_stdout[2]:
-        temp_stdout[2] = "bitrate=-1"
-    if "total_size=N/A" in temp_stdout[3]:
-        temp_stdout[3] = "total_size=-1"
-    if "out_time_us=N/A" in temp_stdout[4]:
-        temp_stdout[4] = "out_time_us=-1"
-    if "out_time_ms=N/A" in temp_stdout[5]:
-        temp_stdout[5] = "out_time_ms=-1"
-    if "out_time=N/A" in temp_stdout[6]:
-        temp_stdout[6] = "out_time=-1"
-    if "speed=N/A" in temp_stdout[9]:
-        temp_stdout[9] = "speed=-1x"
-
-    try:
-        return FFmpegOutput(
-            frame=int(temp_stdout[0].split("=")[1]),
-            fps=float(temp_stdout[1].split("=")[1]),
-            bitrate=float(temp_stdout[2].split("=")[1].split("kbits")[0]),
-            total_size=int(temp_stdout[3].split("=")[1]),
-            out_time_us=int(temp_stdout[4].split("=")[1]),
-            out_time_ms=int(temp_stdout[5].split("=")[1]),
-            out_time=temp_stdout[6].split("=")[1],
-            dup_frames=int(temp_stdout[7].split("=")[1]),
-            drop_frames=int(temp_stdout[8].split("=")[1]),
-            speed=float(temp_stdout[9].split("=")[1].split("x")[0]),
-            file_framerate=file_framerate
-        )
-    except ValueError as ve:
-        log.debug(ffmpeg_output)
-        log.debug(temp_stdout)
-        raise ve
+    values = {}
+    for line in ffmpeg_output:
+        key, separator, value = line.partition("=")
+        if separator:
+            values[key.strip()] = value.strip()
+    return FFmpegOutput.from_progress(values, file_framerate=file_framerate)
 
 
-def _construct_audio_stream_arguments(audio_streams: typing.List[dict]) -> str:
+def read_stream_sizes(ffmpeg_output: typing.Iterable[str]) -> typing.Optional[typing.Dict[str, int]]:
+    """
+    Get the size of each type of stream written by ffmpeg, from the summary at the end of its log output.
+
+    ffmpeg rounds these to the nearest KiB, so the real size is within half a KiB either side of the printed one.  The
+    values returned are upper bounds: at most 1024 bytes over.
+
+    :param ffmpeg_output: lines of ffmpeg log output, including the last ones
+    :return: bytes written by "video", "audio" and "subtitle" streams, or None if there's no summary
+    """
+    for line in reversed(list(ffmpeg_output)):
+        match = STREAM_SIZES_PATTERN.search(line)
+        if match:
+            return {
+                x: math.ceil((float(y) + 0.5) * 1024) for x, y in zip(["video", "audio", "subtitle"], match.groups())
+            }
+    return None
+
+
+class FFmpegProcess:
+    """
+    A running ffmpeg command, with its progress output separated from its log output.
+
+    On POSIX, progress is written to a pipe of its own (`-progress pipe:N`), and stdout/stderr are drained by a
+    background thread.  The log output can't interrupt a progress block halfway through this way, which used to happen
+    with both written to the same pipe.  Windows can't pass extra file descriptors to a child, so there progress is
+    written to stdout and logs are read from stderr instead.
+    """
+
+    def __init__(self, command: str, on_line: typing.Callable[[str], None] = None):
+        """
+        :param command: ffmpeg command to run, without a `-progress` argument
+        :param on_line: called with each line of log output (from the drain thread)
+        """
+        self.on_line = on_line
+        arguments = shlex.split(command)
+
+        if os.name == "nt":
+            arguments[1:1] = ["-progress", "-"]
+            self.process = subprocess.Popen(
+                arguments,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                encoding="utf-8", errors="backslashreplace"
+            )
+            self._progress_stream = self.process.stdout
+            log_stream = self.process.stderr
+        else:
+            read_fd, write_fd = os.pipe()
+            arguments[1:1] = ["-progress", "pipe:{}".format(write_fd)]
+            try:
+                self.process = subprocess.Popen(
+                    arguments,
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT, pass_fds=(write_fd,),
+                    encoding="utf-8", errors="backslashreplace"
+                )
+            except Exception:
+                os.close(read_fd)
+                raise
+            finally:
+                # Only ffmpeg should have the write end open, otherwise the pipe never reaches EOF
+                os.close(write_fd)
+            self._progress_stream = os.fdopen(read_fd, encoding="utf-8", errors="backslashreplace")
+            log_stream = self.process.stdout
+
+        self._log_thread = threading.Thread(target=self._drain, args=(log_stream,), daemon=True)
+        self._log_thread.start()
+
+    def _drain(self, stream: typing.TextIO) -> None:
+        for line in stream:
+            line = line.strip()
+            if line and self.on_line:
+                self.on_line(line)
+
+    def read_progress(self, file_framerate: float = None) -> typing.Iterator[FFmpegOutput]:
+        """
+        :param file_framerate: optional parameter, provide this to calculate speed if ffmpeg returning 'N/A'
+        :return: iterator of progress updates until ffmpeg exits
+        """
+        return read_progress(self._progress_stream, file_framerate=file_framerate)
+
+    def wait(self) -> int:
+        """
+        Wait for ffmpeg to exit and all of its output to be read.
+
+        :return: return code
+        """
+        # Anything left in the progress pipe is read (and discarded) so ffmpeg can't block writing to it
+        for _ in self._progress_stream:
+            pass
+        return_code = self.process.wait()
+        self._log_thread.join()
+        self._progress_stream.close()
+        return return_code
+
+    def kill(self) -> None:
+        """
+        Kill ffmpeg if it's still running, e.g. because handling its progress failed, and clean up after it.  Does
+        nothing if it has already been waited for.
+
+        :return: None
+        """
+        if self.process.poll() is None:
+            self.process.kill()
+        if not self._progress_stream.closed:
+            self.wait()
+
+
+def _construct_audio_track_arguments(audio_streams: typing.List[dict],
+                                     separate_outputs: bool = False) -> typing.List[str]:
+    """
+    Create the arguments of each audio track of an encode, following the rules below.
+
+    :param audio_streams: audio streams of the source file
+    :param separate_outputs: number every track as the first of its own output (see `create_audio_commands`),
+                             instead of all of them in one output
+    :return: arguments of each output audio track, in order
+    """
     # It's never really worth it to keep the original audio because it's so massive.
     # (Audiophiles: I do not care.  You and I are both well aware neither your nor my hearing can tell a difference.)
 
@@ -227,6 +390,9 @@ def _construct_audio_stream_arguments(audio_streams: typing.List[dict]) -> str:
 
     audio_arguments = []
 
+    def next_output() -> int:
+        return 0 if separate_outputs else len(audio_arguments)
+
     # Since the flags for main audio are different from generalized "secondary" audio, we have to pull
     # them out of the loop.  But it's functionally the same as below, just pointed at the first audio track.
     main_track_bitrate = int(audio_streams[0]["tags"]["BPS"]) // 1000
@@ -251,7 +417,7 @@ def _construct_audio_stream_arguments(audio_streams: typing.List[dict]) -> str:
     if main_track_channels > 2:
         audio_arguments.append(
             stereo_gain_template.format(
-                0, len(audio_arguments), len(audio_arguments), len(audio_arguments), len(audio_arguments)
+                0, next_output(), next_output(), next_output(), next_output()
             )
         )
 
@@ -267,23 +433,27 @@ def _construct_audio_stream_arguments(audio_streams: typing.List[dict]) -> str:
         if track_channels >= 6:
             audio_arguments.append(
                 stereo_gain_template.format(
-                    i, len(audio_arguments), len(audio_arguments), len(audio_arguments), len(audio_arguments)
+                    i, next_output(), next_output(), next_output(), next_output()
                 )
             )
         elif track_bitrate >= 192:
             audio_arguments.append(
-                stereo_no_gain_template.format(i, len(audio_arguments), len(audio_arguments), len(audio_arguments))
+                stereo_no_gain_template.format(i, next_output(), next_output(), next_output())
             )
         else:
             if track_codec == "aac":
-                audio_arguments.append(copy_template.format(i, len(audio_arguments)))
+                audio_arguments.append(copy_template.format(i, next_output()))
             else:
                 audio_arguments.append(
-                    stereo_no_gain_template.format(i, len(audio_arguments), len(audio_arguments), len(audio_arguments))
+                    stereo_no_gain_template.format(i, next_output(), next_output(), next_output())
                 )
 
-    # We join-split-join to remove any duplicate whitespace
-    return " ".join(" ".join(audio_arguments).split())
+    # We split-join to remove any duplicate whitespace
+    return [" ".join(x.split()) for x in audio_arguments]
+
+
+def _construct_audio_stream_arguments(audio_streams: typing.List[dict]) -> str:
+    return " ".join(_construct_audio_track_arguments(audio_streams))
 
 
 def _construct_video_filter_arguments(file: pathlib.Path) -> str:
@@ -304,6 +474,23 @@ def _construct_video_filter_arguments(file: pathlib.Path) -> str:
     :param file: file to run cropdetect filter on
     :return: string of arguments necessary to de-interlace and remove black bars from video
     """
+    video_filters = _get_video_filters(file)
+
+    if video_filters:
+        filter_arguments = "-vf {}".format(video_filters)
+    else:
+        filter_arguments = ""
+
+    return filter_arguments
+
+
+def _get_video_filters(file: pathlib.Path) -> str:
+    """
+    Get the filter graph to apply to the video stream, see `_construct_video_filter_arguments`.
+
+    :param file: file to encode
+    :return: comma separated video filters, empty if none are necessary
+    """
     file_info = ffprobe.get_file_info(file)
 
     if file_info.video_stream["field_order"] == "progressive":
@@ -312,23 +499,27 @@ def _construct_video_filter_arguments(file: pathlib.Path) -> str:
         # Use the bwdif filter, one frame output per frame input.
         deinterlace_arguments = "bwdif=0"
 
-    if deinterlace_arguments:
-        filter_arguments = "-vf {}".format(deinterlace_arguments)
-    else:
-        filter_arguments = ""
-
-    return filter_arguments
+    return deinterlace_arguments
 
 
 def _construct_video_stream_arguments(file: pathlib.Path, codec: str,
                                       encode_type: str, encode_value: int,
-                                      preset: str, tune: str = None) -> str:
+                                      preset: str, tune: str = None, threads: int = None,
+                                      video_input: str = "0:v:0") -> str:
     if codec not in ["libx264", "libx265"]:
         raise ValueError("Codec [{}] not supported".format(codec))
 
-    command_fragment = "-map 0:v:0 -c:v:0 {} -preset {}".format(codec, preset)
+    # `video_input` is either a stream of the input or the label of a filter graph output
+    command_fragment = "-map {} -c:v:0 {} -preset {}".format(video_input, codec, preset)
     x265_parameters = []
 
+    # Encoder thread count.  libx265 ignores `-threads`, its equivalent is the size of its thread pool.
+    if threads:
+        if codec == "libx264":
+            command_fragment += " -threads:v {}".format(threads)
+        else:
+            x265_parameters.append("pools={}".format(threads))
+
     if tune and tune in ["film", "grain", "animation"]:
         command_fragment += " -tune {}".format(tune)
 
@@ -480,36 +671,92 @@ def get_bitrate_for_scene(file_path: pathlib.Path) -> int:
     return math.floor(scene_max_kilobits / file_info.duration)
 
 
-def passes_scene_rules(reference_file: pathlib.Path, compressed_file: pathlib.Path) -> bool:
+def passes_scene_rules(reference_file: pathlib.Path, compressed_file: pathlib.Path,
+                       video_stream_size: int = None) -> bool:
     """
     Check if a compressed file's video stream is equal or below scene rule maximum.
 
     :param reference_file: path to uncompressed file
     :param compressed_file: path to compressed file
+    :param video_stream_size: size of the compressed video stream in bytes, if already known (e.g. from
+                              `read_stream_sizes`).  Otherwise it's read from the compressed file's statistics tags.
     :return: whether the compressed file passes scene rules or not
     """
-    compressed_information = ffprobe.get_file_info(compressed_file)
+    if video_stream_size is None:
+        compressed_information = ffprobe.get_file_info(compressed_file)
+        video_stream_size = float(compressed_information.video_stream["tags"]["NUMBER_OF_BYTES"])
     max_video_stream_size = get_max_video_stream_size_for_scene(reference_file)
-    return float(compressed_information.video_stream["tags"]["NUMBER_OF_BYTES"]) <= max_video_stream_size
+    return video_stream_size <= max_video_stream_size
+
+
+def benchmark_encoder(codec: str, preset: str, frame_count: int = 120) -> float:
+    """
+    Measure how fast this machine encodes a synthetic 1080p source with a codec & preset.
 
+    The source is generated by ffmpeg (testsrc2, which has enough motion and detail to not be trivially compressible),
+    so this doesn't need any media on the machine.  Process startup is included in the timing, so short runs
+    under-report slightly; that's fine since it's only used to compare workers.
 
-def delete_two_pass_logs(log_directory: pathlib.Path) -> None:
+    :param codec: video codec to use (libx264 or libx265)
+    :param preset: encoder preset (e.g. slow, medium, veryfast)
+    :param frame_count: number of frames to encode
+    :return: frames encoded per second
+    """
+    if codec not in ["libx264", "libx265"]:
+        raise ValueError("Codec [{}] not supported".format(codec))
+
+    command = "ffmpeg -hide_banner -nostats -loglevel error -f lavfi -i testsrc2=size=1920x1080:rate=24"
+    command += " -frames:v {} -c:v {} -preset {} -f null -".format(frame_count, codec, preset)
+
+    start_time = time.time()
+    process = subprocess.run(shlex.split(command), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    elapsed_time = time.time() - start_time
+
+    if process.returncode != 0:
+        log.debug(process.stderr.decode(errors="backslashreplace"))
+        raise RuntimeError("Benchmark of [{}] [{}] returned code [{}]".format(codec, preset, process.returncode))
+
+    return round(frame_count / elapsed_time, 2)
+
+
+def get_two_pass_log_files(file_path: pathlib.Path, codec: str) -> typing.List[pathlib.Path]:
+    """
+    Get the files the first pass of a two-pass encode writes, relative to the working directory.  The first one is the
+    stats log the second pass can't run without, the other is the macroblock/CU tree data it also reads if it's there.
+
+    :param file_path: path to source file (the logs are named after it, see `_construct_video_stream_arguments`)
+    :param codec: video codec (h264/h265 or libx264/libx265)
+    :return: paths to the log files
+    """
+    if codec in ["h264", "libx264"]:
+        # ffmpeg adds the stream index to `-passlogfile`
+        stats_log = pathlib.Path("{}-0.log".format(file_path.stem))
+        return [stats_log, stats_log.with_name("{}.mbtree".format(stats_log.name))]
+    elif codec in ["h265", "libx265"]:
+        stats_log = pathlib.Path("{}.log".format(file_path.stem))
+        return [stats_log, stats_log.with_name("{}.cutree".format(stats_log.name))]
+    raise ValueError("Got codec value [{}]; expected one of (h264,h265)".format(codec))
+
+
+def delete_two_pass_logs(log_directory: pathlib.Path, file_path: pathlib.Path) -> None:
     """
     Deleting files left behind by a two pass encode
 
     :param log_directory: directory containing two pass log (likely the current working directory)
+    :param file_path: path to the source file that was encoded, the logs are named after it
     :return: None
     """
-    log_prefix = "ffmpeg2pass-0"
-    for file in log_directory.iterdir():
-        if file.name.startswith(log_prefix):
-            file.unlink()
+    log_files = get_two_pass_log_files(file_path, "h264") + get_two_pass_log_files(file_path, "h265")
+    for log_file in log_files:
+        # Including the temporary files the encoders write before renaming them
+        for file in [log_directory.joinpath(log_file), log_directory.joinpath("{}.temp".format(log_file))]:
+            file.unlink(missing_ok=True)
 
 
 def create_two_pass_command_by_relative_size(file_path: pathlib.Path, output_path: pathlib.Path = None,
                                              codec: str = "h264", stream_size: float = None,
-                                             preset: str = "slow",
-                                             tune: str = None) -> typing.Tuple[str, str, pathlib.Path]:
+                                             preset: str = "slow", tune: str = None,
+                                             threads: int = None) -> typing.Tuple[str, str, pathlib.Path]:
     """
     Simple wrapper to get 2-pass commands to encode down to a percentage video stream size rather than
     calculating and providing the bitrate.
@@ -520,6 +767,7 @@ def create_two_pass_command_by_relative_size(file_path: pathlib.Path, output_pat
     :param stream_size: size of encoded video stream relative to source video stream
     :param preset: encoder preset (e.g. slow, medium, veryfast)
     :param tune: encoder tune
+    :param threads: number of encoder threads, encoder default (based on core count) if not set
     :return: Commands necessary to encode a video with two-pass encoding and the path to the output file if run.
     """
     if stream_size:
@@ -529,12 +777,15 @@ def create_two_pass_command_by_relative_size(file_path: pathlib.Path, output_pat
         bitrate = math.floor(compressed_stream_size / file_info.duration)
     else:
         bitrate = get_bitrate_for_scene(file_path)
-    return create_two_pass_command(file_path, output_path, codec, bitrate=bitrate, preset=preset, tune=tune)
+    return create_two_pass_command(
+        file_path, output_path, codec, bitrate=bitrate, preset=preset, tune=tune, threads=threads
+    )
 
 
 def create_two_pass_command(file_path: pathlib.Path, output_path: pathlib.Path = None,
                             codec: str = "h264", bitrate: int = None,
-                            preset: str = "slow", tune: str = None) -> typing.Tuple[str, str, pathlib.Path]:
+                            preset: str = "slow", tune: str = None,
+                            threads: int = None, include_audio: bool = True) -> typing.Tuple[str, str, pathlib.Path]:
     """
     Create commands to encode a file with ffmpeg using two-pass encoding.
 
@@ -549,6 +800,9 @@ def create_two_pass_command(file_path: pathlib.Path, output_path: pathlib.Path =
     :param bitrate: average bitrate in kilobits per second
     :param preset: encoder preset (e.g. slow, medium, veryfast)
     :param tune: encoder tune
+    :param threads: number of encoder threads, encoder default (based on core count) if not set
+    :param include_audio: encode the audio tracks too, leave them out if they're transcoded separately (see
+                          `AudioTranscode`)
     :return: Commands necessary to encode a video with two-pass encoding and the path to the output file if run.
     """
     mkvtoolnix.add_media_statistics_if_necessary(file_path)
@@ -575,7 +829,7 @@ def create_two_pass_command(file_path: pathlib.Path, output_path: pathlib.Path =
         two_pass_output = "/dev/null"
 
     first_pass_video_stream_arguments = _construct_video_stream_arguments(
-        file_path, video_codec, "abr1", bitrate, preset, tune
+        file_path, video_codec, "abr1", bitrate, preset, tune, threads
     )
 
     first_pass_command_template = "{} -i \"{}\" {} -f null {}"
@@ -592,7 +846,7 @@ def create_two_pass_command(file_path: pathlib.Path, output_path: pathlib.Path =
     second_pass_command_template += " {} {} \"{}\""
 
     second_pass_video_stream_arguments = _construct_video_stream_arguments(
-        file_path, video_codec, "abr2", bitrate, preset, tune
+        file_path, video_codec, "abr2", bitrate, preset, tune, threads
     )
     filter_arguments = _construct_video_filter_arguments(file_path)
 
@@ -601,7 +855,7 @@ def create_two_pass_command(file_path: pathlib.Path, output_path: pathlib.Path =
     else:
         subtitle_arguments = ""
 
-    if file_info.audio_streams:
+    if file_info.audio_streams and include_audio:
         audio_arguments = _construct_audio_stream_arguments(file_info.audio_streams)
     else:
         audio_arguments = ""
@@ -617,7 +871,8 @@ def create_two_pass_command(file_path: pathlib.Path, output_path: pathlib.Path =
 
 def create_crf_command(file_path: pathlib.Path, output_path: pathlib.Path = None,
                        codec: str = "h264", crf: int = 18, preset: str = "slow",
-                       tune: str = None) -> typing.Tuple[str, pathlib.Path]:
+                       tune: str = None, threads: int = None,
+                       include_audio: bool = True) -> typing.Tuple[str, pathlib.Path]:
     """
     Create commands to encode a file with ffmpeg using two-pass encoding.
 
@@ -632,6 +887,9 @@ def create_crf_command(file_path: pathlib.Path, output_path: pathlib.Path = None
     :param crf: CRF to encode with
     :param preset: encoder preset (e.g. slow, medium, veryfast)
     :param tune: encoder tune
+    :param threads: number of encoder threads, encoder default (based on core count) if not set
+    :param include_audio: encode the audio tracks too, leave them out if they're transcoded separately (see
+                          `AudioTranscode`)
     :return: Commands necessary to encode a video with two-pass encoding and the path to the output file if run.
     """
     mkvtoolnix.add_media_statistics_if_necessary(file_path)
@@ -658,7 +916,9 @@ def create_crf_command(file_path: pathlib.Path, output_path: pathlib.Path = None
     command_template += " {} {} \"{}\""
 
     # Getting values from here to end
-    video_stream_arguments = _construct_video_stream_arguments(file_path, video_codec, "crf", crf, preset, tune)
+    video_stream_arguments = _construct_video_stream_arguments(
+        file_path, video_codec, "crf", crf, preset, tune, threads
+    )
     video_filter_arguments = _construct_video_filter_arguments(file_path)
 
     if file_info.subtitle_streams:
@@ -666,7 +926,7 @@ def create_crf_command(file_path: pathlib.Path, output_path: pathlib.Path = None
     else:
         subtitle_arguments = ""
 
-    if file_info.audio_streams:
+    if file_info.audio_streams and include_audio:
         audio_arguments = _construct_audio_stream_arguments(file_info.audio_streams)
     else:
         audio_arguments = ""
@@ -680,6 +940,163 @@ def create_crf_command(file_path: pathlib.Path, output_path: pathlib.Path = None
     return " ".join(command.split()), output_path
 
 
+def create_multi_crf_command(file_path: pathlib.Path, outputs: typing.List[dict], threads: int = None,
+                             include_audio: bool = True) -> str:
+    """
+    Create a command to encode a file with several CRF settings at once, e.g. for several profiles.
+
+    The source is decoded (and filtered, if it needs deinterlacing) once, then split between one encoder per output,
+    rather than each encode decoding and filtering the whole file on its own.  Each output is otherwise the same as
+    what `create_crf_command` would produce for it.
+
+    :param file_path: path to source file to encode
+    :param outputs: one dict per output with its "output_path", "codec" (h264 or h265), "crf", "preset" and "tune"
+    :param threads: number of encoder threads, split between the encoders; encoder default if not set
+    :param include_audio: encode the audio tracks into every output, leave them out if they're transcoded separately
+                          (see `AudioTranscode`)
+    :return: command to encode every output
+    """
+    if not outputs:
+        raise ValueError("No outputs to encode [{}] to".format(file_path.name))
+
+    mkvtoolnix.add_media_statistics_if_necessary(file_path)
+    file_info = ffprobe.get_file_info(file_path)
+
+    command = "{} -i \"{}\"".format(BASE_FFMPEG_COMMAND, file_path)
+
+    # A filtered stream can only be used once, so it's split into one copy per encoder.  Unfiltered, every output can
+    # map the input stream itself; ffmpeg still only decodes it once.
+    video_filters = _get_video_filters(file_path)
+    if video_filters:
+        labels = ["[v{}]".format(x) for x in range(len(outputs))]
+        command += " -filter_complex \"[0:v:0]{},split={}{}\"".format(video_filters, len(outputs), "".join(labels))
+        video_inputs = ["\"{}\"".format(x) for x in labels]
+    else:
+        video_inputs = ["0:v:0"] * len(outputs)
+
+    if file_info.subtitle_streams:
+        subtitle_arguments = "-map 0:s -c:s copy"
+    else:
+        subtitle_arguments = ""
+
+    if file_info.audio_streams and include_audio:
+        audio_arguments = _construct_audio_stream_arguments(file_info.audio_streams)
+    else:
+        audio_arguments = ""
+
+    # The encoders run side by side, so they share the threads rather than each starting one per core
+    encoder_threads = max(threads // len(outputs), 1) if threads else None
+
+    for output, video_input in zip(outputs, video_inputs):
+        if output["codec"] == "h264":
+            video_codec = "libx264"
+        elif output["codec"] == "h265":
+            video_codec = "libx265"
+        else:
+            raise ValueError("Got codec value [{}]; expected one of (h264,h265)".format(output["codec"]))
+
+        output["output_path"].parent.mkdir(exist_ok=True, parents=True)
+        video_stream_arguments = _construct_video_stream_arguments(
+            file_path, video_codec, "crf", output["crf"], output["preset"], output.get("tune", None), encoder_threads,
+            video_input=video_input
+        )
+        command += " -movflags use_metadata_tags {} {} {} \"{}\"".format(
+            video_stream_arguments, subtitle_arguments, audio_arguments, output["output_path"]
+        )
+
+    return " ".join(command.split())
+
+
+def create_audio_commands(file_path: pathlib.Path,
+                          output_directory: pathlib.Path) -> typing.List[typing.Tuple[str, pathlib.Path]]:
+    """
+    Create commands to encode each audio track of a file to its own sidecar file, with the same settings the track
+    would get as part of a full encode.  Muxed with the video afterwards, see `mkvtoolnix.mux_tracks`.
+
+    :param file_path: path to source file
+    :param output_directory: directory to write the sidecar files to
+    :return: command for each audio track and the path to the track's sidecar file, in track order
+    """
+    mkvtoolnix.add_media_statistics_if_necessary(file_path)
+    file_info = ffprobe.get_file_info(file_path)
+    if not file_info.audio_streams:
+        return []
+
+    commands = []
+    track_arguments = _construct_audio_track_arguments(file_info.audio_streams, separate_outputs=True)
+    for i, arguments in enumerate(track_arguments):
+        output_path = output_directory.joinpath("{}_audio{}.mka".format(file_path.stem, i))
+        command = "{} -i \"{}\" {} \"{}\"".format(BASE_FFMPEG_COMMAND, file_path, arguments, output_path)
+        commands.append((" ".join(command.split()), output_path))
+    return commands
+
+
+class AudioTranscode:
+    """
+    Encode the audio tracks of a file to sidecar files in the background, one ffmpeg process per track, while the video
+    is encoded on its own.  Audio only has to be encoded once however many times the video is (CRF retries, two-pass),
+    and the tracks don't wait on each other or on the video.
+    """
+
+    def __init__(self, file_path: pathlib.Path, output_directory: pathlib.Path, processes: int = None):
+        """
+        :param file_path: file to encode the audio tracks of
+        :param output_directory: directory to write the sidecar files to
+        :param processes: number of tracks to encode at once, all of them if not set
+        """
+        self.file_path = file_path
+        self.commands = create_audio_commands(file_path, output_directory)
+        self._cancel = threading.Event()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(processes or len(self.commands), 1), thread_name_prefix="audio"
+        )
+        self._futures = []
+
+    def start(self) -> "AudioTranscode":
+        for command, output_path in self.commands:
+            output_path.parent.mkdir(exist_ok=True, parents=True)
+            self._futures.append(self._executor.submit(
+                subprocess_handler.run_command_detailed, command, cancel_event=self._cancel,
+                max_lines=subprocess_handler.LOG_MAX_LINES
+            ))
+        log.debug("Encoding [{}] audio tracks of [{}] in the background".format(
+            len(self.commands), self.file_path.name
+        ))
+        return self
+
+    def wait(self) -> typing.List[pathlib.Path]:
+        """
+        Wait for every track to finish encoding.
+
+        :return: sidecar file of each track, in track order
+        """
+        output_paths = {x: y[1] for x, y in zip(self._futures, self.commands)}
+        # As they finish, so a failed track stops the others straight away
+        for future in concurrent.futures.as_completed(self._futures):
+            result = future.result()
+            if result.return_code != 0:
+                if result.stderr:
+                    log.debug(result.stderr)
+                self.cancel()
+                raise RuntimeError(
+                    "ffmpeg on [{}] returned code [{}]".format(output_paths[future].name, result.return_code)
+                )
+        self._executor.shutdown()
+        return [x[1] for x in self.commands]
+
+    def cancel(self) -> None:
+        """
+        Stop encoding, e.g. because the video encode failed, and delete the sidecar files.  Also cleans up once they've
+        been muxed.
+
+        :return: None
+        """
+        self._cancel.set()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        for _, output_path in self.commands:
+            output_path.unlink(missing_ok=True)
+
+
 def change_container(input_file: pathlib.Path, container: str = "mkv") -> pathlib.Path:
     """
     Remuxes video file to a different container.
@@ -727,78 +1144,28 @@ def handle_ffmpeg_return(file_info: ffprobe.FFProbeFile, command: str,
 
 def run_ffmpeg_command(command: str, frame_count: int, file_framerate: float = None,
                        print_output=False) -> (int, typing.List[str], typing.List[FFmpegOutput]):
+    """
+    Run an ffmpeg command, tracking its progress.
+
+    Only the last `progress.DEFAULT_HISTORY` lines of output and progress steps are kept, so memory use doesn't grow
+    with the length of the encode.
 
+    :param command: ffmpeg command to run
+    :param frame_count: number of frames in the input, for percentages and ETAs
+    :param file_framerate: optional parameter, provide this to calculate speed if ffmpeg returning 'N/A'
+    :param print_output: whether to log progress live or not
+    :return: return code, last lines of log output, last FFmpegOutput steps
+    """
     # TODO: figure out a way to print a cool progress bar if in an active terminal.
 
-    stdout = []
-    temp_stdout = []
-    output_steps = []
-    in_progress = False  # Used so we can ignore output before we start encoding
-    hit_end = False
-
-    process = subprocess.Popen(
-        shlex.split(command),
-        universal_newlines=True,
-        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-        encoding="utf-8", errors="backslashreplace"
-    )
+    tracker = progress.ProgressTracker(frame_count)
+    process = FFmpegProcess(command, on_line=tracker.add_line)
+
+    for output in process.read_progress(file_framerate=file_framerate):
+        tracker.update(output)
+        if print_output:
+            average_eta = seconds_to_duration(tracker.eta) if tracker.eta >= 0 else "?"
+            log.debug("{} | Avg. ETA: {:8s}".format(output.create_log_string(frame_count), average_eta))
 
-    while True:
-        process_stdout = process.stdout.readline().strip()
-        if process_stdout == "" and process.poll() is not None:
-            break
-
-        stdout.append(process_stdout)
-        if process_stdout and not hit_end:
-            if not in_progress and "frame=" in process_stdout:
-                in_progress = True
-
-            if in_progress and "=" in process_stdout and process_stdout.count("=") == 1:
-                if process_stdout.startswith("["):
-                    # This is to filter output like:
-                    #  `[null @ 0000029040a27780] Application provided invalid, <trunc> 0: 369 >= 369`
-                    # However sometimes that gets managed with what we're looking for, e.g.:
-                    #  `[null @ 0000029040a27780] frame=380`
-                    # I'm going to assume that this can't happen twice in a row, e.g.:
-                    #  `[null @ 0000029040a27780] frame=380`
-                    #  `[null @ 0000029040a27780] fps=74.63`
-                    # And check if "frame=" is present, and if so, extract it and process as normal
-                    if "frame=" in process_stdout:
-                        temp_stdout.append(process_stdout.strip().split("] ")[1])
-                    continue
-
-                # This is a corollary check to the check above.  In the event that ffmpeg sends an update to stdout
-                # while it's sending another message, you may get output like:
-                #  `[null @ 0000013894ef1f00] Application provided invalid, <trunc> 0: 1641 >= 1641`
-                #  `[null @ 0000013894ef1f00] frame=1646
-                #  `fps=67.94`
-                #  `<further progress output truncated>`
-                #  `Application provided invalid, <trunc> 0: 1645 >= 1645`
-                # The first message being sent gets interrupted by a progress update, then resumes being printed
-                # So this check is to handle that.
-                # I imagine there's a better solution here, but handling this edge case is easier for the moment.
-                if " " in process_stdout.strip().split("=")[0]:
-                    continue
-
-                temp_stdout.append(process_stdout.strip())
-
-                if "progress=" in process_stdout:
-                    output = format_ffmpeg_output(temp_stdout, file_framerate=file_framerate)
-                    output_steps.append(output)
-                    if print_output:
-                        remaining_frames = frame_count - output.frame
-                        if any([x.fps > 0 for x in output_steps]):
-                            average_eta = seconds_to_duration(
-                                remaining_frames / (sum([x.fps for x in output_steps]) / len(output_steps))
-                            )
-                        else:
-                            average_eta = "?"
-                        log.debug("{} | Avg. ETA: {:8s}".format(output.create_log_string(frame_count), average_eta))
-
-                    temp_stdout = []
-
-                    if "progress=end" in process_stdout:
-                        hit_end = True
-
-    return_code = process.poll()
-    return return_code, [x.strip() for x in stdout if x], output_steps
+    return_code = process.wait()
+    return return_code, list(tracker.lines), list(tracker.steps)
@@ -0,0 +1,88 @@
+import array
+import bisect
+import sys
+import typing
+import zlib
+
+
+class KeyframeIndex:
+    """
+    Sorted list of keyframe timestamps (in milliseconds) for the video stream of a file.
+
+    Stored as a zlib compressed array of deltas between keyframes, which is a few bytes per keyframe since GOPs are
+    usually a fixed length.  Decoding is done once when the index is loaded; every lookup afterwards is a binary search.
+    """
+
+    def __init__(self, timestamps: typing.Iterable[int]):
+        self.timestamps = array.array("q", sorted(set(int(x) for x in timestamps)))
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __repr__(self):
+        return "<KeyframeIndex with {} keyframes>".format(len(self.timestamps))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "KeyframeIndex":
+        deltas = array.array("q")
+        deltas.frombytes(zlib.decompress(data))
+        if sys.byteorder == "big":
+            deltas.byteswap()
+
+        index = cls([])
+        running_total = 0
+        for delta in deltas:
+            running_total += delta
+            index.timestamps.append(running_total)
+        return index
+
+    def to_bytes(self) -> bytes:
+        deltas = array.array("q")
+        previous = 0
+        for timestamp in self.timestamps:
+            deltas.append(timestamp - previous)
+            previous = timestamp
+
+        if sys.byteorder == "big":
+            deltas.byteswap()
+        return zlib.compress(deltas.tobytes(), 9)
+
+    def previous(self, timestamp: int) -> typing.Optional[int]:
+        """
+        Get the last keyframe at or before a timestamp, which is where a seek to that timestamp will actually land.
+
+        :param timestamp: timestamp in milliseconds
+        :return: timestamp of the keyframe in milliseconds, or None if there are no keyframes before the timestamp
+        """
+        position = bisect.bisect_right(self.timestamps, timestamp)
+        if position == 0:
+            return None
+        return self.timestamps[position - 1]
+
+    def next(self, timestamp: int) -> typing.Optional[int]:
+        """
+        Get the first keyframe at or after a timestamp.
+
+        :param timestamp: timestamp in milliseconds
+        :return: timestamp of the keyframe in milliseconds, or None if there are no keyframes after the timestamp
+        """
+        position = bisect.bisect_left(self.timestamps, timestamp)
+        if position == len(self.timestamps):
+            return None
+        return self.timestamps[position]
+
+    def nearest(self, timestamp: int) -> typing.Optional[int]:
+        """
+        Get the keyframe closest to a timestamp, in either direction.  Ties go to the earlier keyframe.
+
+        :param timestamp: timestamp in milliseconds
+        :return: timestamp of the keyframe in milliseconds, or None if the index is empty
+        """
+        before = self.previous(timestamp)
+        after = self.next(timestamp)
+
+        if before is None:
+            return after
+        if after is None:
+            return before
+        return before if timestamp - before <= after - timestamp else after
@@ -0,0 +1,459 @@
+import fractions
+import pathlib
+import struct
+import typing
+
+
+# Reads the header elements of a Matroska file (Segment Info, Tracks and Tags) and returns them in the same shape as
+# `ffprobe -show_streams -show_format -of json`, without running ffprobe.  Nothing but the few KB of header elements is
+# read: clusters are skipped using the SeekHead, or by seeking past them.
+#
+# Only files that can be described with certainty are handled.  Anything else (not Matroska, still being written,
+# undetermined interlacing, codecs not listed below, attachments, no tags) returns None so the caller can fall back to
+# ffprobe.
+#
+# Element reference: https://www.matroska.org/technical/elements.html
+
+########################################################################################################################
+# Element IDs
+########################################################################################################################
+EBML = 0x1A45DFA3
+DOC_TYPE = 0x4282
+
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEK_ID = 0x53AB
+SEEK_POSITION = 0x53AC
+
+INFO = 0x1549A966
+TIMESTAMP_SCALE = 0x2AD7B1
+DURATION = 0x4489
+TITLE = 0x7BA9
+MUXING_APP = 0x4D80
+
+TRACKS = 0x1654AE6B
+TRACK_ENTRY = 0xAE
+TRACK_UID = 0x73C5
+TRACK_TYPE = 0x83
+CODEC_ID = 0x86
+NAME = 0x536E
+LANGUAGE = 0x22B59C
+FLAG_DEFAULT = 0x88
+FLAG_FORCED = 0x55AA
+DEFAULT_DURATION = 0x23E383
+VIDEO = 0xE0
+PIXEL_WIDTH = 0xB0
+PIXEL_HEIGHT = 0xBA
+FLAG_INTERLACED = 0x9A
+FIELD_ORDER = 0x9D
+AUDIO = 0xE1
+SAMPLING_FREQUENCY = 0xB5
+CHANNELS = 0x9F
+
+TAGS = 0x1254C367
+TAG = 0x7373
+TARGETS = 0x63C0
+TAG_TRACK_UID = 0x63C5
+SIMPLE_TAG = 0x67C8
+TAG_NAME = 0x45A3
+TAG_LANGUAGE = 0x447A
+TAG_STRING = 0x4487
+
+ATTACHMENTS = 0x1941A469
+CLUSTER = 0x1F43B675
+
+# Top level elements that are read in full, everything else is skipped
+_HEADER_ELEMENTS = [SEEK_HEAD, INFO, TRACKS, TAGS, ATTACHMENTS]
+
+# Header elements are a few KB, anything claiming to be bigger than this is garbage (or not a header)
+_MAX_HEADER_ELEMENT_SIZE = 16 * 1024 * 1024
+
+TRACK_TYPES = {1: "video", 2: "audio", 17: "subtitle"}
+
+# Matroska codec IDs to ffprobe codec names
+CODEC_NAMES = {
+    "V_MPEG4/ISO/AVC": "h264",
+    "V_MPEGH/ISO/HEVC": "hevc",
+    "V_AV1": "av1",
+    "V_VP8": "vp8",
+    "V_VP9": "vp9",
+    "V_MPEG2": "mpeg2video",
+    "A_AAC": "aac",
+    "A_AC3": "ac3",
+    "A_EAC3": "eac3",
+    "A_DTS": "dts",
+    "A_TRUEHD": "truehd",
+    "A_FLAC": "flac",
+    "A_OPUS": "opus",
+    "A_VORBIS": "vorbis",
+    "A_MPEG/L3": "mp3",
+    "S_TEXT/UTF8": "subrip",
+    "S_TEXT/ASS": "ass",
+    "S_TEXT/SSA": "ass",
+    "S_HDMV/PGS": "hdmv_pgs_subtitle",
+    "S_VOBSUB": "dvd_subtitle",
+}
+
+# FieldOrder values to ffprobe's field_order
+FIELD_ORDERS = {0: "progressive", 1: "tt", 6: "bb", 9: "bt", 14: "tb"}
+
+
+class MatroskaError(ValueError):
+    pass
+
+
+########################################################################################################################
+# EBML
+########################################################################################################################
+def _read_vint(data: bytes, position: int, keep_marker: bool = False) -> typing.Tuple[int, int, bool]:
+    """
+    Read a variable length integer (element ID or size).
+
+    :param data: buffer to read from
+    :param position: offset of the integer in the buffer
+    :param keep_marker: keep the length marker bit (element IDs are written with it)
+    :return: value, offset after the integer, whether the value is "unknown" (all ones, for sizes)
+    """
+    if position >= len(data):
+        raise MatroskaError("Unexpected end of data")
+
+    first_byte = data[position]
+    if first_byte == 0:
+        raise MatroskaError("Invalid variable length integer at [{}]".format(position))
+
+    length = 9 - first_byte.bit_length()
+    if position + length > len(data):
+        raise MatroskaError("Unexpected end of data")
+
+    value = first_byte if keep_marker else first_byte & ((1 << (8 - length)) - 1)
+    for byte in data[position + 1:position + length]:
+        value = (value << 8) | byte
+
+    unknown = not keep_marker and value == (1 << (7 * length)) - 1
+    return value, position + length, unknown
+
+
+def _iterate_elements(data: bytes, start: int = 0,
+                      end: int = None) -> typing.Iterator[typing.Tuple[int, int, int]]:
+    """
+    Iterate the child elements in a buffer.
+
+    :param data: buffer holding the elements
+    :param start: offset of the first element
+    :param end: offset the elements end at, defaults to the end of the buffer
+    :return: iterator of (element ID, data start, data end)
+    """
+    end = len(data) if end is None else end
+    position = start
+    while position < end:
+        element_id, position, _ = _read_vint(data, position, keep_marker=True)
+        size, position, unknown = _read_vint(data, position)
+        if unknown or position + size > end:
+            raise MatroskaError("Element [{:X}] doesn't fit in its parent".format(element_id))
+        yield element_id, position, position + size
+        position += size
+
+
+def _read_uint(data: bytes) -> int:
+    return int.from_bytes(data, "big")
+
+
+def _read_float(data: bytes) -> float:
+    if len(data) == 4:
+        return struct.unpack(">f", data)[0]
+    elif len(data) == 8:
+        return struct.unpack(">d", data)[0]
+    return 0.0
+
+
+def _read_string(data: bytes) -> str:
+    return data.decode("utf-8", errors="replace").rstrip("\x00")
+
+
+def _read_element_header(file: typing.BinaryIO, position: int) -> typing.Tuple[int, int, int, bool]:
+    """
+    Read the ID and size of an element in a file.
+
+    :param file: file to read from
+    :param position: offset of the element in the file
+    :return: element ID, offset of the element's data, size of the element's data, whether the size is unknown
+    """
+    file.seek(position)
+    header = file.read(12)
+    element_id, offset, _ = _read_vint(header, 0, keep_marker=True)
+    size, offset, unknown = _read_vint(header, offset)
+    return element_id, position + offset, size, unknown
+
+
+########################################################################################################################
+# Matroska
+########################################################################################################################
+def _parse_info(data: bytes) -> dict:
+    info = {"timestamp_scale": 1000000}
+    for element_id, start, end in _iterate_elements(data):
+        if element_id == TIMESTAMP_SCALE:
+            info["timestamp_scale"] = _read_uint(data[start:end])
+        elif element_id == DURATION:
+            info["duration"] = _read_float(data[start:end])
+        elif element_id == TITLE:
+            info["title"] = _read_string(data[start:end])
+        elif element_id == MUXING_APP:
+            info["muxing_app"] = _read_string(data[start:end])
+    return info
+
+
+def _frame_rate_string(default_duration: int) -> str:
+    # Frame durations are stored in whole nanoseconds, so 24000/1001 is 41708333ns, not exactly 1001/24000s.
+    # Snap to the nearest integer or NTSC rate ffprobe would report.
+    frame_rate = 1000000000 / default_duration
+    for denominator in [1, 1001]:
+        numerator = round(frame_rate * denominator)
+        if numerator and abs(numerator / denominator - frame_rate) < 0.001:
+            return "{}/{}".format(numerator, denominator)
+
+    fraction = fractions.Fraction(1000000000, default_duration).limit_denominator(1001)
+    return "{}/{}".format(fraction.numerator, fraction.denominator)
+
+
+def _parse_track(data: bytes, start: int, end: int, index: int) -> typing.Tuple[int, dict]:
+    track = {"uid": None, "type": None, "codec_id": None, "language": "eng", "default": 1, "forced": 0}
+    video = {}
+    audio = {}
+
+    for element_id, child_start, child_end in _iterate_elements(data, start, end):
+        value = data[child_start:child_end]
+        if element_id == TRACK_UID:
+            track["uid"] = _read_uint(value)
+        elif element_id == TRACK_TYPE:
+            track["type"] = _read_uint(value)
+        elif element_id == CODEC_ID:
+            track["codec_id"] = _read_string(value)
+        elif element_id == NAME:
+            track["name"] = _read_string(value)
+        elif element_id == LANGUAGE:
+            track["language"] = _read_string(value)
+        elif element_id == FLAG_DEFAULT:
+            track["default"] = _read_uint(value)
+        elif element_id == FLAG_FORCED:
+            track["forced"] = _read_uint(value)
+        elif element_id == DEFAULT_DURATION:
+            track["default_duration"] = _read_uint(value)
+        elif element_id == VIDEO:
+            for video_id, video_start, video_end in _iterate_elements(data, child_start, child_end):
+                video[video_id] = data[video_start:video_end]
+        elif element_id == AUDIO:
+            for audio_id, audio_start, audio_end in _iterate_elements(data, child_start, child_end):
+                audio[audio_id] = data[audio_start:audio_end]
+
+    codec_type = TRACK_TYPES.get(track["type"])
+    codec_name = CODEC_NAMES.get(track["codec_id"])
+    if not codec_type or not codec_name:
+        raise MatroskaError("Track [{}] has unsupported type/codec [{}]".format(index, track["codec_id"]))
+
+    stream = {
+        "index": index,
+        "codec_name": codec_name,
+        "codec_type": codec_type,
+        "disposition": {"default": track["default"], "forced": track["forced"], "attached_pic": 0},
+        "tags": {}
+    }
+    if track["language"] and track["language"] != "und":
+        stream["tags"]["language"] = track["language"]
+    if track.get("name"):
+        stream["tags"]["title"] = track["name"]
+
+    if codec_type == "video":
+        if PIXEL_WIDTH not in video or PIXEL_HEIGHT not in video or "default_duration" not in track:
+            raise MatroskaError("Video track [{}] missing dimensions or frame rate".format(index))
+
+        # 0 is "undetermined", which ffprobe would work out from the bitstream, so leave it to ffprobe
+        interlaced = _read_uint(video.get(FLAG_INTERLACED, b"\x00"))
+        if interlaced == 2:
+            field_order = "progressive"
+        elif interlaced == 1 and _read_uint(video.get(FIELD_ORDER, b"\x02")) in FIELD_ORDERS:
+            field_order = FIELD_ORDERS[_read_uint(video[FIELD_ORDER])]
+        else:
+            raise MatroskaError("Video track [{}] has undetermined interlacing".format(index))
+
+        stream["width"] = _read_uint(video[PIXEL_WIDTH])
+        stream["height"] = _read_uint(video[PIXEL_HEIGHT])
+        stream["field_order"] = field_order
+        stream["r_frame_rate"] = _frame_rate_string(track["default_duration"])
+        stream["avg_frame_rate"] = stream["r_frame_rate"]
+    elif codec_type == "audio":
+        stream["channels"] = _read_uint(audio.get(CHANNELS, b"\x01"))
+        stream["sample_rate"] = str(int(_read_float(audio.get(SAMPLING_FREQUENCY, struct.pack(">f", 8000.0)))))
+
+    return track["uid"], stream
+
+
+def _parse_tracks(data: bytes) -> typing.Tuple[typing.List[dict], typing.Dict[int, dict]]:
+    streams = []
+    streams_by_uid = {}
+    for element_id, start, end in _iterate_elements(data):
+        if element_id == TRACK_ENTRY:
+            uid, stream = _parse_track(data, start, end, len(streams))
+            streams.append(stream)
+            streams_by_uid[uid] = stream
+    return streams, streams_by_uid
+
+
+def _parse_tags(data: bytes) -> typing.List[typing.Tuple[typing.List[int], typing.Dict[str, str]]]:
+    """
+    :return: list of (track UIDs the tag applies to, empty for the whole file; tag values)
+    """
+    tags = []
+    for element_id, start, end in _iterate_elements(data):
+        if element_id != TAG:
+            continue
+
+        track_uids = []
+        values = {}
+        for tag_id, tag_start, tag_end in _iterate_elements(data, start, end):
+            if tag_id == TARGETS:
+                for target_id, target_start, target_end in _iterate_elements(data, tag_start, tag_end):
+                    if target_id == TAG_TRACK_UID:
+                        track_uids.append(_read_uint(data[target_start:target_end]))
+            elif tag_id == SIMPLE_TAG:
+                name, language, string = None, "und", None
+                for simple_id, simple_start, simple_end in _iterate_elements(data, tag_start, tag_end):
+                    if simple_id == TAG_NAME:
+                        name = _read_string(data[simple_start:simple_end])
+                    elif simple_id == TAG_LANGUAGE:
+                        language = _read_string(data[simple_start:simple_end])
+                    elif simple_id == TAG_STRING:
+                        string = _read_string(data[simple_start:simple_end])
+
+                # Same naming as ffprobe: the language is appended unless it's undetermined, e.g. "BPS-eng"
+                if name and string is not None:
+                    values[name if language == "und" else "{}-{}".format(name, language)] = string
+        tags.append(([x for x in track_uids if x != 0], values))
+    return tags
+
+
+def _read_header_elements(file: typing.BinaryIO, file_size: int) -> typing.Dict[int, typing.List[bytes]]:
+    """
+    Read the header elements of the first segment of a file.
+
+    Top level elements are walked in order until the first cluster, then any header elements the SeekHead(s) point to
+    that haven't been read yet (mkvpropedit often writes tags to the end of the file) are read directly.
+
+    :param file: file to read
+    :param file_size: size of the file
+    :return: contents of each header element, by element ID
+    """
+    element_id, position, size, unknown = _read_element_header(file, 0)
+    if element_id != EBML:
+        raise MatroskaError("Not an EBML file")
+    file.seek(position)
+    header = file.read(size)
+    for child_id, start, end in _iterate_elements(header):
+        if child_id == DOC_TYPE and _read_string(header[start:end]) not in ["matroska", "webm"]:
+            raise MatroskaError("Not a Matroska file")
+
+    element_id, segment_start, segment_size, unknown = _read_element_header(file, position + size)
+    if element_id != SEGMENT:
+        raise MatroskaError("No segment after EBML header")
+    if unknown or segment_start + segment_size > file_size:
+        raise MatroskaError("Segment is incomplete (file still being written?)")
+
+    elements: typing.Dict[int, typing.List[bytes]] = {}
+    read_positions = set()
+    seek_positions = []
+
+    def read_element(element_position: int) -> typing.Tuple[int, int]:
+        # Reads the element at a position if it's a header element, returns its ID and the position after it
+        child_id, data_start, data_size, child_unknown = _read_element_header(file, element_position)
+        if child_unknown:
+            raise MatroskaError("Element [{:X}] has an unknown size".format(child_id))
+        if child_id in _HEADER_ELEMENTS and element_position not in read_positions:
+            if data_size > _MAX_HEADER_ELEMENT_SIZE:
+                raise MatroskaError("Element [{:X}] is too large".format(child_id))
+            read_positions.add(element_position)
+            file.seek(data_start)
+            data = file.read(data_size)
+            elements.setdefault(child_id, []).append(data)
+
+            if child_id == SEEK_HEAD:
+                for seek_id, seek_start, seek_end in _iterate_elements(data):
+                    if seek_id != SEEK:
+                        continue
+                    target_id, target_position = None, None
+                    for entry_id, entry_start, entry_end in _iterate_elements(data, seek_start, seek_end):
+                        if entry_id == SEEK_ID:
+                            target_id = _read_uint(data[entry_start:entry_end])
+                        elif entry_id == SEEK_POSITION:
+                            target_position = _read_uint(data[entry_start:entry_end])
+                    if target_id in _HEADER_ELEMENTS and target_position is not None:
+                        seek_positions.append(segment_start + target_position)
+        return child_id, data_start + data_size
+
+    position = segment_start
+    segment_end = segment_start + segment_size
+    while position < segment_end:
+        child_id, position = read_element(position)
+        if child_id == CLUSTER:
+            break
+
+    # SeekHeads can point to further SeekHeads, so this list can grow while it's being read
+    for seek_position in seek_positions:
+        if seek_position not in read_positions and seek_position < segment_end:
+            read_element(seek_position)
+
+    return elements
+
+
+def get_ffprobe_output(file_path: pathlib.Path) -> typing.Optional[dict]:
+    """
+    Get the information `ffprobe -show_streams -show_format -of json` would give for a Matroska file, by reading its
+    header elements directly.
+
+    Only the fields this project uses are filled in.
+
+    :param file_path: file to read
+    :return: dict with "streams" and "format", or None if the file can't be handled (use ffprobe instead)
+    """
+    try:
+        file_size = file_path.stat().st_size
+        with file_path.open("rb") as file:
+            elements = _read_header_elements(file, file_size)
+
+        if ATTACHMENTS in elements:
+            raise MatroskaError("Attachments are listed as streams by ffprobe")
+        if INFO not in elements or TRACKS not in elements or TAGS not in elements:
+            raise MatroskaError("Missing segment info, tracks or tags")
+
+        info = _parse_info(elements[INFO][0])
+        if "duration" not in info:
+            raise MatroskaError("No duration")
+        streams, streams_by_uid = _parse_tracks(elements[TRACKS][0])
+
+        format_tags = {}
+        if info.get("title"):
+            format_tags["title"] = info["title"]
+        if info.get("muxing_app"):
+            format_tags["encoder"] = info["muxing_app"]
+        for tags_data in elements[TAGS]:
+            for track_uids, values in _parse_tags(tags_data):
+                if not track_uids:
+                    format_tags.update(values)
+                for track_uid in track_uids:
+                    if track_uid in streams_by_uid:
+                        streams_by_uid[track_uid]["tags"].update(values)
+    except (MatroskaError, OSError, struct.error):
+        return None
+
+    duration = info["duration"] * info["timestamp_scale"] / 1000000000
+    return {
+        "streams": streams,
+        "format": {
+            "filename": str(file_path),
+            "nb_streams": len(streams),
+            "format_name": "matroska,webm",
+            "duration": "{:.6f}".format(duration),
+            "size": str(file_size),
+            "bit_rate": str(int(file_size * 8 / duration)) if duration > 0 else "N/A",
+            "tags": format_tags
+        }
+    }
@@ -7,7 +7,6 @@ import shutil
 from utils import log
 from utils import ffmpeg
 from utils import ffprobe
-from utils import mediainfo
 from utils import requests_handler
 
 
@@ -42,7 +41,7 @@ def _download_vmaf_model(neg_mode: bool) -> pathlib.Path:
 
 def create_metrics_command(reference: pathlib.Path, compressed: pathlib.Path,
                            neg_mode: bool = False, subsample_rate: int = 1,
-                           psnr: bool = True, ms_ssim: bool = True) -> str:
+                           psnr: bool = True, ms_ssim: bool = True, threads: int = None) -> str:
     if not reference.exists():
         raise ValueError("Path does not exist: [{}]".format(reference))
     if not compressed.exists():
@@ -56,8 +55,11 @@ def create_metrics_command(reference: pathlib.Path, compressed: pathlib.Path,
     #   On further research, this is only necessary if both videos have different framerates or variable framerates.
     #   What I encode does not have either of these issues, so this is not a concern.
 
-    allowed_thread_count = math.floor(multiprocessing.cpu_count() * 0.9)
-    command_template = "ffmpeg -progress - -nostats -hide_banner -y -stats_period 1 -loglevel warning"
+    if threads:
+        allowed_thread_count = threads
+    else:
+        allowed_thread_count = max(1, math.floor(multiprocessing.cpu_count() * 0.9))
+    command_template = "ffmpeg -nostats -hide_banner -y -stats_period 1 -loglevel warning"
     command_template += " -i \"{}\" -i \"{}\" -lavfi '{}libvmaf={}n_subsample={}"
     command_template += ":model=version={}|path={}:log_path=report.json:n_threads={}:log_fmt=json' -f null -"
 
@@ -73,8 +75,8 @@ def create_metrics_command(reference: pathlib.Path, compressed: pathlib.Path,
     # Adding the bwdif filter in the case where reference is interlaced and compressed isn't.
     # It would be a good idea to implement checks for when the reference isn't interlaced and the compressed is.
     # However, don't do that.
-    reference_scan_type = mediainfo.get_media_info(reference).video_stream.get("ScanType", "")
-    compressed_scan_type = mediainfo.get_media_info(compressed).video_stream.get("ScanType", "")
+    reference_scan_type = ffprobe.get_file_info(reference).scan_type
+    compressed_scan_type = ffprobe.get_file_info(compressed).scan_type
     if compressed_scan_type == "Progressive" and reference_scan_type != compressed_scan_type:
         interlace_filter = "[1:v]bwdif=0:-1:0[ref];[0:v][ref]"
     else:
@@ -157,7 +159,7 @@ def create_comparison_images(reference: pathlib.Path, compressed: pathlib.Path)
     else:
         deinterlace_argument = ",bwdif=0"
 
-    reference_arguments_template = "ffmpeg -progress - -nostats -hide_banner -y -stats_period 1 -loglevel"
+    reference_arguments_template = "ffmpeg -nostats -hide_banner -y -stats_period 1 -loglevel"
     reference_arguments_template += " warning -i \"{}\" -y -vf \"setpts=N/TB, {}, crop=(in_w)/2:in_h:0:0,"
     reference_arguments_template += " drawtext='{}':fontsize=36:fontcolor='white':text='0':x=10:y=10{}\""
     reference_arguments_template += " -vsync 0 \"{}/0_%04d.png\""
@@ -170,7 +172,7 @@ def create_comparison_images(reference: pathlib.Path, compressed: pathlib.Path)
     ffmpeg.handle_ffmpeg_return(reference_file_info, reference_images_arguments, print_output=False)
 
     compressed_file_info = ffprobe.get_file_info(compressed)
-    compressed_arguments_template = "ffmpeg -progress - -nostats -hide_banner -y -stats_period 1 -loglevel"
+    compressed_arguments_template = "ffmpeg -nostats -hide_banner -y -stats_period 1 -loglevel"
     compressed_arguments_template += " warning -i \"{}\" -y -vf \"setpts=N/TB, {}, crop=(in_w)/2:in_h:(in_w)/2:0,"
     compressed_arguments_template += " drawtext='{}':fontsize=36:fontcolor='white':text='1':x=w-10-text_w/2:y=10\""
     compressed_arguments_template += " -vsync 0 \"{}/1_%04d.png\""
@@ -184,7 +186,7 @@ def create_comparison_images(reference: pathlib.Path, compressed: pathlib.Path)
 
     log.debug("Creating comparison images between reference and compressed files")
     for x in range(1, len(low_frames) + 1):
-        command_template = "ffmpeg -progress - -nostats -hide_banner -y -stats_period 1 -y -i {} -i {}"
+        command_template = "ffmpeg -nostats -hide_banner -y -stats_period 1 -y -i {} -i {}"
         command_template += " -filter_complex \"hstack=inputs=2\" \"{}/{}.png\""
         command = command_template.format(
             "\"{}/0_{}.png\"".format(images_folder, str(x).zfill(4)),
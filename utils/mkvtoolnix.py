@@ -1,4 +1,6 @@
+import collections
 import pathlib
+import threading
 import typing
 
 from utils import ffprobe
@@ -6,12 +8,52 @@ from utils import log
 from utils import subprocess_handler
 
 
-def add_media_statistics(file_path: pathlib.Path) -> None:
+# Number of file versions (see `ffprobe.get_file_version`) remembered as having current statistics tags.  Calculating
+# statistics reads the whole file, so once a version is known to have them it's never read again for them.
+STATISTICS_CACHE_SIZE = 1024
+
+_statistics_versions: "collections.OrderedDict[tuple, None]" = collections.OrderedDict()
+_statistics_lock = threading.Lock()
+
+
+def _has_current_statistics(file_path: pathlib.Path) -> bool:
+    version = ffprobe.get_file_version(file_path)
+    with _statistics_lock:
+        if version in _statistics_versions:
+            _statistics_versions.move_to_end(version)
+            return True
+    return False
+
+
+def _set_current_statistics(file_path: pathlib.Path) -> None:
+    version = ffprobe.get_file_version(file_path)
+    with _statistics_lock:
+        _statistics_versions[version] = None
+        while len(_statistics_versions) > STATISTICS_CACHE_SIZE:
+            _statistics_versions.popitem(last=False)
+
+
+def add_media_statistics(file_path: pathlib.Path, force: bool = False) -> None:
+    """
+    Calculate track statistics (frame count, bytes, bitrate, etc.) with mkvpropedit and write them to the file's tags.
+
+    Statistics are calculated at most once per version of a file, later calls for the same version do nothing.
+
+    :param file_path: file to add statistics to
+    :param force: calculate statistics even if this version of the file already has them
+    :return: None
+    """
+    if not force and _has_current_statistics(file_path):
+        log.debug("Statistics of [{}] are already current".format(file_path))
+        return
+
     log.debug("Adding statistics to [{}]".format(file_path))
     command_template = "mkvpropedit --add-track-statistics-tags \"{}\""
     command = command_template.format(str(file_path).replace("\\", "/").replace("\\'", "'"))
 
-    code, out, err = subprocess_handler.run_command(command, print_output=False)
+    code, out, err = subprocess_handler.run_command(
+        command, print_output=False, max_lines=subprocess_handler.LOG_MAX_LINES
+    )
     if code != 0:
         if out:
             log.debug(out)
@@ -19,8 +61,15 @@ def add_media_statistics(file_path: pathlib.Path) -> None:
             log.error(err)
         raise RuntimeError("Command [{}] returned code [{}]".format(command, code))
 
+    # mkvpropedit edits in place, make sure the statistics tags are seen by the next probe
+    ffprobe.invalidate_file_info(file_path)
+    _set_current_statistics(file_path)
+
 
 def add_media_statistics_if_necessary(file_path: pathlib.Path) -> None:
+    if _has_current_statistics(file_path):
+        return
+
     file_information = ffprobe.get_file_info(file_path)
 
     if file_information.video_stream:
@@ -35,7 +84,9 @@ def add_media_statistics_if_necessary(file_path: pathlib.Path) -> None:
     statistics_present = bool(stream_to_check.get("tags", {}).get("_STATISTICS_WRITING_APP", None))
     if not statistics_present:
         log.debug("File [{}] missing statistics from mkvtoolnix".format(file_path))
-        add_media_statistics(file_path)
+        add_media_statistics(file_path, force=True)
+    else:
+        _set_current_statistics(file_path)
 
 
 def change_audio_titles(file_path: pathlib.Path, new_titles: typing.List[str]) -> None:
@@ -50,7 +101,9 @@ def change_audio_titles(file_path: pathlib.Path, new_titles: typing.List[str]) -
         command.append("--edit track:a{}".format(i + 1))
         command.append("--set \"name={}\"".format(new_titles[i]))
 
-    code, out, err = subprocess_handler.run_command(" ".join(command), print_output=False)
+    code, out, err = subprocess_handler.run_command(
+        " ".join(command), print_output=False, max_lines=subprocess_handler.LOG_MAX_LINES
+    )
     if code != 0:
         if out:
             log.debug(out)
@@ -58,6 +111,8 @@ def change_audio_titles(file_path: pathlib.Path, new_titles: typing.List[str]) -
             log.error(err)
         raise RuntimeError("Command [{}] returned code [{}]".format(" ".join(command), code))
 
+    ffprobe.invalidate_file_info(file_path)
+
 
 def unforce_subtitles(file_info: ffprobe.FFProbeFile) -> None:
     subs = [x for x in file_info.subtitle_streams]
@@ -73,10 +128,42 @@ def unforce_subtitles(file_info: ffprobe.FFProbeFile) -> None:
     if len(track_commands) > 0:
         log.debug("Unforcing subtitles")
         command = command_template.format(str(file_info.path), " ".join(track_commands))
-        code, out, err = subprocess_handler.run_command(command)
+        code, out, err = subprocess_handler.run_command(command, max_lines=subprocess_handler.LOG_MAX_LINES)
         if code != 0:
             if out:
                 log.debug(out)
             if err:
                 log.error(err)
             raise RuntimeError("Unforcing subtitles for [{}] returned code [{}]".format(file_info.path.name, code))
+        ffprobe.invalidate_file_info(file_info.path)
+
+
+def mux_tracks(file_path: pathlib.Path, track_files: typing.List[pathlib.Path], output_path: pathlib.Path) -> None:
+    """
+    Mux the tracks of several files into one with mkvmerge, in order: every track of the first file, then every track
+    of each of the others.  Used to add separately encoded audio (see `ffmpeg.AudioTranscode`) to an encoded video.
+
+    :param file_path: main file, its tracks come first
+    :param track_files: files with more tracks to add
+    :param output_path: muxed file
+    :return: None
+    """
+    log.debug("Muxing [{}] tracks into [{}]".format(len(track_files), output_path.name))
+    command = "mkvmerge --quiet -o \"{}\" {}".format(
+        output_path, " ".join("\"{}\"".format(x) for x in [file_path] + track_files)
+    )
+
+    # mkvmerge returns 1 for warnings, the output is still complete
+    code, out, err = subprocess_handler.run_command(
+        command, print_output=False, max_lines=subprocess_handler.LOG_MAX_LINES
+    )
+    if code not in [0, 1]:
+        if out:
+            log.debug(out)
+        if err:
+            log.error(err)
+        raise RuntimeError("Muxing [{}] returned code [{}]".format(output_path.name, code))
+    if code == 1 and out:
+        log.warning(out)
+
+    ffprobe.invalidate_file_info(output_path)
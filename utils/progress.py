@@ -0,0 +1,224 @@
+import collections
+import json
+import threading
+import time
+import typing
+
+import requests
+
+from utils import log
+from utils import requests_handler
+
+
+# Number of raw output lines and progress updates kept for debugging a failed run.  With `-stats_period 1`, ffmpeg
+# prints about 12 lines a second, so this is the last minute or so.
+DEFAULT_HISTORY = 1000
+
+# Weight of the newest sample in the moving average the ETA is based on.  0.05 is a time constant of ~20 updates, which
+# smooths out the per-second jitter of ffmpeg without lagging far behind a real change in speed (e.g. a scene change).
+DEFAULT_ALPHA = 0.05
+
+
+class ProgressTracker:
+    """
+    Running statistics for a long-running ffmpeg command.  Every update is O(1) in time and memory regardless of how
+    long the command runs; only the last `history` lines/updates are kept, for logging if the command fails.
+
+    * `average_fps`: mean of every fps value ffmpeg reported, same as the worker always sent to the manager
+    * `ewma_fps`: exponentially weighted moving average of the fps between updates, used for the ETA, so it reacts to
+      the current speed of the encode instead of being dragged down by a slow start (or up by a fast one)
+    """
+
+    def __init__(self, frame_count: int, alpha: float = DEFAULT_ALPHA, history: int = DEFAULT_HISTORY):
+        self.frame_count: int = frame_count
+        self.alpha: float = alpha
+
+        self.lines: typing.Deque[str] = collections.deque(maxlen=history)
+        self.steps: typing.Deque[typing.Any] = collections.deque(maxlen=history)
+
+        self.updates: int = 0
+        self.frame: int = 0
+        self.fps_total: float = 0.0
+        self.ewma_fps: float = 0.0
+        self.start_time: float = time.monotonic()
+
+        self._last_frame: int = 0
+        self._last_time: typing.Optional[float] = None
+
+    def __repr__(self):
+        return "<ProgressTracker {}/{} frames, {} updates>".format(self.frame, self.frame_count, self.updates)
+
+    def add_line(self, line: str) -> None:
+        """
+        Keep a line of raw output, dropping the oldest one if the buffer is full.
+
+        :param line: line of output
+        :return: None
+        """
+        self.lines.append(line)
+
+    def update(self, step, now: float = None) -> None:
+        """
+        Add a progress update.
+
+        :param step: progress update from ffmpeg (anything with `frame` and `fps` attributes)
+        :param now: monotonic time the update was received, defaults to now
+        :return: None
+        """
+        now = time.monotonic() if now is None else now
+
+        self.steps.append(step)
+        self.updates += 1
+        self.frame = step.frame
+        self.fps_total += step.fps
+
+        # fps between this update and the previous one.  The first update only has ffmpeg's own fps to go off.
+        if self._last_time is not None and now > self._last_time:
+            instant_fps = (step.frame - self._last_frame) / (now - self._last_time)
+        else:
+            instant_fps = step.fps
+
+        if instant_fps > 0:
+            if self.ewma_fps > 0:
+                self.ewma_fps = self.alpha * instant_fps + (1 - self.alpha) * self.ewma_fps
+            else:
+                self.ewma_fps = instant_fps
+
+        self._last_frame = step.frame
+        self._last_time = now
+
+    @property
+    def average_fps(self) -> float:
+        if self.updates == 0:
+            return 0.0
+        return self.fps_total / self.updates
+
+    @property
+    def remaining_frames(self) -> int:
+        return max(self.frame_count - self.frame, 0)
+
+    @property
+    def eta(self) -> float:
+        """
+        :return: estimated seconds remaining, or -1 if there's no estimate yet
+        """
+        if self.ewma_fps <= 0:
+            return -1
+        return self.remaining_frames / self.ewma_fps
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start_time
+
+
+########################################################################################################################
+# Reporting
+########################################################################################################################
+# How long a request to the manager can take before it's abandoned.  Progress is sent again soon enough anyway.
+REPORT_TIMEOUT = 10
+
+# Reports are sent at most once per this many times the manager's response time, so a slow manager gets fewer
+# requests instead of a growing backlog of them.
+REPORT_LATENCY_MULTIPLIER = 10
+
+
+class ProgressReporter:
+    """
+    Sends progress updates to the manager from a background thread, so a slow (or unreachable) manager never holds up
+    the ffmpeg output loop.  The thread uses its own session, sessions aren't shared between threads.
+
+    Only the latest update matters, so `report` just replaces whatever is waiting to be sent and returns immediately.
+    The thread sends at most one request every `interval` seconds.  The interval adapts to the manager: it's
+    REPORT_LATENCY_MULTIPLIER times the average response time (between `min_interval` and `max_interval`), and doubles
+    after every failed request.
+    """
+
+    def __init__(self, url: str, headers: dict = None, min_interval: float = 1.0, max_interval: float = 30.0):
+        self.url = url
+        self.headers = headers or {}
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.latency: typing.Optional[float] = None
+        self.sent: int = 0
+        self.failed: int = 0
+
+        self._pending: typing.Optional[dict] = None
+        self._closing = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="progress-reporter", daemon=True)
+        self._thread.start()
+
+    def __repr__(self):
+        return "<ProgressReporter {} sent, {} failed, every {:.1f}s>".format(self.sent, self.failed, self.interval)
+
+    def report(self, data: dict) -> None:
+        """
+        Queue an update to send, replacing any update that hasn't been sent yet.  Never blocks on the network.
+
+        :param data: update to send as JSON
+        :return: None
+        """
+        with self._condition:
+            self._pending = data
+            self._condition.notify()
+
+    def close(self, data: dict = None, timeout: float = REPORT_TIMEOUT) -> None:
+        """
+        Send any final update (and anything still waiting) right away, then stop the thread.
+
+        :param data: final update to send, e.g. 100% progress
+        :param timeout: seconds to wait for the last update to be sent
+        :return: None
+        """
+        with self._condition:
+            if data is not None:
+                self._pending = data
+            self._closing = True
+            self._condition.notify()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            log.warning("Timed out sending the last progress update to the manager")
+
+    def _run(self) -> None:
+        last_send = 0.0
+        while True:
+            with self._condition:
+                # Wait for an update, and for the interval since the last request to pass (unless closing)
+                while not self._closing:
+                    remaining = last_send + self.interval - time.monotonic()
+                    if self._pending is not None and remaining <= 0:
+                        break
+                    self._condition.wait(remaining if self._pending is not None else None)
+
+                data = self._pending
+                self._pending = None
+                closing = self._closing
+
+            if data is not None:
+                last_send = time.monotonic()
+                self._send(data)
+            if closing:
+                # The thread's own session (see `requests_handler.get_session`)
+                requests_handler.close_session()
+                return
+
+    def _send(self, data: dict) -> None:
+        start_time = time.monotonic()
+        try:
+            response = requests_handler.get_session().post(
+                self.url, data=json.dumps(data), headers=self.headers, timeout=REPORT_TIMEOUT
+            )
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            self.failed += 1
+            self.interval = min(self.interval * 2, self.max_interval)
+            log.warning("Could not send progress update to manager ({}), next in [{:.1f}]s".format(
+                type(e).__name__, self.interval
+            ))
+            return
+
+        latency = time.monotonic() - start_time
+        self.latency = latency if self.latency is None else 0.2 * latency + 0.8 * self.latency
+        self.interval = min(max(self.latency * REPORT_LATENCY_MULTIPLIER, self.min_interval), self.max_interval)
+        self.sent += 1
@@ -4,21 +4,107 @@ import pika
 from utils import config
 
 
-def send_message(message: dict) -> None:
+# Queues with a dead-letter queue (a worker's own queue, see `distributor.scheduler.get_affinity_queue`) are deleted
+# after going this long without a consumer, so workers that are gone for good don't leave queues behind.  Their
+# messages expire long before that.
+#
+# Those messages expire by a TTL on the queue rather than on each message: RabbitMQ only expires a message with its own
+# TTL once it reaches the head of the queue, so one stuck behind a higher priority (or longer lived) message could wait
+# there indefinitely instead of moving to its dead-letter queue.
+DEAD_LETTER_QUEUE_EXPIRY_MS = 7 * 24 * 60 * 60 * 1000
+
+
+def declare_queue(channel: pika.adapters.blocking_connection.BlockingChannel, queue: str,
+                  dead_letter_queue: str = None, message_ttl_seconds: float = None) -> None:
+    """
+    Declare a task queue.  Both the manager and the workers declare queues, and RabbitMQ refuses a declaration with
+    different arguments than the existing queue, so everything should go through here.
+
+    :param channel: channel to declare the queue on
+    :param queue: name of the queue
+    :param dead_letter_queue: queue that expired messages are moved to, if any
+    :param message_ttl_seconds: how long messages wait in the queue before expiring, None to never expire
+    :return: None
+    """
+    arguments = {"x-max-priority": config.load_rabbitmq_config()["max_priority"]}
+    if dead_letter_queue:
+        arguments["x-dead-letter-exchange"] = ""
+        arguments["x-dead-letter-routing-key"] = dead_letter_queue
+        arguments["x-expires"] = DEAD_LETTER_QUEUE_EXPIRY_MS
+    if message_ttl_seconds:
+        arguments["x-message-ttl"] = int(message_ttl_seconds * 1000)
+    channel.queue_declare(queue=queue, durable=True, arguments=arguments)
+
+
+def send_message(message: dict, queue: str = None, priority: int = 0,
+                 dead_letter_queue: str = None, message_ttl_seconds: float = None) -> None:
+    """
+    Send a persistent message to a task queue.
+
+    :param message: message to send, will be JSON encoded
+    :param queue: queue to send the message to, defaults to the encode queue
+    :param priority: message priority, higher priority messages are delivered first (0 to max_priority)
+    :param dead_letter_queue: queue the message is moved to once it expires, see `declare_queue`
+    :param message_ttl_seconds: TTL of the queue's messages, see `declare_queue`
+    :return: None
+    """
+    rabbitmq_config = config.load_rabbitmq_config()
+    if not queue:
+        queue = rabbitmq_config["encode_queue"]
+
     # Setup connection
-    connection = pika.BlockingConnection(pika.ConnectionParameters(config.load_rabbitmq_config()["broker"]))
+    connection = pika.BlockingConnection(pika.ConnectionParameters(rabbitmq_config["broker"]))
     channel = connection.channel()
 
     # Create a message queue
-    channel.queue_declare(queue=config.load_rabbitmq_config()["queue"], durable=True)
+    declare_queue(channel, queue, dead_letter_queue=dead_letter_queue, message_ttl_seconds=message_ttl_seconds)
+    if dead_letter_queue:
+        # Expired messages are dropped if their dead-letter queue doesn't exist
+        declare_queue(channel, dead_letter_queue)
 
     # Send message
     channel.basic_publish(
         exchange="",
-        routing_key=config.load_rabbitmq_config()["queue"],
+        routing_key=queue,
         body=json.dumps(message).encode(),
-        properties=pika.BasicProperties(delivery_mode=2)  # Persistent messages
+        properties=pika.BasicProperties(
+            delivery_mode=2,  # Persistent messages
+            priority=max(0, min(priority, rabbitmq_config["max_priority"]))
+        )
     )
 
     # Closing properly
     connection.close()
+
+
+def move_messages(source_queue: str, destination_queue: str) -> int:
+    """
+    Move every message waiting in a task queue to another task queue, keeping their priorities.
+
+    :param source_queue: queue to empty
+    :param destination_queue: queue to move the messages to
+    :return: number of messages moved
+    """
+    rabbitmq_config = config.load_rabbitmq_config()
+
+    # Setup connection
+    connection = pika.BlockingConnection(pika.ConnectionParameters(rabbitmq_config["broker"]))
+    channel = connection.channel()
+    # Publishing blocks until the broker has the message, so nothing is acknowledged before it's been moved
+    channel.confirm_delivery()
+
+    declare_queue(channel, source_queue)
+    declare_queue(channel, destination_queue)
+
+    moved = 0
+    while True:
+        method, properties, body = channel.basic_get(queue=source_queue)
+        if method is None:
+            break
+        channel.basic_publish(exchange="", routing_key=destination_queue, body=body, properties=properties)
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+        moved += 1
+
+    # Closing properly
+    connection.close()
+    return moved
@@ -1,6 +1,37 @@
+import threading
+
 import requests
 
 
+# Sessions aren't guaranteed to be thread-safe, so each thread gets its own
+_local = threading.local()
+
+
+def get_session() -> requests.Session:
+    """
+    Get the session of the current thread, so repeated requests to the manager from it reuse one keep-alive connection
+    instead of opening a new one every time.
+
+    :return: session of the current thread
+    """
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = _local.session = requests.Session()
+    return session
+
+
+def close_session() -> None:
+    """
+    Close the session of the current thread, if it has one, e.g. before a short-lived thread exits.
+
+    :return: None
+    """
+    session = getattr(_local, "session", None)
+    if session is not None:
+        session.close()
+        _local.session = None
+
+
 def send_get_request(url: str, **kwargs) -> requests.Response:
     """
     Send a GET request to a URL with arbitrary parameter dict kwargs, return the response with proper encoding if the
@@ -0,0 +1,186 @@
+import os
+import pathlib
+import shutil
+import threading
+import typing
+
+from utils import log
+
+
+class SourceCache:
+    """
+    Cache of source files on a worker, so tasks on the same source (an encode for each profile, then metrics for each
+    encode) download it once.
+
+    Files are stored by their contents where possible: the manager's fingerprint and size, so a source that was renamed
+    or copied is still a hit.  Files without a fingerprint are stored by their ID and size instead.  Once the cache is
+    over its size cap, the least recently used files are deleted first.
+
+    Files are hardlinked into and out of the cache, so a hit costs nothing and deleting a task's working directory
+    leaves the cached copy.  The cache directory can be shared by every slot on a machine.
+    """
+
+    def __init__(self, directory: pathlib.Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_key(file_information: dict) -> typing.Optional[str]:
+        """
+        Get the cache key of a file, from its information as the manager serializes it.
+
+        :param file_information: file information, with its ID, size and fingerprint
+        :return: cache key, None if there isn't enough information to cache the file
+        """
+        if not file_information or file_information.get("size") in [None, -1]:
+            return None
+        if file_information.get("fingerprint"):
+            return "{}-{}".format(file_information["fingerprint"], file_information["size"])
+        if file_information.get("id") is not None:
+            return "file{}-{}".format(file_information["id"], file_information["size"])
+        return None
+
+    def is_enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _get_path(self, key: str) -> pathlib.Path:
+        return self.directory.joinpath(key)
+
+    def fetch(self, key: str, destination: pathlib.Path) -> bool:
+        """
+        Put a cached file at the destination, if it's in the cache.
+
+        :param key: cache key of the file, see `get_key`
+        :param destination: where to put the file
+        :return: whether the file was in the cache
+        """
+        cached_file = self._get_path(key)
+        try:
+            destination.unlink(missing_ok=True)
+            _link_or_copy(cached_file, destination)
+            # Mark it as recently used
+            os.utime(cached_file)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return False
+
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += destination.stat().st_size
+        log.debug("Source cache hit for [{}]".format(destination.name))
+        return True
+
+    def add(self, key: str, file_path: pathlib.Path) -> None:
+        """
+        Add a file to the cache, then delete the least recently used files until the cache fits its cap again.
+
+        :param key: cache key of the file, see `get_key`
+        :param file_path: file to add
+        :return: None
+        """
+        file_size = file_path.stat().st_size
+        if file_size > self.max_bytes:
+            log.debug("[{}] is bigger than the whole source cache, not caching it".format(file_path.name))
+            return
+
+        self.directory.mkdir(exist_ok=True, parents=True)
+        # Linked under a temporary name and renamed, so another slot never sees a partial file
+        temporary_path = self._get_path("{}.{}.tmp".format(key, os.getpid()))
+        try:
+            _link_or_copy(file_path, temporary_path)
+            os.replace(temporary_path, self._get_path(key))
+        except OSError as e:
+            temporary_path.unlink(missing_ok=True)
+            log.warning("Could not add [{}] to the source cache: {}".format(file_path.name, e))
+            return
+
+        self._evict()
+
+    def remove(self, key: str) -> None:
+        """
+        Remove a file from the cache, e.g. because it turned out to be unusable.
+
+        :param key: cache key of the file
+        :return: None
+        """
+        self._get_path(key).unlink(missing_ok=True)
+
+    def _iterate_entries(self) -> typing.Iterator[pathlib.Path]:
+        # Cached files only: not files still being added, or anything else that ended up in the directory
+        if not self.directory.exists():
+            return
+        for entry in self.directory.iterdir():
+            if not entry.name.endswith(".tmp") and entry.is_file():
+                yield entry
+
+    def _evict(self) -> None:
+        entries = []
+        for entry in self._iterate_entries():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry))
+
+        total_size = sum(x[1] for x in entries)
+        for _, size, entry in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            entry.unlink(missing_ok=True)
+            total_size -= size
+            with self._lock:
+                self.evictions += 1
+            log.debug("Evicted [{}] from the source cache".format(entry.name))
+
+    def get_keys(self) -> typing.List[str]:
+        """
+        Get the keys of every file in the cache, for the manager to send tasks to the worker that has their source.
+
+        :return: cache keys
+        """
+        return sorted(x.name for x in self._iterate_entries())
+
+    def get_statistics(self) -> dict:
+        """
+        Get the hit rate of the cache since the worker started, and what's in it now.
+
+        :return: cache statistics
+        """
+        entries = 0
+        size = 0
+        for entry in self._iterate_entries():
+            try:
+                size += entry.stat().st_size
+                entries += 1
+            except FileNotFoundError:
+                continue
+
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "bytes_saved": self.bytes_saved,
+                "evictions": self.evictions,
+                "entries": entries,
+                "size": size,
+                "max_size": self.max_bytes
+            }
+
+
+def _link_or_copy(source: pathlib.Path, destination: pathlib.Path) -> None:
+    try:
+        os.link(source, destination)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        # Different filesystems (or one without hardlinks)
+        shutil.copyfile(source, destination)
@@ -1,11 +1,131 @@
+import collections
+import os
 import shlex
 import subprocess
+import threading
+import time
 import typing
 
 from utils import log
 
 
-def run_command(command: str, print_output=False) -> (int, typing.List[str], typing.List[str]):
+# Lines of stdout/stderr to keep for commands whose output is only a log (e.g. mkvtoolnix, ffmpeg), so a misbehaving
+# (or very chatty) tool can't eat the worker's memory.  Everything is kept by default, since output that's parsed
+# (e.g. ffprobe's JSON) is useless once it's cut short.
+LOG_MAX_LINES = 10000
+
+# Seconds between SIGTERM and SIGKILL when a command is stopped for timing out or being cancelled.
+TERMINATE_GRACE_PERIOD = 5
+
+
+class CommandResult:
+    def __init__(self, command: str, return_code: int, stdout: typing.List[str], stderr: typing.List[str],
+                 wall_time: float, cpu_time: typing.Optional[float], timed_out: bool = False, cancelled: bool = False,
+                 dropped_lines: int = 0):
+        self.command: str = command
+        self.return_code: int = return_code
+        self.stdout: typing.List[str] = stdout
+        self.stderr: typing.List[str] = stderr
+        self.wall_time: float = wall_time
+        self.cpu_time: typing.Optional[float] = cpu_time  # user + system, None if the platform can't tell us
+        self.timed_out: bool = timed_out
+        self.cancelled: bool = cancelled
+        self.dropped_lines: int = dropped_lines  # lines that didn't fit in the buffers (oldest are dropped first)
+
+    def __repr__(self):
+        return "<CommandResult [{}] code {} in {:.3f}s>".format(
+            self.command.split(" ")[0], self.return_code, self.wall_time
+        )
+
+
+########################################################################################################################
+# Statistics
+########################################################################################################################
+# Totals of every command run by this process, by program name
+_statistics: typing.Dict[str, typing.Dict[str, float]] = {}
+_statistics_lock = threading.Lock()
+
+
+def _record_statistics(program: str, result: CommandResult) -> None:
+    with _statistics_lock:
+        program_statistics = _statistics.setdefault(program, {"count": 0, "wall_time": 0.0, "cpu_time": 0.0})
+        program_statistics["count"] += 1
+        program_statistics["wall_time"] += result.wall_time
+        program_statistics["cpu_time"] += result.cpu_time or 0.0
+
+
+def get_statistics() -> typing.Dict[str, typing.Dict[str, float]]:
+    """
+    Get the number of invocations and total wall/CPU time of every program run through this module.
+
+    :return: statistics by program name, e.g. {"ffprobe": {"count": 12, "wall_time": 1.3, "cpu_time": 0.9}}
+    """
+    with _statistics_lock:
+        return {x: y.copy() for x, y in _statistics.items()}
+
+
+########################################################################################################################
+# Running Commands
+########################################################################################################################
+def _drain(stream: typing.TextIO, buffer: typing.Deque[str], counter: typing.List[int], print_output: bool) -> None:
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+
+        counter[0] += 1
+        buffer.append(line)
+        if print_output:
+            log.debug(line)
+
+
+def _wait(process: subprocess.Popen, poll_interval: float) -> typing.Optional[float]:
+    """
+    Reap a process, returning the CPU time it used where the platform supports it.
+
+    :param process: process to reap
+    :param poll_interval: seconds to wait for it, or None to block until it exits
+    :return: CPU time (user + system) if the process was reaped and it's known, None otherwise
+    """
+    if hasattr(os, "wait4"):
+        pid, status, rusage = os.wait4(process.pid, 0 if poll_interval is None else os.WNOHANG)
+        if pid == 0:
+            time.sleep(poll_interval)
+            return None
+        # Reaped here rather than by Popen, so let it know the exit code
+        process.returncode = os.waitstatus_to_exitcode(status)
+        return rusage.ru_utime + rusage.ru_stime
+
+    try:
+        process.wait(timeout=poll_interval)
+    except subprocess.TimeoutExpired:
+        pass
+    return None
+
+
+def _stop(process: subprocess.Popen) -> None:
+    process.terminate()
+    deadline = time.monotonic() + TERMINATE_GRACE_PERIOD
+    while process.poll() is None and time.monotonic() < deadline:
+        time.sleep(0.05)
+    if process.poll() is None:
+        process.kill()
+
+
+def run_command_detailed(command: str, print_output=False, timeout: float = None,
+                         cancel_event: threading.Event = None,
+                         max_lines: typing.Optional[int] = None) -> CommandResult:
+    """
+    Run a command, draining stdout and stderr at the same time so neither pipe can fill up and block the process.
+
+    :param command: command to run
+    :param print_output: whether to log stdout live or not
+    :param timeout: seconds to let the command run before killing it, None to wait forever
+    :param cancel_event: kill the command as soon as this event is set
+    :param max_lines: lines of stdout and of stderr to keep (the last ones, see `LOG_MAX_LINES`), None to keep all
+    :return: result of the command
+    """
+    start_time = time.monotonic()
     process = subprocess.Popen(
         shlex.split(command),
         universal_newlines=True,
@@ -13,17 +133,67 @@ def run_command(command: str, print_output=False) -> (int, typing.List[str], typ
         encoding="utf-8", errors="backslashreplace"
     )
 
-    stdout = []
-    while True:
-        process_stdout = process.stdout.readline()
-        if process_stdout == "" and process.poll() is not None:
-            break
+    stdout = collections.deque(maxlen=max_lines)
+    stderr = collections.deque(maxlen=max_lines)
+    stdout_count = [0]
+    stderr_count = [0]
+    drain_threads = [
+        threading.Thread(target=_drain, args=(process.stdout, stdout, stdout_count, print_output), daemon=True),
+        threading.Thread(target=_drain, args=(process.stderr, stderr, stderr_count, False), daemon=True)
+    ]
+    for thread in drain_threads:
+        thread.start()
+
+    timed_out = False
+    cancelled = False
+    cpu_time = None
+
+    if timeout is None and cancel_event is None:
+        cpu_time = _wait(process, None)
+    else:
+        # Checking frequently at first so quick commands aren't held up, backing off for long ones
+        poll_interval = 0.001
+        while process.returncode is None:
+            cpu_time = _wait(process, poll_interval)
+            if process.returncode is not None:
+                break
+
+            if timeout is not None and time.monotonic() - start_time > timeout:
+                log.warning("Command [{}] timed out after [{}]s".format(command, timeout))
+                timed_out = True
+            elif cancel_event is not None and cancel_event.is_set():
+                log.debug("Command [{}] cancelled".format(command))
+                cancelled = True
+
+            if timed_out or cancelled:
+                _stop(process)
+                break
+            poll_interval = min(poll_interval * 2, 0.05)
+
+    for thread in drain_threads:
+        thread.join()
+    process.stdout.close()
+    process.stderr.close()
+
+    result = CommandResult(
+        command, process.returncode, list(stdout), list(stderr),
+        wall_time=time.monotonic() - start_time, cpu_time=cpu_time, timed_out=timed_out, cancelled=cancelled,
+        dropped_lines=stdout_count[0] - len(stdout) + stderr_count[0] - len(stderr)
+    )
+    _record_statistics(os.path.basename(shlex.split(command)[0]), result)
+    return result
 
-        stdout.append(process_stdout.strip())
-        if print_output and process_stdout:
-            log.debug(process_stdout.strip())
 
-    return_code = process.poll()
-    stderr = process.stderr.readlines()
+def run_command(command: str, print_output=False, timeout: float = None,
+                max_lines: typing.Optional[int] = None) -> (int, typing.List[str], typing.List[str]):
+    """
+    Run a command, see `run_command_detailed`.
 
-    return return_code, [x.strip() for x in stdout if x], [x.strip() for x in stderr if x]
+    :param command: command to run
+    :param print_output: whether to log stdout live or not
+    :param timeout: seconds to let the command run before killing it, None to wait forever
+    :param max_lines: lines of stdout and of stderr to keep (the last ones, see `LOG_MAX_LINES`), None to keep all
+    :return: return code, stdout lines, stderr lines
+    """
+    result = run_command_detailed(command, print_output=print_output, timeout=timeout, max_lines=max_lines)
+    return result.return_code, result.stdout, result.stderr